@@ -0,0 +1,137 @@
+"""
+Lower bounds on kernel distances from the first few DFT coefficients of the series (GEMINI)
+
+For each series of a SeriesStore, the filter keeps in memory the magnitudes of the first coefficients of the
+rFFT of the standardized series, and two numbers summing up the others: their energy and the sum of their
+fourth powers. From those of a query and of a series, it computes an upper bound on K(x,y), hence a lower
+bound on their kcorr_metric distance, at the cost of a few multiply-adds, with no FFT and no exp over the
+whole length. Candidates whose bound exceeds the distance of the current k-th best are discarded before
+their exact distance is computed.
+
+With X and Y the DFTs of standardized series x and y of length n, their cross-correlation at shift j is
+c_j = sum_f X_f conj(Y_f) e^(2 pi i f j / n) / n^2, so that:
+- c_j <= C = (sum_f |X_f| |Y_f|) / n^2, where the sum over the coefficients that are not kept is at most
+  the square root of the product of their energies (Cauchy-Schwarz); and c_j <= 1 anyway
+- sum_j c_j = X_0 Y_0 / n, and sum_j c_j^2 = Q = (sum_f |X_f|^2 |Y_f|^2) / n^3, the sum over the coefficients
+  not kept being at most the square root of the product of the sums of their fourth powers
+Since e^u <= 1 + u + u^2 g(U) for all u <= U, with g(U) = (e^U - 1 - U) / U^2, K(x,y) = sum_j e^(mult c_j) is
+at most n + mult X_0 Y_0 / n + mult^2 Q g(mult C), and at most n e^(mult C).
+
+Classes:
+--------
+DFTFilter(store, coefficients = DEFAULT_COEFFICIENTS, mult = 1)
+- Computes the truncated spectra of all the series of store, a chunk of rows at a time, and their self-kernels
+  with multiplier mult (those of the store for mult = 1)
+- Methods:
+        len(filter): number of series
+        coefficients: number of DFT coefficients kept per series
+        features(spectra): the truncated features of the rFFT spectra of standardized series, one per row
+        lower_bounds(features, kernels, rows = None): the len(queries) x len(rows) kcorr_metric lower bounds
+                                 from queries, given their features and self-kernels (with the multiplier of the
+                                 filter), to the series in rows (all of them by default)
+        record(tested, passed): counts candidates tested by the filter and those that passed it
+        tested, passed, selectivity: the counts so far, and the fraction of the tested candidates that
+                                 passed (the lower, the more exact distances the filter saves)
+        reset(): sets the counts back to zero
+
+Example:
+--------
+>>> from SeriesStore import SeriesStore
+>>> from TimeSeriesDistance import spectral_features_many
+>>> import tempfile, os
+>>> values = np.cumsum(np.random.randn(20, 64), axis=1)
+>>> store = SeriesStore.create(os.path.join(tempfile.mkdtemp(), 'series'), [str(i) for i in range(20)], values)
+>>> dftFilter = DFTFilter(store, 4)
+>>> spectra, kernels = spectral_features_many(store.std(slice(0, 2)))
+>>> dftFilter.lower_bounds(dftFilter.features(spectra), kernels).shape
+(2, 20)
+"""
+import numpy as np
+from TimeSeriesDistance import kcorr_dist, kcorr_metric, spectral_features_many, CHUNK_ROWS
+
+# coefficients kept per series when none are asked for
+DEFAULT_COEFFICIENTS = 8
+
+
+class DFTFilter(object):
+    "In-memory truncated spectra of the series of a store, bounding their kernel distances to a query from below."
+    # relative margin on the bound of K(x,y), so that rounding never pushes a bound past the exact distance
+    SLACK = 1e-9
+
+    def __init__(self, store, coefficients=DEFAULT_COEFFICIENTS, mult=1):
+        if coefficients < 1:
+            raise ValueError('The filter needs at least one coefficient')
+        self.n = store.values.shape[1]
+        self.coefficients = min(coefficients, self.n // 2 + 1)
+        self.mult = mult
+        # the rFFT holds each coefficient but the first (and the last, for even n) for itself and its conjugate
+        weights = np.full(self.n // 2 + 1, 2.0)
+        weights[0] = 1
+        if self.n % 2 == 0:
+            weights[-1] = 1
+        self._weights = weights
+        count = len(store)
+        self._magnitudes = np.empty((count, self.coefficients))
+        self._energy = np.empty(count)
+        self._fourth = np.empty(count)
+        self._kernels = np.empty(count)
+        for start in range(0, count, CHUNK_ROWS):
+            rows = slice(start, start + CHUNK_ROWS)
+            self._magnitudes[rows], self._energy[rows], self._fourth[rows] = self.features(store.spectrum(rows))
+            # the store keeps the self-kernels with multiplier 1 only
+            if mult == 1:
+                self._kernels[rows] = store.self_kernel(rows)
+            else:
+                self._kernels[rows] = spectral_features_many(store.std(rows), mult)[1]
+        self._powers = self._magnitudes ** 2
+        self.reset()
+
+    def __len__(self):
+        return len(self._magnitudes)
+
+    def features(self, spectra):
+        """magnitudes of the first coefficients of rFFT spectra, one per row, with the energy and the sum of
+        the fourth powers of the magnitudes of all the others, counting both halves of the full DFT"""
+        spectra = np.atleast_2d(spectra)
+        power = np.abs(spectra) ** 2
+        rest = power[:, self.coefficients:]
+        restWeights = self._weights[self.coefficients:]
+        return (np.sqrt(power[:, :self.coefficients]), rest.dot(restWeights), (rest * rest).dot(restWeights))
+
+    def lower_bounds(self, features, kernels, rows=None):
+        "kcorr_metric lower bounds from queries, given their features and self-kernels, to the series in rows"
+        magnitudes, energy, fourth = features
+        kernels = np.atleast_1d(kernels)
+        rows = slice(None) if rows is None else rows
+        n, mult = self.n, self.mult
+        weights = self._weights[:self.coefficients]
+        candidates = self._magnitudes[rows]
+        # upper bound on every c_j, and on the sum of their squares
+        correlation = (magnitudes * weights).dot(candidates.T)
+        correlation += np.sqrt(np.outer(energy, self._energy[rows]))
+        correlation = np.minimum(correlation / n**2, 1.0)
+        squares = (magnitudes**2 * weights).dot(self._powers[rows].T)
+        squares += np.sqrt(np.outer(fourth, self._fourth[rows]))
+        squares /= n**3
+        # g(mult C), from its series where cancellation would spoil it
+        top = mult * correlation
+        small = top < 1e-4
+        safe = np.where(small, 1.0, top)
+        slope = np.where(small, 0.5 + top / 6 + top**2 / 12, (np.expm1(safe) - safe) / safe**2)
+        mean = mult * np.outer(magnitudes[:, 0], candidates[:, 0]) / n
+        Kxy = np.minimum(n + mean + mult**2 * squares * slope, n * np.exp(top)) * (1 + self.SLACK)
+        return kcorr_metric(kcorr_dist(Kxy / np.sqrt(np.outer(kernels, self._kernels[rows]))))
+
+    def record(self, tested, passed):
+        "count candidates the filter was tried on, and those whose bound did not rule them out"
+        self.tested += tested
+        self.passed += passed
+
+    @property
+    def selectivity(self):
+        "fraction of the tested candidates that passed the filter, None before any test"
+        return self.passed / self.tested if self.tested else None
+
+    def reset(self):
+        self.tested = 0
+        self.passed = 0
@@ -0,0 +1,100 @@
+"""
+All-pairs kernel distance matrices between time series
+
+distance_matrix(series, others = None, mult = 1, condensed = False, out = None, block = BLOCK_ROWS, processes = 1)
+-------------
+- Expects a N x L matrix of standardized time series, one per row (e.g. store.std(slice(None)) of a SeriesStore),
+  and optionally a M x L matrix of others
+- Returns the N x M matrix of kcorr_dist(kernel_corr(series[i], others[j], mult)), or the N x N matrix
+  of the series with each other when others is None
+- With condensed = True (others must be None), returns the N * (N - 1) / 2 distances above the diagonal
+  instead, in the order of scipy.spatial.distance.pdist: row 0 with rows 1 ... N - 1, then row 1 with rows 2 ...
+- With out set to a file name, the result is written into a memory mapped '.npy' file there and that map is
+  returned, so N can be larger than what fits in memory
+
+The matrix is computed in square blocks of block x block pairs: the rows of a block pair are transformed once
+and all their cross-correlations come from a single inverse FFT along the last axis, which keeps each step
+small enough to stay in cache. Between the series and themselves only the blocks on and above the diagonal
+are computed and mirrored. With processes > 1 the blocks are spread across a multiprocessing pool, and the
+parent writes each one into the result as it comes back.
+
+Example:
+--------
+>>> series = np.random.randn(5, 100)
+>>> series = (series - series.mean(axis=1)[:, None]) / series.std(axis=1)[:, None]
+>>> distance_matrix(series).shape
+(5, 5)
+>>> distance_matrix(series, condensed=True).shape
+(10,)
+"""
+import multiprocessing
+import numpy as np
+from TimeSeriesDistance import spectral_features_many, kernel_dist_spectra_matrix
+
+# rows on each side of a block of pairs
+BLOCK_ROWS = 64
+
+
+def _distance_block(task):
+    "kernel distances between the rows of two blocks, returned with the position of the block"
+    rowStart, colStart, rows, cols, mult = task
+    n = rows.shape[1]
+    rowSpectra, rowKernels = spectral_features_many(rows, mult)
+    colSpectra, colKernels = spectral_features_many(cols, mult)
+    return rowStart, colStart, kernel_dist_spectra_matrix(rowSpectra, rowKernels, colSpectra, colKernels, n, mult)
+
+
+def _condensed_index(n, i, j):
+    "position of the pair (i, j), i < j, in the condensed distances of n series"
+    return n*i - i*(i + 1)//2 + j - i - 1
+
+
+def distance_matrix(series, others=None, mult=1, condensed=False, out=None, block=BLOCK_ROWS, processes=1):
+    "kernel distance matrix of the rows of series with the rows of others, or with each other"
+    series = np.atleast_2d(series)
+    symmetric = others is None
+    if symmetric:
+        others = series
+    others = np.atleast_2d(others)
+    if series.shape[1] != others.shape[1]:
+        raise ValueError('Time series must all have the same length')
+    if condensed and not symmetric:
+        raise ValueError('Only the distances of series with each other can be condensed')
+    if block < 1:
+        raise ValueError('Blocks must hold at least one row')
+    n, m = len(series), len(others)
+    shape = (n*(n - 1)//2,) if condensed else (n, m)
+    if out is None:
+        result = np.empty(shape)
+    else:
+        result = np.lib.format.open_memmap(out, mode='w+', dtype=np.float64, shape=shape)
+
+    tasks = ((rowStart, colStart, series[rowStart:rowStart + block], others[colStart:colStart + block], mult)
+             for rowStart in range(0, n, block)
+             for colStart in range(rowStart if symmetric else 0, m, block))
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        blocks = pool.imap_unordered(_distance_block, tasks)
+    else:
+        pool = None
+        blocks = map(_distance_block, tasks)
+    try:
+        for rowStart, colStart, distances in blocks:
+            rowEnd, colEnd = rowStart + len(distances), colStart + distances.shape[1]
+            if not condensed:
+                result[rowStart:rowEnd, colStart:colEnd] = distances
+                if symmetric and colStart != rowStart:
+                    result[colStart:colEnd, rowStart:rowEnd] = distances.T
+                continue
+            # each row of the block is a run of consecutive pairs in the condensed order
+            for i in range(rowStart, rowEnd):
+                first = max(colStart, i + 1)
+                if first < colEnd:
+                    start = _condensed_index(n, i, first)
+                    result[start:start + colEnd - first] = distances[i - rowStart, first - colStart:]
+    finally:
+        if pool is not None:
+            pool.terminate()
+    if out is not None:
+        result.flush()
+    return result
@@ -0,0 +1,105 @@
+"""
+Manifest of a VP forest index
+
+Written by createVPForest once all the VP databases and the pivot table are saved, and read by the queries, so that
+they use the vantage points the databases on disk were built for without rebuilding anything. It is a JSON file
+('manifest.json' by default) holding:
+- the vantage points, in order: the name of the TS, its row in the series store and the file of its database
+- the series store and pivot table files, the number and length of the series indexed
+- the distance parameters (the kernel multiplier and the metric the pivot table holds)
+- the seed the vantage points were drawn with, if any, so that the same index can be built again
+- the file of the vantage point tree over the series (see buildVPDBforest.VPTreeDB) and the root address committed
+  in it, so that queries read the tree built with the forest
+- once series were added or removed by a VPForest: the root address committed in each database, the store
+  rows of the removed series and the generation of the index, counting the commits since the first build.
+  Queries read the databases at those roots and the first seriesCount rows of the store and pivot table,
+  so that a manifest always describes one consistent snapshot of the whole forest
+
+Classes:
+--------
+IndexManifest(vantagePoints, seriesCount, length, store = DEFAULT_STORE, pivotTable = DEFAULT_PIVOT_TABLE,
+              mult = 1, metric = 'kcorr_metric', seed = None, roots = None, removed = (), generation = 0,
+              vpTree = None, vpTreeRoot = None)
+- vantagePoints is a list of (name of the TS, row in the store, name of the database) tuples
+- roots is None, for databases read at their last commit, or the root address of each of them
+- vpTree is None for an index built without a vantage point tree
+- Methods:
+        VPDict: the vantage points as a selectVPs dictionary, {number: (name of the TS, name of the database)}
+        VProws: the rows of the vantage points in the store, in order
+        save(path = DEFAULT_MANIFEST): writes the manifest, atomically replacing any previous one
+- Class methods:
+        load(path = DEFAULT_MANIFEST): reads a saved manifest, raises ValueError if it is of another version
+"""
+import json
+import os
+from SeriesStore import DEFAULT_STORE
+from PivotTable import DEFAULT_PIVOT_TABLE
+
+DEFAULT_MANIFEST = 'manifest.json'
+MANIFEST_VERSION = 1
+
+
+class IndexManifest(object):
+    "Description of the files and parameters of a VP forest index."
+    def __init__(self, vantagePoints, seriesCount, length, store=DEFAULT_STORE, pivotTable=DEFAULT_PIVOT_TABLE,
+                 mult=1, metric='kcorr_metric', seed=None, roots=None, removed=(), generation=0,
+                 vpTree=None, vpTreeRoot=None):
+        self.vantagePoints = [(str(name), int(row), str(db)) for name, row, db in vantagePoints]
+        self.seriesCount = int(seriesCount)
+        self.length = int(length)
+        self.store = store
+        self.pivotTable = pivotTable
+        self.mult = mult
+        self.metric = metric
+        self.seed = seed
+        self.roots = None if roots is None else [int(root) for root in roots]
+        self.removed = sorted(int(row) for row in removed)
+        self.generation = int(generation)
+        self.vpTree = vpTree
+        self.vpTreeRoot = None if vpTreeRoot is None else int(vpTreeRoot)
+
+    @property
+    def VPDict(self):
+        "the vantage points in the format of selectVPs: {number: (name of the TS, name of the database)}"
+        return {i + 1: (name, db) for i, (name, row, db) in enumerate(self.vantagePoints)}
+
+    @property
+    def VProws(self):
+        "rows of the vantage points in the series store"
+        return [row for name, row, db in self.vantagePoints]
+
+    def save(self, path=DEFAULT_MANIFEST):
+        "write the manifest to path, through a temporary file so that readers never see half of it"
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'vantagePoints': [{'ts': name, 'row': row, 'db': db} for name, row, db in self.vantagePoints],
+            'seriesCount': self.seriesCount,
+            'length': self.length,
+            'store': self.store,
+            'pivotTable': self.pivotTable,
+            'distance': {'mult': self.mult, 'metric': self.metric},
+            'seed': self.seed,
+            'roots': self.roots,
+            'removed': self.removed,
+            'generation': self.generation,
+            'vpTree': self.vpTree,
+            'vpTreeRoot': self.vpTreeRoot,
+        }
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path=DEFAULT_MANIFEST):
+        "read the manifest saved in path"
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest.get('version') != MANIFEST_VERSION:
+            raise ValueError('Index manifest of unknown version %r' % manifest.get('version'))
+        return cls([(vp['ts'], vp['row'], vp['db']) for vp in manifest['vantagePoints']],
+                   manifest['seriesCount'], manifest['length'], manifest['store'], manifest['pivotTable'],
+                   manifest['distance']['mult'], manifest['distance']['metric'], manifest['seed'],
+                   manifest.get('roots'), manifest.get('removed', ()), manifest.get('generation', 0),
+                   manifest.get('vpTree'), manifest.get('vpTreeRoot'))
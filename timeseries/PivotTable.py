@@ -0,0 +1,147 @@
+"""
+Pivot table (LAESA) over the series of a SeriesStore
+
+For k pivot series (the vantage points of the forest), the table keeps the N x k matrix of the kcorr_metric
+distances from every series of the store to every pivot, saved as '<path>.npy' and opened memory mapped,
+and the store rows of the pivots, saved as '<path>_rows.npy'.
+
+Since kcorr_metric obeys the triangle inequality, a series x can be no closer to a query q than
+max_i |d(q, pivot_i) - d(x, pivot_i)|. Once the query's distances to the k pivots are known, one vectorized
+pass over the table bounds the distance to every candidate, and the exact distance is only computed for
+the candidates whose bound does not exceed the distance of the current k-th best.
+
+Classes:
+--------
+PivotTable(path, count = None)
+- Opens the table saved under path, with only its first count rows if count is given
+- Methods:
+        len(table): number of series
+        pivots: store rows of the pivots, in the order of the columns
+        distances: the N x k table
+        pivot_distances(store, fourier, kernel): kcorr_metric distances from a query, given the spectral_features
+                                                 of the standardized query, to the pivots
+        lower_bounds(pivotDistances, rows = None): bounds on the distances from the query to the series in rows
+                                                   (all of them by default)
+        nearest(store, fourier, kernel, k = 1, rows = None, pivotDistances = None): the (distance, row) pairs of
+                                                   the k series in rows nearest to the query, nearest first.
+                                                   pivotDistances can be passed when they are already known
+        cost: the number of exact distances the last search computed
+        append(distances): adds the rows of the series appended to the store, given their distances to the pivots
+- Class methods:
+        create(path, store, pivots, distances = None): computes the table of the series of store for the pivot
+                                     rows (or takes the N x k distances, if known), saves it under path and opens it
+"""
+import heapq
+import os
+import numpy as np
+from SeriesStore import open_rows
+from TimeSeriesDistance import kernel_dist_spectra_many, kcorr_metric
+
+# where createVPForest saves the table of its vantage points
+DEFAULT_PIVOT_TABLE = 'pivots'
+
+
+class PivotTable(object):
+    "Memory mapped table of the distances from the series of a store to a few pivot series."
+    # candidates whose exact distance is computed in one batch
+    BATCH = 32
+
+    def __init__(self, path, count=None):
+        self.path = path
+        # the file can have room for more rows than the table holds (see append)
+        self._distances = np.load(path + '.npy', mmap_mode='r')[:count]
+        self._pivots = np.load(path + '_rows.npy')
+        self.cost = 0
+
+    def __len__(self):
+        return len(self._distances)
+
+    @property
+    def pivots(self):
+        "store rows of the pivots, one per column"
+        return self._pivots
+
+    @property
+    def distances(self):
+        "the N x k table of distances from each series to each pivot"
+        return self._distances
+
+    def pivot_distances(self, store, fourier, kernel):
+        "kcorr_metric distances from a query, given its spectral_features, to the pivots"
+        distances, _ = kernel_dist_spectra_many(fourier, kernel, store.spectrum(self._pivots),
+                                                store.self_kernel(self._pivots), store.values.shape[1])
+        return kcorr_metric(distances)
+
+    def lower_bounds(self, pivotDistances, rows=None):
+        "lower bounds on the distances from a query, at pivotDistances from the pivots, to the series in rows"
+        table = self._distances if rows is None else self._distances[rows]
+        return np.max(np.abs(table - pivotDistances), axis=1)
+
+    def nearest(self, store, fourier, kernel, k=1, rows=None, pivotDistances=None):
+        """the (distance, row) pairs of the k series in rows (all of them by default) nearest to a query,
+        nearest first, given the spectral_features of the standardized query"""
+        if k < 1:
+            raise ValueError('At least one neighbor must be searched for')
+        if pivotDistances is None:
+            pivotDistances = self.pivot_distances(store, fourier, kernel)
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows, dtype=np.int64)
+        bounds = self.lower_bounds(pivotDistances, rows)
+        # candidates are verified in increasing order of their bound, so the k-th best shrinks fast
+        order = np.argsort(bounds, kind='mergesort')
+        sortedBounds = bounds[order]
+        # max-heap of the best pairs so far, as (-distance, row)
+        best = []
+        self.cost = 0
+        start = 0
+        while start < len(order):
+            tau = -best[0][0] if len(best) == k else np.inf
+            # every candidate left has a bound of at least sortedBounds[start]
+            end = min(start + max(self.BATCH, k - len(best)),
+                      np.searchsorted(sortedBounds, tau, side='right'))
+            if end <= start:
+                break
+            candidates = rows[order[start:end]]
+            distances, _ = kernel_dist_spectra_many(fourier, kernel, store.spectrum(candidates),
+                                                    store.self_kernel(candidates), store.values.shape[1])
+            self.cost += len(candidates)
+            for distance, row in zip(kcorr_metric(distances).tolist(), candidates.tolist()):
+                if len(best) < k:
+                    heapq.heappush(best, (-distance, row))
+                elif distance < -best[0][0]:
+                    heapq.heapreplace(best, (-distance, row))
+            start = end
+        return sorted((-distance, row) for distance, row in best)
+
+    def append(self, distances):
+        """add rows at the end of the table, given the kcorr_metric distances of the new series to the pivots.
+        Readers that open the table with the count of rows it had never see them"""
+        distances = np.atleast_2d(distances)
+        if distances.shape[1] != len(self._pivots):
+            raise ValueError('Rows must hold a distance to each pivot')
+        start, end = len(self), len(self) + len(distances)
+        table = open_rows(self.path + '.npy', end)
+        table[start:end] = distances
+        table.flush()
+        del table
+        self._distances = np.load(self.path + '.npy', mmap_mode='r')[:end]
+
+    @classmethod
+    def create(cls, path, store, pivots, distances=None):
+        """compute the table of the series of store for the pivot rows, save it under path and open it.
+        distances, the N x k kcorr_metric distances, can be passed when they are already known"""
+        pivots = np.asarray(pivots, dtype=np.int64)
+        if len(pivots) == 0:
+            raise ValueError('A pivot table needs at least one pivot')
+        # written aside and moved into place, readers of the previous table keep their map
+        table = np.lib.format.open_memmap(
+            path + '.tmp', mode='w+', dtype=np.float64, shape=(len(store), len(pivots)))
+        if distances is not None:
+            table[:] = distances
+        else:
+            for column, pivot in enumerate(pivots):
+                table[:, column] = kcorr_metric(store.distances(pivot))
+        table.flush()
+        del table
+        os.replace(path + '.tmp', path + '.npy')
+        np.save(path + '_rows.npy', pivots)
+        return cls(path)
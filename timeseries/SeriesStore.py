@@ -0,0 +1,193 @@
+"""
+Packed, memory mapped store for a collection of equal length time series
+
+All the values are kept in one N x L float64 matrix saved as '<path>.npy', row i holding the i-th series,
+and the series names (e.g. './ts_12.npy') are kept in '<path>_names.npy'. The matrix is opened with
+np.load(mmap_mode='r'), so opening a store reads no values and each row is a zero-copy view into the map.
+
+Next to the values, the store keeps a spectral index of the series, computed once when they are stored:
+their standardized values ('<path>_std.npy'), the rFFT of those ('<path>_fft.npy') and their self-kernels
+K(x,x) with multiplier 1 ('<path>_kxx.npy'), as used by TimeSeriesDistance.kernel_corr_spectra.
+
+Classes:
+--------
+SeriesStore(path, count = None)
+- Opens the store saved under path, with only its first count series if count is given
+- Methods:
+        len(store): number of series
+        store[row]: values of the series in that row, as a read-only view
+        name(row): name of the series in that row
+        row(name): row of the series with that name, raises KeyError if there is none
+        values: the whole N x L matrix
+        std(row), spectrum(row), self_kernel(row): standardized values, their rFFT and K(x,x) for a row,
+                                                   or for an array or slice of rows at once
+        distances(row): kcorr_dist distances from the series in a row to all the series, in row order
+        append(names, series): adds the series at the end of the store, with their names, and returns their rows
+- Class methods:
+        create(path, names, series): saves the series (an iterable of equal length value arrays) under
+                                     path, with their names, and opens the new store
+        from_files(path, fileNames): packs the series saved with np.save in fileNames (e.g. by
+                                     generateAndStoreTS) into a store, named after their files
+"""
+import os
+import numpy as np
+from TimeSeriesDistance import spectral_features_many, kernel_dist_spectra_many, CHUNK_ROWS
+
+# where generateAndStoreTS saves the store and where the VP forest reads it from
+DEFAULT_STORE = 'series'
+
+
+def open_rows(path, count):
+    """
+    Open the .npy matrix saved in path for writing, with room for at least count rows.
+
+    A full matrix is copied into a new file with twice the rows, which then replaces it, so that
+    readers that mapped the old file keep a valid view of the rows they know of.
+    """
+    matrix = np.load(path, mmap_mode='r+')
+    if len(matrix) >= count:
+        return matrix
+    grown = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=matrix.dtype,
+                                      shape=(max(count, 2 * len(matrix)),) + matrix.shape[1:])
+    grown[:len(matrix)] = matrix
+    grown.flush()
+    del matrix
+    os.replace(path + '.tmp', path)
+    return grown
+
+
+class SeriesStore(object):
+    """
+    Read-only view of N equal length time series packed in one memory mapped matrix.
+
+    Rows are the integer ids of the series: the VP databases store them as values,
+    and a candidate is read by indexing the store with its row instead of loading its file.
+    """
+    def __init__(self, path, count=None):
+        self.path = path
+        self._names = [str(name) for name in np.load(path + '_names.npy')][:count]
+        count = len(self._names)
+        self._rows = {name: row for row, name in enumerate(self._names)}
+        # the files can have room for more rows than the store holds (see append)
+        self._values = np.load(path + '.npy', mmap_mode='r')[:count]
+        if not os.path.exists(path + '_kxx.npy'):
+            # store saved before the spectral index existed
+            self._save_spectral_index()
+        self._std = np.load(path + '_std.npy', mmap_mode='r')[:count]
+        self._spectra = np.load(path + '_fft.npy', mmap_mode='r')[:count]
+        self._kernels = np.load(path + '_kxx.npy', mmap_mode='r')[:count]
+
+    def __len__(self):
+        return len(self._names)
+
+    def __getitem__(self, row):
+        "values of the series in a row, as a view into the mapped matrix"
+        return self._values[row]
+
+    @property
+    def values(self):
+        "the N x L matrix of all the series, one per row"
+        return self._values
+
+    def std(self, row):
+        "standardized values of the series in a row"
+        return self._std[row]
+
+    def spectrum(self, row):
+        "rFFT of the standardized values of the series in a row"
+        return self._spectra[row]
+
+    def self_kernel(self, row):
+        "K(x,x) of the standardized series in a row, with multiplier 1"
+        return self._kernels[row]
+
+    def distances(self, row):
+        """kcorr_dist distances from the series in a row to all the series of the store, in row order.
+        the spectra stay mapped and are read a chunk at a time"""
+        allRows = slice(None)
+        distances, _ = kernel_dist_spectra_many(self._spectra[row], self._kernels[row], self._spectra[allRows],
+                                                self._kernels[allRows], self._values.shape[1])
+        return distances
+
+    def name(self, row):
+        return self._names[row]
+
+    def row(self, name):
+        return self._rows[name]
+
+    def append(self, names, series):
+        """
+        Add the series (equal length value arrays, as long as those of the store) at the end of the store,
+        with their names and spectral index, and return their rows.
+
+        The rows are written past the end of the store, and its names saved last, so that until then the
+        store holds the same series. Readers that opened it before, or that open it with the count of
+        series it had (see IndexManifest), never see the new rows.
+        """
+        names = list(names)
+        series = np.atleast_2d(np.asarray(series, dtype=np.float64))
+        if len(names) != len(series) or series.shape[1] != self._values.shape[1]:
+            raise ValueError('Series must be named and as long as those of the store')
+        start, end = len(self), len(self) + len(series)
+        std = (series - series.mean(axis=1)[:, None]) / series.std(axis=1)[:, None]
+        spectra, kernels = spectral_features_many(std)
+        for suffix, rows in (('.npy', series), ('_std.npy', std), ('_fft.npy', spectra), ('_kxx.npy', kernels)):
+            matrix = open_rows(self.path + suffix, end)
+            matrix[start:end] = rows
+            matrix.flush()
+            del matrix
+        with open(self.path + '_names.tmp', 'wb') as f:
+            np.save(f, np.array(self._names + names))
+        os.replace(self.path + '_names.tmp', self.path + '_names.npy')
+        self.__init__(self.path)
+        return list(range(start, end))
+
+    def _save_spectral_index(self):
+        "compute and save the standardized values, spectra and self-kernels of all the rows"
+        n, length = self._values.shape
+        std = np.lib.format.open_memmap(
+            self.path + '_std.npy', mode='w+', dtype=np.float64, shape=(n, length))
+        spectra = np.lib.format.open_memmap(
+            self.path + '_fft.npy', mode='w+', dtype=np.complex128, shape=(n, length // 2 + 1))
+        kernels = np.zeros(n)
+        for start in range(0, n, CHUNK_ROWS):
+            values = self._values[start:start + CHUNK_ROWS]
+            block = (values - values.mean(axis=1)[:, None]) / values.std(axis=1)[:, None]
+            std[start:start + CHUNK_ROWS] = block
+            spectra[start:start + CHUNK_ROWS], kernels[start:start + CHUNK_ROWS] = spectral_features_many(block)
+        std.flush()
+        spectra.flush()
+        del std, spectra
+        # saved last: its presence tells that the index is complete
+        np.save(self.path + '_kxx.npy', kernels)
+
+    @classmethod
+    def create(cls, path, names, series):
+        """
+        Save the series under path, row i holding series[i] named names[i], and open the store.
+
+        Rows are written one by one into the mapped file, so the series need not all be in memory.
+        """
+        names = list(names)
+        values = None
+        for row, seriesValues in enumerate(series):
+            seriesValues = np.asarray(seriesValues, dtype=np.float64)
+            if values is None:
+                values = np.lib.format.open_memmap(
+                    path + '.npy', mode='w+', dtype=np.float64, shape=(len(names), len(seriesValues)))
+            values[row] = seriesValues
+        if values is None:
+            raise ValueError('A series store needs at least one series')
+        values.flush()
+        del values
+        np.save(path + '_names.npy', np.array(names))
+        if os.path.exists(path + '_kxx.npy'):
+            # the index of the store being replaced
+            os.remove(path + '_kxx.npy')
+        return cls(path)
+
+    @classmethod
+    def from_files(cls, path, fileNames):
+        "pack the series saved in fileNames into a store under path, named after their files"
+        fileNames = list(fileNames)
+        return cls.create(path, fileNames, (np.load(fileName) for fileName in fileNames))
@@ -2,8 +2,6 @@ import math
 import numpy.fft as nfft
 import numpy as np
 import ArrayTimeSeries as ts
-from scipy.stats import norm
-import matplotlib.pyplot as plt
 
 """
 Implementation of timeseries distance by kernel correlation
@@ -17,10 +15,25 @@ Contain functions to:
 
 4. Compute the real distance between two timeseries
 
+5. Precompute the rFFT spectrum and self-kernel K(x,x) of a standardized timeseries, and compute
+   the kernelized correlation from those, so that indexed series are never re-standardized or
+   transformed again: a pair then costs a single inverse FFT
+
+6. Compute, in one call, the distances and best phase shifts from one timeseries to each row of a
+   matrix of timeseries (or of their spectra), transforming whole blocks of rows along an axis.
+   The rows are processed CHUNK_ROWS at a time so memory stays bounded for any number of rows.
+   kernel_dist_spectra_matrix gives the distances between every pair of rows of two small sets at once
+
+7. Turn kernel distances into a metric (kcorr_metric), for indexes that prune with the triangle inequality
 
 """
+# rows transformed at once by the batch functions
+CHUNK_ROWS = 1024
+
 def tsmaker(m, s, j):
     "generate timeseries for testing"
+    #imported here so that modules importing the distances do not pay for scipy.stats
+    from scipy.stats import norm
     t = np.arange(0.0, 1.0, 0.01)
     v = norm.pdf(t, m, s) + j*np.random.randn(100)
     return ts.ArrayTimeSeries(v, t)
@@ -69,6 +82,83 @@ def kernel_corr(ts1, ts2, mult=1):
     
     return Kxy/np.sqrt(Kxx*Kyy)
 
+def spectral_features(ts1, mult=1):
+    """
+    Given a standardized time series, return its rFFT spectrum and its self-kernel K(x,x),
+    the normalizer kernel_corr would otherwise recompute for every pair
+    """
+    fourier_ts1 = nfft.rfft(ts1)
+    Kxx = np.sum(np.exp(mult*ccor_spectra(fourier_ts1, fourier_ts1, len(ts1))))
+    return fourier_ts1, Kxx
+
+def ccor_spectra(fourier_ts1, fourier_ts2, n):
+    "cross-correlation of two standardized time series of length n, given their rFFT spectra"
+    return (1/n) * nfft.irfft(fourier_ts1 * np.conj(fourier_ts2), n)
+
+def kernel_corr_spectra(fourier_ts1, Kxx, fourier_ts2, Kyy, n, mult=1):
+    """
+    Same as kernel_corr, from the spectral_features of the two time series (of length n).
+    Kxx and Kyy must have been computed with the same multiplier.
+    """
+    Kxy = np.sum(np.exp(mult*ccor_spectra(fourier_ts1, fourier_ts2, n)))
+    return Kxy/np.sqrt(Kxx*Kyy)
+
+def spectral_features_many(series, mult=1, chunk=CHUNK_ROWS):
+    "spectral_features of each row of a matrix of standardized time series"
+    series = np.atleast_2d(series)
+    count, n = series.shape
+    spectra = np.empty((count, n // 2 + 1), dtype=np.complex128)
+    kernels = np.empty(count)
+    for start in range(0, count, chunk):
+        block = nfft.rfft(series[start:start + chunk], axis=1)
+        spectra[start:start + chunk] = block
+        kernels[start:start + chunk] = np.sum(np.exp(mult*ccor_spectra(block, block, n)), axis=1)
+    return spectra, kernels
+
+def kernel_dist_spectra_many(fourier_ts1, Kxx, spectra, Kyy, n, mult=1, chunk=CHUNK_ROWS):
+    """
+    Given the spectral_features of one time series of length n and those of many (a matrix of
+    spectra, one per row, and an array of self-kernels), return the array of their kernel distances
+    to the first one and the array of phase shifts at which their cross-correlation with it peaks,
+    as max_corr_at_phase(ts1, row) does for a pair
+    """
+    spectra = np.atleast_2d(spectra)
+    Kyy = np.atleast_1d(Kyy)
+    distances = np.empty(len(spectra))
+    shifts = np.empty(len(spectra), dtype=int)
+    for start in range(0, len(spectra), chunk):
+        ccorVals = ccor_spectra(fourier_ts1, spectra[start:start + chunk], n)
+        Kxy = np.sum(np.exp(mult*ccorVals), axis=1)
+        distances[start:start + chunk] = kcorr_dist(Kxy/np.sqrt(Kxx*Kyy[start:start + chunk]))
+        shifts[start:start + chunk] = np.argmax(ccorVals, axis=1)
+    return distances, shifts
+
+def kernel_dist_spectra_matrix(spectra1, Kxx, spectra2, Kyy, n, mult=1):
+    """
+    Given the spectral_features of two sets of time series of length n (matrices of spectra, one per row,
+    and arrays of self-kernels), return the matrix of the kernel distances between each row of the first
+    and each row of the second. All the pairs are transformed at once, so callers keep the sets small
+    """
+    # cross-correlation of every row with every column, one pair per [row, column, :]
+    ccorVals = ccor_spectra(spectra1[:, None, :], spectra2[None, :, :], n)
+    Kxy = np.sum(np.exp(mult*ccorVals), axis=2)
+    return kcorr_dist(Kxy/np.sqrt(Kxx[:, None]*Kyy[None, :]))
+
+def kernel_dist_many(ts1, series, mult=1, chunk=CHUNK_ROWS):
+    """
+    Given a standardized time series and a matrix of standardized time series, one per row,
+    return the kernel distances from each row to ts1 and the phase shifts of their best correlation
+    """
+    series = np.atleast_2d(series)
+    fourier_ts1, Kxx = spectral_features(ts1, mult)
+    distances = np.empty(len(series))
+    shifts = np.empty(len(series), dtype=int)
+    for start in range(0, len(series), chunk):
+        spectra, Kyy = spectral_features_many(series[start:start + chunk], mult, chunk)
+        distances[start:start + chunk], shifts[start:start + chunk] = kernel_dist_spectra_many(
+            fourier_ts1, Kxx, spectra, Kyy, len(ts1), mult, chunk)
+    return distances, shifts
+
 def kcorr_dist(kxy):
     """
     #The higher the correlation, the lower is the distance between two timeseries. 
@@ -76,8 +166,17 @@ def kcorr_dist(kxy):
     """
     return (2 * (1 - kxy))
 
+def kcorr_metric(kdist):
+    """
+    #Square root of a kcorr_dist (or of an array of them): the distance between the two timeseries in the
+    #feature space of the kernel. Unlike kcorr_dist it obeys the triangle inequality, which metric trees
+    #rely on to prune, and it ranks pairs the same way. Rounding errors below 0 are clipped.
+    """
+    return np.sqrt(np.maximum(kdist, 0))
+
 # to test if functions above work
 if __name__ == "__main__":
+    import matplotlib.pyplot as plt
     t1 = tsmaker(0.5, 0.1, 0.01)
     t2 = tsmaker(0.5, 0.1, 0.01)
     print(t1.mean(), t1.std(), t2.mean(), t2.std())
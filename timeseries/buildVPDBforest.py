@@ -1,17 +1,24 @@
 """
-Implementation of similarity searches using unbalanced binary search tree, wrapped into a database, with reference to implementation from  Lab 10
+Implementation of similarity searches using a self-balancing (AVL) binary search tree, wrapped into a database, with reference to implementation from  Lab 10
 
 With 20 vantage points selected, there will be 20 BST.
 Given a target TS, the nearest VP will be identified and searches will be carried out on the database associated with the vantage point
 
 Classes:
 --------
-1. DBDB
+1. DBDB(f, lsm = False, background_merge = False, bplus = False, **options)
+- Keys are kept in an AVL tree, or in a log-structured tree (lsm = True, see LSMTree) or a B+tree (bplus = True, see BPlusTree)
+- options are passed on to Storage: cache, mapped, concurrent, buffered, sync_commits, sync_interval_ms, root_address
 - Methods:
         getRootKey(): return the key of the root node of the tree
         getNodeKey(node): returns the key of the node
+        getNodeValue(node): returns the value of the node, without searching the tree for its key again
         getLeftChildNode(node = 0): returns the left child node from parent node, with parent node set as the root node as the default
         getRightChildNode(node = 0): returns the right child node from parent node, with parent node set as the root node as the default
+        range(lo = None, hi = None): lazily yields the (key, value) pairs with lo <= key <= hi in key order
+        items(): lazily yields all (key, value) pairs in key order
+        bulk_load(items): replaces the contents with the (key, value) pairs in items and commits
+        compact(filename = None): rewrites the file with only the committed tree and returns the bytes reclaimed
 
 2. VantagePointDB
 - Inherits from DBDB. 
@@ -25,29 +32,67 @@ Classes:
     Inputs - n: the total number of timeseries to be compared against the target TS
             folderPath: to be specified without the last '/', example: if TS files are in current folder, the input should be "." 
 
-3. createVPForest(k = 20)
-- Create a forest of VPDB, with k being 20 as the default. k corresponds to the number of vantage points identified as listed in VPDict
+    populate_from_store(store)
+    Purpose: Same as populate_VPDistTree, for all the series of a SeriesStore. The value at each node is the row of the TS
+
+    nearest(vpDistance, distance, k = 1, lower_bound = None, budget = None, time_limit = None)
+    Purpose: Best-first search for the k TS nearest to a query, as (distance, row) pairs, nearest first.
+             Exact, unless a budget of distances or a time_limit stops it early
+
+3. VPTreeDB
+- Inherits from DBDB. Holds a single vantage point tree over all the rows of a SeriesStore (see VPTree)
+- buildVPTree(store) writes the tree and returns its root, openVPTree(VPTreefilename, root_address) opens it read-only
+- Methods:
+        build(store, rows = None, seed = None), insert(store, row), remove(store, row)
+        nearest(store, fourier, kernel, k = 1, radius = None): the (distance, row) pairs of the k series nearest to a query
+
+4. createVPForest(k = 20, seed = None, n = 1000, folderPath = '.', manifestFileName = DEFAULT_MANIFEST,
+                  processes = 1, report = False, lsm = False, bplus = False)
+- Create a forest of VPDB, with k being 20 as the default. k corresponds to the number of vantage points drawn by selectVPs,
+  reproducibly for a given seed. The pivot table and the VP tree are built along, and the IndexManifest is saved and returned
+- Importing this module builds nothing: the forest is built by calling createVPForest, or by running this file
+
+5. VPForest(manifestFileName = DEFAULT_MANIFEST)
+- Opens the forest of a manifest to add and remove series while queries run on it
+- Methods:
+        add_series(id, values, commit = True), remove_series(id, commit = True), commit(), compact(), close()
 
 Preconditions:
 -------------
 - 1000 TS generated should follow the naming convention: 'ts_1.npy' ... to 'ts_1000.npy'
 
 """
+import bisect
+import heapq
+import itertools
+import math
+import collections
+import mmap
+import multiprocessing
+import numbers
 import pickle
 import os
 import struct
 import portalocker
+import threading
+import time
+import types
 import os
 from selectVPs import selectVPs
+from SeriesStore import SeriesStore, DEFAULT_STORE
+from PivotTable import PivotTable, DEFAULT_PIVOT_TABLE
+from IndexManifest import IndexManifest, DEFAULT_MANIFEST
 import ArrayTimeSeries as ts
 from TimeSeriesDistance import tsmaker, random_ts, stand, ccor, max_corr_at_phase, kernel_corr, kcorr_dist
+from TimeSeriesDistance import kernel_dist_spectra_many, kernel_dist_spectra_matrix, kcorr_metric
 import numpy as np
 
-# create the dictionary that contains info on the TS chosen as vantage points
-VPDict = selectVPs()
-
 class ValueRef(object):
-    " a reference to a string value on disk"
+    " a reference to a string (or integer) value on disk"
+    #integers, such as series store rows, are tagged with a byte that never starts utf-8 text
+    INTEGER_TAG = b'\xff'
+    INTEGER_FORMAT = "!q"
+
     def __init__(self, referent=None, address=0):
         self._referent = referent #value to store
         self._address = address #address to store at
@@ -61,17 +106,31 @@ class ValueRef(object):
 
     @staticmethod
     def referent_to_bytes(referent):
+        if isinstance(referent, numbers.Integral):
+            return ValueRef.INTEGER_TAG + struct.pack(ValueRef.INTEGER_FORMAT, referent)
         return referent.encode('utf-8')
 
     @staticmethod
     def bytes_to_referent(bytes):
-        return bytes.decode('utf-8')
+        if bytes[:1] == ValueRef.INTEGER_TAG:
+            return struct.unpack_from(ValueRef.INTEGER_FORMAT, bytes, 1)[0]
+        #str() rather than bytes.decode so that memory mapped views work too
+        return str(bytes, 'utf-8')
 
     
     def get(self, storage):
         "read bytes for value from disk"
         if self._referent is None and self._address:
-            self._referent = self.bytes_to_referent(storage.read(self._address))
+            return self._read(storage, self.bytes_to_referent)
+        return self._referent
+
+    def _read(self, storage, decode):
+        "decode the record at our address, going through the storage's cache if it has one"
+        if storage.cache is not None:
+            #the cache owns what it decodes: keeping it here as well would pin
+            #evicted nodes in memory through their parents
+            return storage.cache.read(storage, self._address, decode)
+        self._referent = decode(storage.read(self._address))
         return self._referent
 
     def store(self, storage):
@@ -83,32 +142,74 @@ class ValueRef(object):
 
 class BinaryNodeRef(ValueRef):
     "reference to a btree node on disk"
-    
+    #float64 key, left/value/right addresses and the subtree height
+    NODE_FORMAT = "!dQQQI"
+
     #calls the BinaryNode's store_refs
     def prepare_to_store(self, storage):
         "have a node store its refs"
         if self._referent:
             self._referent.store_refs(storage)
 
+    def get(self, storage):
+        "read bytes for node from disk, decoding them in the format of the file"
+        if (self._referent is None and self._address
+                and storage.format_version == Storage.PICKLE_FORMAT):
+            return self._read(storage, self.pickle_bytes_to_referent)
+        return ValueRef.get(self, storage)
+
+    def store(self, storage):
+        "store bytes for node to disk, encoding them in the format of the file"
+        if (self._referent is not None and not self._address
+                and storage.format_version == Storage.PICKLE_FORMAT):
+            self.prepare_to_store(storage)
+            self._address = storage.write(self.pickle_referent_to_bytes(self._referent))
+        ValueRef.store(self, storage)
+
     @staticmethod
     def referent_to_bytes(referent):
-        "use pickle to convert node to bytes"
+        "pack node into a fixed width record"
+        return struct.pack(BinaryNodeRef.NODE_FORMAT,
+            referent.key,
+            referent.left_ref.address,
+            referent.value_ref.address,
+            referent.right_ref.address,
+            referent.height,
+        )
+
+    @staticmethod
+    def bytes_to_referent(data):
+        "unpack a fixed width record to get a node object"
+        key, left, value, right, height = struct.unpack(BinaryNodeRef.NODE_FORMAT, data)
+        return BinaryNode(
+            BinaryNodeRef(address=left),
+            key,
+            ValueRef(address=value),
+            BinaryNodeRef(address=right),
+            height,
+        )
+
+    @staticmethod
+    def pickle_referent_to_bytes(referent):
+        "use pickle to convert node to bytes, for files in the old format"
         return pickle.dumps({
             'left': referent.left_ref.address,
             'key': referent.key,
             'value': referent.value_ref.address,
             'right': referent.right_ref.address,
+            'height': referent.height,
         })
 
     @staticmethod
-    def bytes_to_referent(string):
-        "unpickle bytes to get a node object"
+    def pickle_bytes_to_referent(string):
+        "unpickle bytes to get a node object, for files in the old format"
         d = pickle.loads(string)
         return BinaryNode(
             BinaryNodeRef(address=d['left']),
             d['key'],
             ValueRef(address=d['value']),
             BinaryNodeRef(address=d['right']),
+            d.get('height', 1),
         )
 
 class BinaryNode(object):
@@ -120,13 +221,16 @@ class BinaryNode(object):
             key=kwargs.get('key', node.key),
             value_ref=kwargs.get('value_ref', node.value_ref),
             right_ref=kwargs.get('right_ref', node.right_ref),
+            height=kwargs.get('height', node.height),
         )
 
-    def __init__(self, left_ref, key, value_ref, right_ref):
+    def __init__(self, left_ref, key, value_ref, right_ref, height=1):
         self.left_ref = left_ref
         self.key = key
         self.value_ref = value_ref
         self.right_ref = right_ref
+        #height of the subtree rooted here, used by BalancedBinaryTree
+        self.height = height
 
     def store_refs(self, storage):
         "method for a node to store all of its stuff"
@@ -142,8 +246,23 @@ class BinaryTree(object):
     "Immutable Binary Tree class. Constructs new tree on changes"
     def __init__(self, storage):
         self._storage = storage
+        #root snapshot. over a concurrent storage each thread keeps its own
+        self._snapshot = threading.local() if storage.concurrent else types.SimpleNamespace()
         self._refresh_tree_ref()
 
+    @property
+    def _tree_ref(self):
+        try:
+            return self._snapshot.tree_ref
+        except AttributeError:
+            #first use from this thread
+            self._refresh_tree_ref()
+            return self._snapshot.tree_ref
+
+    @_tree_ref.setter
+    def _tree_ref(self, tree_ref):
+        self._snapshot.tree_ref = tree_ref
+
     def commit(self):
         "changes are final only when committed"
         #triggers BinaryNodeRef.store
@@ -174,6 +293,29 @@ class BinaryTree(object):
                 return self._follow(node.value_ref)
         raise KeyError
 
+    def range(self, lo=None, hi=None):
+        """lazily yield (key, value) pairs with lo <= key <= hi in key order.
+        subtrees outside the range are never read; None leaves that side open"""
+        if not self._storage.locked:
+            self._refresh_tree_ref()
+        stack = []
+        node = self._follow(self._tree_ref)
+        while stack or node is not None:
+            if node is not None:
+                if lo is not None and node.key < lo:
+                    #everything on the left is smaller still
+                    node = self._follow(node.right_ref)
+                else:
+                    stack.append(node)
+                    node = self._follow(node.left_ref)
+            else:
+                node = stack.pop()
+                if hi is not None and node.key > hi:
+                    #the rest of the stack is larger still
+                    return
+                yield node.key, self._follow(node.value_ref)
+                node = self._follow(node.right_ref)
+
     def set(self, key, value):
         "set a new value in the tree. will cause a new tree"
         #try to lock the tree. If we succeed make sure
@@ -247,6 +389,74 @@ class BinaryTree(object):
                 return node.right_ref
         return BinaryNodeRef(referent=new_node)
 
+    def bulk_load(self, items):
+        """replace the tree with a perfectly balanced one holding the (key, value) pairs.
+        pairs are sorted once and nodes are appended children first, so every
+        record written is part of the committed tree"""
+        if self._storage.lock():
+            self._refresh_tree_ref()
+        #later pairs win over earlier ones with the same key, as with set
+        entries = sorted(dict(items).items())
+        self._tree_ref = self._build(entries, 0, len(entries))[0]
+        self.commit()
+
+    def _build(self, entries, lo, hi):
+        "write the balanced subtree of entries[lo:hi], returning its ref and height"
+        if lo >= hi:
+            return BinaryNodeRef(), 0
+        mid = (lo + hi) // 2
+        left_ref, left_height = self._build(entries, lo, mid)
+        right_ref, right_height = self._build(entries, mid + 1, hi)
+        key, value = entries[mid]
+        height = 1 + max(left_height, right_height)
+        node_ref = BinaryNodeRef(referent=BinaryNode(
+            left_ref, key, ValueRef(value), right_ref, height))
+        node_ref.store(self._storage)
+        #only keep the address so that memory stays O(log n)
+        return BinaryNodeRef(address=node_ref.address), height
+
+    def compact_into(self, storage):
+        """copy the committed tree into an empty storage and commit it there.
+        nodes are written first in breadth-first order, so the upper levels share
+        the first blocks of the file, then the values in the same order"""
+        self._refresh_tree_ref()
+        nodes, values = [], []
+        #new index of each node, by its address in the old file
+        position = {self._tree_ref.address: 0}
+        queue = collections.deque()
+        root = self._follow(self._tree_ref)
+        if root is not None:
+            queue.append(root)
+        while queue:
+            node = queue.popleft()
+            nodes.append(node)
+            values.append(bytes(self._storage.read(node.value_ref.address)))
+            for child_ref in (node.left_ref, node.right_ref):
+                child = self._follow(child_ref)
+                if child is not None:
+                    position[child_ref.address] = len(position)
+                    queue.append(child)
+        #node records have a fixed width, so every new address is known up front
+        node_length = Storage.INTEGER_LENGTH + struct.calcsize(BinaryNodeRef.NODE_FORMAT)
+        node_addresses = [Storage.SUPERBLOCK_SIZE + i * node_length
+                          for i in range(len(nodes))]
+        value_addresses = []
+        address = Storage.SUPERBLOCK_SIZE + len(nodes) * node_length
+        for value in values:
+            value_addresses.append(address)
+            address += Storage.INTEGER_LENGTH + len(value)
+        def new_ref(ref):
+            if ref.address in position:
+                return BinaryNodeRef(address=node_addresses[position[ref.address]])
+            return BinaryNodeRef()
+        for i, node in enumerate(nodes):
+            storage.write(BinaryNodeRef.referent_to_bytes(BinaryNode(
+                new_ref(node.left_ref), node.key, ValueRef(address=value_addresses[i]),
+                new_ref(node.right_ref), node.height)))
+        for value in values:
+            storage.write(value)
+        storage.commit_root_address(node_addresses[0] if nodes else 0)
+
     def _follow(self, ref):
         "get a node from a reference"
         #calls BinaryNodeRef.get
@@ -258,28 +468,270 @@ class BinaryTree(object):
             if next_node is None:
                 return node
             node = next_node
+
+class BalancedBinaryTree(BinaryTree):
+    """Immutable AVL tree. Constructs new tree on changes and rebalances
+    the copied path, so lookups stay O(log n) whatever the key order"""
+
+    def _height(self, ref):
+        node = self._follow(ref)
+        return node.height if node is not None else 0
+
+    def _node_ref(self, left_ref, key, value_ref, right_ref):
+        "make a new node whose height is computed from its children"
+        height = 1 + max(self._height(left_ref), self._height(right_ref))
+        return BinaryNodeRef(referent=BinaryNode(
+            left_ref, key, value_ref, right_ref, height))
+
+    def _rotate_right(self, node):
+        "new subtree with the left child of node promoted to the top"
+        left = self._follow(node.left_ref)
+        right_ref = self._node_ref(
+            left.right_ref, node.key, node.value_ref, node.right_ref)
+        return self._node_ref(left.left_ref, left.key, left.value_ref, right_ref)
+
+    def _rotate_left(self, node):
+        "new subtree with the right child of node promoted to the top"
+        right = self._follow(node.right_ref)
+        left_ref = self._node_ref(
+            node.left_ref, node.key, node.value_ref, right.left_ref)
+        return self._node_ref(left_ref, right.key, right.value_ref, right.right_ref)
+
+    def _balance(self, left_ref, key, value_ref, right_ref):
+        "make a new node, rotating if its children differ in height by more than one"
+        balance = self._height(left_ref) - self._height(right_ref)
+        if balance > 1:
+            left = self._follow(left_ref)
+            if self._height(left.left_ref) < self._height(left.right_ref):
+                left_ref = self._rotate_left(left)
+            return self._rotate_right(
+                BinaryNode(left_ref, key, value_ref, right_ref))
+        if balance < -1:
+            right = self._follow(right_ref)
+            if self._height(right.right_ref) < self._height(right.left_ref):
+                right_ref = self._rotate_right(right)
+            return self._rotate_left(
+                BinaryNode(left_ref, key, value_ref, right_ref))
+        return self._node_ref(left_ref, key, value_ref, right_ref)
+
+    def _insert(self, node, key, value_ref):
+        "insert a new node creating a new, rebalanced path from root"
+        if node is None:
+            return self._node_ref(BinaryNodeRef(), key, value_ref, BinaryNodeRef())
+        elif key < node.key:
+            return self._balance(
+                self._insert(self._follow(node.left_ref), key, value_ref),
+                node.key, node.value_ref, node.right_ref)
+        elif key > node.key:
+            return self._balance(
+                node.left_ref, node.key, node.value_ref,
+                self._insert(self._follow(node.right_ref), key, value_ref))
+        else: #same key, only the value changes so the shape is kept
+            return BinaryNodeRef(
+                referent=BinaryNode.from_node(node, value_ref=value_ref))
+
+    def _delete(self, node, key):
+        "underlying delete implementation, rebalancing on the way up"
+        if node is None:
+            raise KeyError
+        elif key < node.key:
+            return self._balance(
+                self._delete(self._follow(node.left_ref), key),
+                node.key, node.value_ref, node.right_ref)
+        elif key > node.key:
+            return self._balance(
+                node.left_ref, node.key, node.value_ref,
+                self._delete(self._follow(node.right_ref), key))
+        left = self._follow(node.left_ref)
+        right = self._follow(node.right_ref)
+        if left and right:
+            replacement = self._find_max(left)
+            left_ref = self._delete(left, replacement.key)
+            return self._balance(
+                left_ref, replacement.key, replacement.value_ref, node.right_ref)
+        elif left:
+            return node.left_ref
+        else:
+            return node.right_ref
+
+class NodeCache(object):
+    """LRU cache of decoded nodes and values, keyed by file and address.
+
+    Records in a Storage are never rewritten once appended, so a decoded record
+    stays valid for as long as its file exists and one cache can be shared by
+    every database of the forest. Files are told apart by the random id in their
+    superblock rather than by path or inode, so a file compacted, or deleted and
+    created again, is never served the records of the one it replaced. The cache is bounded by the total length of the
+    cached records; hits and misses are counted to help choose that bound.
+    """
+    DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def read(self, storage, address, decode):
+        "return the decoded record at address in storage, reading it on a miss"
+        key = (storage.file_id, address)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        data = storage.read(address)
+        referent = decode(data)
+        with self._lock:
+            if key not in self._entries and len(data) <= self.max_bytes:
+                self._entries[key] = (referent, len(data))
+                self.size += len(data)
+                while self.size > self.max_bytes:
+                    _, (_, length) = self._entries.popitem(last=False)
+                    self.size -= length
+        return referent
+
+    def clear(self):
+        "drop every entry"
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
 class Storage(object):
+    """Append-only record file with the root address in its superblock.
+
+    Each file has a random id in its superblock, written when it is created, by which a NodeCache tells
+    it apart from the files it may replace. A mapped storage renews its map when the committed root lies
+    past its end. A concurrent one gives each thread its own file handle, read with positional reads, and
+    reads the root under a shared lock; while a writer holds the exclusive lock, the last root read is used.
+
+    Options:
+        cache: NodeCache shared with other storages
+        mapped: read-only, records are read from a memory map of the file
+        concurrent: read-only, for use by many threads at once
+        buffered: records written before a commit are kept in memory and
+                  appended in one write when the root is committed
+        sync_commits: fsync every that many commits (0, the default, never does)
+        sync_interval_ms: fsync on commit when the last fsync is older than this
+        root_address: read the tree committed at that address (e.g. recorded in an
+                      IndexManifest) instead of the last one committed to the file.
+                      commits through this storage move it to their own root
+        format_version: format a new file is written in, FORMAT_VERSION by default.
+                        existing files keep the one in their superblock
+    """
     SUPERBLOCK_SIZE = 4096
     INTEGER_FORMAT = "!Q"
     INTEGER_LENGTH = 8
+    #the superblock holds the root address followed by the node format version.
+    #files written before the version marker have zeros there and pickled nodes
+    #then comes the random id of the file, zero in files written before it
+    FILE_ID_ADDRESS = 2 * INTEGER_LENGTH
+    PICKLE_FORMAT = 0
+    STRUCT_FORMAT = 1
+    #sorted runs of a log-structured tree (see LSMTree) rather than tree nodes
+    LSM_FORMAT = 2
+    #pages of a B+tree (see BPlusTree), each record written into a page of its own
+    BPLUS_FORMAT = 3
+    PAGE_SIZE = SUPERBLOCK_SIZE
+    #largest record that fits in a page next to its length prefix
+    PAGE_CAPACITY = PAGE_SIZE - INTEGER_LENGTH
+    FORMAT_VERSION = STRUCT_FORMAT
+    #ids of the storages that read files without an id
+    _anonymous_ids = itertools.count()
 
-    def __init__(self, f):
+    def __init__(self, f, cache=None, mapped=False, concurrent=False,
+                 buffered=False, sync_commits=0, sync_interval_ms=None, root_address=None,
+                 format_version=None):
         self._f = f
         self.locked = False
-        #we ensure that we start in a sector boundary
-        self._ensure_superblock()
+        #root to read instead of the one in the superblock, set once the file is ready
+        self._pinned_root = None
+        self._new_format_version = self.FORMAT_VERSION if format_version is None else format_version
+        #records waiting for the next commit, starting at _buffer_address
+        self.buffered = buffered
+        self._buffer = bytearray()
+        self._buffer_address = 0
+        #durability policy: commits since the last fsync, and when that was
+        self.sync_commits = sync_commits
+        self.sync_interval_ms = sync_interval_ms
+        self._unsynced_commits = 0
+        self._last_sync = time.time()
+        #optional NodeCache shared with other storages
+        self.cache = cache
+        stat = os.fstat(f.fileno())
+        #read-only storages read records straight from a memory map of the file
+        self._map = None
+        #read-only storages shared by threads give each thread its own file handle
+        self.concurrent = concurrent
+        if mapped and concurrent:
+            raise ValueError('A storage is either mapped or concurrent.')
+        if (mapped or concurrent) and stat.st_size < self.SUPERBLOCK_SIZE:
+            raise ValueError('Not a database file.')
+        if mapped:
+            self._remap()
+            self.format_version = self._map_integer(self.INTEGER_LENGTH)
+            self._set_file_id(self._map_integer(self.FILE_ID_ADDRESS))
+        elif concurrent:
+            if not isinstance(f.name, str):
+                raise ValueError('Database file name unknown, cannot open reader handles.')
+            self._local = threading.local()
+            self._reader_files = []
+            self._reader_files_lock = threading.Lock()
+            self.format_version = self._bytes_to_integer(os.pread(
+                f.fileno(), self.INTEGER_LENGTH, self.INTEGER_LENGTH))
+            self._set_file_id(self._bytes_to_integer(os.pread(
+                f.fileno(), self.INTEGER_LENGTH, self.FILE_ID_ADDRESS)))
+            #last root read by any thread, handed out while a writer holds the file
+            self._root_address = self._bytes_to_integer(
+                os.pread(f.fileno(), self.INTEGER_LENGTH, 0))
+        else:
+            #we ensure that we start in a sector boundary
+            self._ensure_superblock()
+        self._pinned_root = root_address
 
     def _ensure_superblock(self):
         "guarantee that the next write will start on a sector boundary"
         self.lock()
         self._seek_end()
         end_address = self._f.tell()
+        if end_address == 0:
+            #new file: empty root, then the format its nodes will be written in
+            self._write_integer(0)
+            self._write_integer(self._new_format_version)
+            end_address = self._f.tell()
         if end_address < self.SUPERBLOCK_SIZE:
             self._f.write(b'\x00' * (self.SUPERBLOCK_SIZE - end_address))
+        self._f.seek(self.INTEGER_LENGTH)
+        self.format_version = self._read_integer()
+        file_id = self._read_integer()
+        if not file_id:
+            #new file, or one written before ids: it gets one for good
+            file_id = self._new_file_id()
+            self._f.seek(self.FILE_ID_ADDRESS)
+            self._write_integer(file_id)
+        self._set_file_id(file_id)
         self.unlock()
 
+    @staticmethod
+    def _new_file_id():
+        return int.from_bytes(os.urandom(Storage.INTEGER_LENGTH), 'big') or 1
+
+    def _set_file_id(self, file_id):
+        """identify the file in cache keys, across the storages that open it. a file without an id,
+        opened read-only, is known to this storage alone"""
+        self.file_id = file_id if file_id else ('storage', next(self._anonymous_ids))
+
     def lock(self):
         "if not locked, lock the file for writing"
+        if self._map is not None or self.concurrent:
+            raise ValueError('Database opened read-only.')
         if not self.locked:
             portalocker.lock(self._f, portalocker.LOCK_EX)
             self.locked = True
@@ -317,37 +769,188 @@ class Storage(object):
         "write data to disk, returning the adress at which you wrote it"
         #first lock, get to end, get address to return, write size
         #write data, unlock <==WRONG, dont want to unlock here
+        if self.format_version == self.BPLUS_FORMAT:
+            return self._write_page(data)
         self.lock()
-        self._seek_end()
-        object_address = self._f.tell()
-        self._write_integer(len(data))
-        self._f.write(data)
+        object_address = self._end_address()
+        self._append(self._integer_to_bytes(len(data)) + data)
         return object_address
 
+    def _write_page(self, data):
+        """write data into a fresh page, returning the address of the page.
+        Pages are PAGE_SIZE bytes and start on PAGE_SIZE boundaries, right after the superblock,
+        so a record never straddles two disk blocks. Records keep the usual length prefix,
+        so they are read as any other"""
+        if len(data) > self.PAGE_CAPACITY:
+            raise ValueError('Record of %d bytes does not fit in a page' % len(data))
+        self.lock()
+        object_address = self._end_address()
+        #realign if the file was left with a partial page
+        padding = -object_address % self.PAGE_SIZE
+        self._append(b'\x00' * padding + self._integer_to_bytes(len(data)) + data
+                     + b'\x00' * (self.PAGE_CAPACITY - len(data)))
+        return object_address + padding
+
+    def _end_address(self):
+        "address the next record will be written at"
+        if self._buffer:
+            return self._buffer_address + len(self._buffer)
+        self._seek_end()
+        self._buffer_address = self._f.tell()
+        return self._buffer_address
+
+    def _append(self, data):
+        "add data at the end of the file, or of the write buffer"
+        if self.buffered:
+            self._buffer += data
+        else:
+            self._f.write(data)
+
+    def _flush_buffer(self):
+        "append all buffered records to the file in a single write"
+        if self._buffer:
+            self._seek_end()
+            self._f.write(self._buffer)
+            self._buffer = bytearray()
+
     def read(self, address):
+        if self._buffer and address >= self._buffer_address:
+            #written since the last commit and still in memory
+            start = address - self._buffer_address + self.INTEGER_LENGTH
+            length = self._bytes_to_integer(self._buffer[start - self.INTEGER_LENGTH:start])
+            return bytes(self._buffer[start:start + length])
+        if self._map is not None:
+            return self._read_mapped(address)
+        if self.concurrent:
+            #positional reads leave every file position alone
+            fd = self._reader_file().fileno()
+            length = self._bytes_to_integer(os.pread(fd, self.INTEGER_LENGTH, address))
+            return os.pread(fd, length, address + self.INTEGER_LENGTH)
         self._f.seek(address)
         length = self._read_integer()
         data = self._f.read(length)
         return data
 
+    def _reader_file(self):
+        "this thread's own handle on the file, opened on first use"
+        reader_file = getattr(self._local, 'f', None)
+        if reader_file is None:
+            reader_file = self._local.f = open(self._f.name, 'rb')
+            with self._reader_files_lock:
+                self._reader_files.append(reader_file)
+        return reader_file
+
+    def _read_shared_root_address(self):
+        """read the root under a shared lock on this thread's handle.
+        while a writer holds the exclusive lock, the last root read is returned"""
+        reader_file = self._reader_file()
+        try:
+            portalocker.lock(reader_file, portalocker.LOCK_SH | portalocker.LOCK_NB)
+        except portalocker.LockException:
+            return self._root_address
+        try:
+            self._root_address = self._bytes_to_integer(
+                os.pread(reader_file.fileno(), self.INTEGER_LENGTH, 0))
+        finally:
+            portalocker.unlock(reader_file)
+        return self._root_address
+
+    def _remap(self):
+        "map the whole file as it is now, dropping the previous mapping"
+        old_map = self._map
+        if old_map is not None:
+            self._view.release()
+        self._map = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        if old_map is not None:
+            try:
+                old_map.close()
+            except BufferError:
+                #a decoded record still points into it; it goes with that record
+                pass
+
+    def _map_integer(self, address):
+        return struct.unpack_from(self.INTEGER_FORMAT, self._map, address)[0]
+
+    def _read_mapped(self, address):
+        "view of the record at address, without copying it out of the map"
+        if address + self.INTEGER_LENGTH > len(self._map):
+            self._remap()
+        length = self._map_integer(address)
+        start = address + self.INTEGER_LENGTH
+        if start + length > len(self._map):
+            self._remap()
+        return self._view[start:start + length]
+
     def commit_root_address(self, root_address):
         self.lock()
+        self._flush_buffer()
         self._f.flush()
+        sync = self._sync_due()
+        if sync:
+            #the tree must be on disk before the root pointing to it
+            os.fsync(self._f.fileno())
         #make sure you write root address at position 0
         self._seek_superblock()
         #write is atomic because we store the address on a sector boundary.
         self._write_integer(root_address)
         self._f.flush()
+        if sync:
+            self._sync()
+        if self._pinned_root is not None:
+            self._pinned_root = root_address
         self.unlock()
 
+    def _sync_due(self):
+        "count a commit and tell whether the durability policy wants an fsync now"
+        self._unsynced_commits += 1
+        if self.sync_commits and self._unsynced_commits >= self.sync_commits:
+            return True
+        return (self.sync_interval_ms is not None
+                and (time.time() - self._last_sync) * 1000 >= self.sync_interval_ms)
+
+    def _sync(self):
+        os.fsync(self._f.fileno())
+        self._unsynced_commits = 0
+        self._last_sync = time.time()
+
     def get_root_address(self):
+        if self._pinned_root is not None:
+            if self._map is not None and self._pinned_root >= len(self._map):
+                self._remap()
+            return self._pinned_root
+        if self._map is not None:
+            #the superblock is shared with writers through the page cache: a root
+            #past the end of the map means the file has grown since we mapped it
+            root_address = self._map_integer(0)
+            if root_address >= len(self._map):
+                self._remap()
+            return root_address
+        if self.concurrent:
+            return self._read_shared_root_address()
         #read the first integer in the file
         self._seek_superblock()
         root_address = self._read_integer()
         return root_address
 
     def close(self):
+        #uncommitted records are dropped rather than left as garbage in the file
+        self._buffer = bytearray()
+        if self._unsynced_commits and (self.sync_commits or self.sync_interval_ms is not None):
+            self._f.flush()
+            self._sync()
         self.unlock()
+        if self.concurrent:
+            with self._reader_files_lock:
+                for reader_file in self._reader_files:
+                    reader_file.close()
+                self._reader_files = []
+        if self._map is not None:
+            self._view.release()
+            try:
+                self._map.close()
+            except BufferError:
+                pass
         self._f.close()
 
     @property
@@ -355,25 +958,72 @@ class Storage(object):
         return self._f.closed
 
 class DBDB(object):
+    """Key-value database over a Storage, keys kept in one of three immutable trees.
 
-    def __init__(self, f):
-        self._storage = Storage(f)
-        self._tree = BinaryTree(self._storage)
+    By default keys are in a BalancedBinaryTree (AVL), so the path to any key is O(log n) even when
+    distances are inserted in sorted order. Its nodes are fixed width records (float key, three addresses
+    and the height); files created before this format carry no version in their superblock and are still
+    read and written with pickled nodes. lsm=True creates the file as a LSMTree, for databases that take in
+    many writes, and bplus=True as a BPlusTree. Files are reopened in the structure they were created with,
+    so readers need not pass lsm or bplus; the tree navigation helpers only apply to binary trees.
+    """
+
+    def __init__(self, f, lsm=False, background_merge=False, bplus=False, **options):
+        """options are passed on to Storage (cache, mapped, concurrent, buffered, ...).
+        lsm=True creates a new file as a log-structured tree (see LSMTree), and bplus=True
+        as a B+tree (see BPlusTree), which is then opened as one whatever lsm and bplus are;
+        background_merge applies to log-structured trees"""
+        if lsm and bplus:
+            raise ValueError('A database is either log-structured or a B+tree.')
+        if lsm:
+            options['format_version'] = Storage.LSM_FORMAT
+        elif bplus:
+            options['format_version'] = Storage.BPLUS_FORMAT
+        self._storage = Storage(f, **options)
+        format_version = self._storage.format_version
+        if format_version == Storage.LSM_FORMAT and not bplus:
+            self._tree = LSMTree(self._storage, background_merge)
+        elif format_version == Storage.BPLUS_FORMAT and not lsm:
+            self._tree = BPlusTree(self._storage)
+        elif lsm or bplus:
+            self._storage.close()
+            raise ValueError('Database file is not %s.' % ('log-structured' if lsm else 'a B+tree'))
+        else:
+            self._tree = BalancedBinaryTree(self._storage)
 
     def _assert_not_closed(self):
         if self._storage.closed:
             raise ValueError('Database closed.')
 
     def close(self):
+        if isinstance(self._tree, LSMTree):
+            self._tree.wait()
         self._storage.close()
 
     def commit(self):
         self._assert_not_closed()
         self._tree.commit()
 
+    def merge(self):
+        "merge the runs of a log-structured database until no tier is left to merge, see LSMTree.merge"
+        self._assert_not_closed()
+        if not isinstance(self._tree, LSMTree):
+            raise ValueError('Only log-structured databases have runs to merge.')
+        self._tree.wait()
+        return self._tree.merge()
+
     def get(self, key):
         self._assert_not_closed()
         return self._tree.get(key)
+
+    def range(self, lo=None, hi=None):
+        "generator of (key, value) pairs with lo <= key <= hi, in key order"
+        self._assert_not_closed()
+        return self._tree.range(lo, hi)
+
+    def items(self):
+        "generator of all (key, value) pairs, in key order"
+        return self.range()
     
     def getRootKey(self):
         #refresh the references and get new tree if needed
@@ -385,6 +1035,10 @@ class DBDB(object):
     
     def getNodeKey(self, node):
         return node.key
+
+    def getNodeValue(self, node):
+        "value stored at the node, read through its value_ref rather than searched by key"
+        return self._tree._follow(node.value_ref)
     
     def getLeftChildNode(self, node = 0):
         if node == 0:
@@ -406,9 +1060,761 @@ class DBDB(object):
         self._assert_not_closed()
         return self._tree.delete(key)
 
+    def bulk_load(self, items):
+        "replace the contents with the (key, value) pairs in items and commit"
+        self._assert_not_closed()
+        return self._tree.bulk_load(items)
+
+    def compact(self, filename=None):
+        """rewrite the file with only the committed tree, returning the bytes reclaimed.
+
+        Uncommitted changes are committed first. The live tree is copied to a new
+        file which then replaces the old one, so readers that still have the old
+        file open keep reading their snapshot. Other writers must reopen the file.
+        """
+        self._assert_not_closed()
+        if filename is None:
+            #once compacted, the file is open under the name it was written as
+            filename = getattr(self, '_filename', self._storage._f.name)
+        if not isinstance(filename, str):
+            raise ValueError('Database file name unknown, pass it to compact.')
+        self.commit()
+        if isinstance(self._tree, LSMTree):
+            self._tree.wait()
+        #keep writers out until the new file is in place
+        self._storage.lock()
+        old_size = os.fstat(self._storage._f.fileno()).st_size
+        new_filename = filename + '.compact'
+        #binary trees are written in the current format, other structures keep theirs
+        format_version = None
+        if self._storage.format_version in (Storage.LSM_FORMAT, Storage.BPLUS_FORMAT):
+            format_version = self._storage.format_version
+        #the new file is written and synced as the old one was
+        storage = self._storage
+        new_storage = type(storage)(open(new_filename, 'w+b'), cache=storage.cache, buffered=storage.buffered,
+                                    sync_commits=storage.sync_commits, sync_interval_ms=storage.sync_interval_ms,
+                                    format_version=format_version)
+        try:
+            self._tree.compact_into(new_storage)
+            os.fsync(new_storage._f.fileno())
+            os.replace(new_filename, filename)
+        except Exception:
+            new_storage.close()
+            os.remove(new_filename)
+            raise
+        self._storage.close()
+        self._storage = new_storage
+        self._filename = filename
+        self._tree._storage = new_storage
+        self._tree._refresh_tree_ref()
+        return old_size - os.fstat(new_storage._f.fileno()).st_size
+
+class BPlusLeaf(object):
+    "leaf page of a B+tree: sorted keys and their encoded values"
+    def __init__(self, keys, values):
+        self.keys = keys
+        self.values = values
+
+    def store_refs(self, storage):
+        pass
+
+class BPlusInternal(object):
+    "internal page of a B+tree: n sorted separator keys and n + 1 child refs"
+    def __init__(self, keys, child_refs):
+        self.keys = keys
+        self.child_refs = child_refs
+
+    def store_refs(self, storage):
+        "store the children first so that their addresses are known"
+        for child_ref in self.child_refs:
+            child_ref.store(storage)
+
+class BPlusPageRef(BinaryNodeRef):
+    "reference to a B+tree page on disk"
+    LEAF = 0
+    INTERNAL = 1
+    HEADER_FORMAT = "!BH"
+    HEADER_LENGTH = struct.calcsize(HEADER_FORMAT)
+    ENTRY_FORMAT = "!dH"
+    ENTRY_LENGTH = struct.calcsize(ENTRY_FORMAT)
+    #pages have a single encoding, whatever the superblock says
+    get = ValueRef.get
+    store = ValueRef.store
+
+    @staticmethod
+    def referent_to_bytes(referent):
+        "pack a page as a header followed by fixed width keys and addresses"
+        ref = BPlusPageRef
+        n = len(referent.keys)
+        if isinstance(referent, BPlusLeaf):
+            chunks = [struct.pack(ref.HEADER_FORMAT, ref.LEAF, n)]
+            for key, value in zip(referent.keys, referent.values):
+                chunks.append(struct.pack(ref.ENTRY_FORMAT, key, len(value)))
+                chunks.append(value)
+            return b''.join(chunks)
+        return b''.join([
+            struct.pack(ref.HEADER_FORMAT, ref.INTERNAL, n),
+            struct.pack("!%dd" % n, *referent.keys),
+            struct.pack("!%dQ" % (n + 1),
+                        *[child_ref.address for child_ref in referent.child_refs]),
+        ])
+
+    @staticmethod
+    def bytes_to_referent(data):
+        "unpack a page written by referent_to_bytes"
+        ref = BPlusPageRef
+        kind, n = struct.unpack_from(ref.HEADER_FORMAT, data)
+        offset = ref.HEADER_LENGTH
+        if kind == ref.LEAF:
+            keys, values = [], []
+            for i in range(n):
+                key, length = struct.unpack_from(ref.ENTRY_FORMAT, data, offset)
+                offset += ref.ENTRY_LENGTH
+                keys.append(key)
+                values.append(bytes(data[offset:offset + length]))
+                offset += length
+            return BPlusLeaf(keys, values)
+        keys = list(struct.unpack_from("!%dd" % n, data, offset))
+        offset += 8 * n
+        addresses = struct.unpack_from("!%dQ" % (n + 1), data, offset)
+        return BPlusInternal(keys, [BPlusPageRef(address=a) for a in addresses])
+
+class BPlusTree(BinaryTree):
+    """Immutable B+tree over a Storage in BPLUS_FORMAT, one page per record. Constructs new pages on changes.
+
+    Keys are floats (the distances stored by VantagePointDB) and values are
+    strings, both kept inline in the pages. Internal pages hold up to
+    MAX_INTERNAL_KEYS keys, so a million keys are reached in 3 to 4 page reads.
+    Like the binary tree, changed pages are copied up to the root, so leaves
+    are not chained to their siblings; ordered scans walk down from the root.
+    Pages are Storage.PAGE_SIZE (4 KiB, the superblock size) long and aligned
+    on page boundaries.
+    """
+    MAX_INTERNAL_KEYS = ((Storage.PAGE_CAPACITY - BPlusPageRef.HEADER_LENGTH
+                          - Storage.INTEGER_LENGTH) // 16)
+    #values up to this size are guaranteed to leave room for a split
+    MAX_VALUE_LENGTH = Storage.PAGE_SIZE // 4
+    #pages smaller than this are merged with a sibling on delete
+    MIN_FILL = Storage.PAGE_SIZE // 4
+
+    def _refresh_tree_ref(self):
+        "get reference to new tree if it has changed"
+        self._tree_ref = BPlusPageRef(
+            address=self._storage.get_root_address())
+
+    def _size(self, node):
+        "encoded size of a page in bytes"
+        if isinstance(node, BPlusLeaf):
+            return (BPlusPageRef.HEADER_LENGTH + len(node.keys) * BPlusPageRef.ENTRY_LENGTH
+                    + sum(len(value) for value in node.values))
+        return BPlusPageRef.HEADER_LENGTH + 16 * len(node.keys) + Storage.INTEGER_LENGTH
+
+    def _overflows(self, node):
+        if isinstance(node, BPlusLeaf):
+            return self._size(node) > Storage.PAGE_CAPACITY
+        return len(node.keys) > self.MAX_INTERNAL_KEYS
+
+    def _split(self, node):
+        "split a full page into two, returning (left, separator key, right)"
+        if isinstance(node, BPlusLeaf):
+            #split at the byte midpoint so that both halves fit in a page
+            half = self._size(node) // 2
+            mid, used = 0, BPlusPageRef.HEADER_LENGTH
+            while used < half and mid < len(node.keys) - 1:
+                used += BPlusPageRef.ENTRY_LENGTH + len(node.values[mid])
+                mid += 1
+            mid = max(mid, 1)
+            return (BPlusLeaf(node.keys[:mid], node.values[:mid]),
+                    node.keys[mid],
+                    BPlusLeaf(node.keys[mid:], node.values[mid:]))
+        mid = len(node.keys) // 2
+        return (BPlusInternal(node.keys[:mid], node.child_refs[:mid + 1]),
+                node.keys[mid],
+                BPlusInternal(node.keys[mid + 1:], node.child_refs[mid + 1:]))
+
+    def get(self, key):
+        "get value for a key"
+        if not self._storage.locked:
+            self._refresh_tree_ref()
+        node = self._follow(self._tree_ref)
+        while isinstance(node, BPlusInternal):
+            node = self._follow(node.child_refs[bisect.bisect_right(node.keys, key)])
+        if node is not None:
+            i = bisect.bisect_left(node.keys, key)
+            if i < len(node.keys) and node.keys[i] == key:
+                return ValueRef.bytes_to_referent(node.values[i])
+        raise KeyError
+
+    def range(self, lo=None, hi=None, reverse=False):
+        """lazily yield (key, value) pairs with lo <= key <= hi in key order,
+        or in reverse order from hi down. the pages on the path to the current
+        leaf are kept on a stack, so each page in the range is read once"""
+        if not self._storage.locked:
+            self._refresh_tree_ref()
+        node = self._follow(self._tree_ref)
+        if node is None:
+            return
+        step = -1 if reverse else 1
+        stack = []
+        while isinstance(node, BPlusInternal):
+            if reverse:
+                i = bisect.bisect_right(node.keys, hi) if hi is not None else len(node.keys)
+            else:
+                i = bisect.bisect_right(node.keys, lo) if lo is not None else 0
+            stack.append((node, i))
+            node = self._follow(node.child_refs[i])
+        if reverse:
+            i = bisect.bisect_right(node.keys, hi) if hi is not None else len(node.keys)
+        else:
+            i = bisect.bisect_left(node.keys, lo) if lo is not None else 0
+        while True:
+            entries = zip(node.keys[:i], node.values[:i]) if reverse else zip(node.keys[i:], node.values[i:])
+            for key, value in (reversed(list(entries)) if reverse else entries):
+                if (hi is not None and key > hi) or (lo is not None and key < lo):
+                    return
+                yield key, ValueRef.bytes_to_referent(value)
+            #climb to the first ancestor with a child on the next side, then go down its near side
+            while stack and not 0 <= stack[-1][1] + step < len(stack[-1][0].child_refs):
+                stack.pop()
+            if not stack:
+                return
+            parent, i = stack.pop()
+            stack.append((parent, i + step))
+            node = self._follow(parent.child_refs[i + step])
+            while isinstance(node, BPlusInternal):
+                i = len(node.keys) if reverse else 0
+                stack.append((node, i))
+                node = self._follow(node.child_refs[i])
+            i = len(node.keys) if reverse else 0
+
+    def set(self, key, value):
+        "set a new value in the tree. will cause a new tree"
+        if self._storage.lock():
+            self._refresh_tree_ref()
+        value = ValueRef.referent_to_bytes(value)
+        if len(value) > self.MAX_VALUE_LENGTH:
+            raise ValueError('Value of %d bytes is too large for a page' % len(value))
+        node = self._follow(self._tree_ref)
+        if node is None:
+            node = BPlusLeaf([], [])
+        node = self._insert(node, float(key), value)
+        if self._overflows(node):
+            #the root split, so the tree grows by one level
+            left, separator, right = self._split(node)
+            node = BPlusInternal([separator], [BPlusPageRef(referent=left),
+                                               BPlusPageRef(referent=right)])
+        self._tree_ref = BPlusPageRef(referent=node)
+
+    def _insert(self, node, key, value):
+        "copy of node with key inserted; the copy may overflow and need a split"
+        if isinstance(node, BPlusLeaf):
+            keys, values = list(node.keys), list(node.values)
+            i = bisect.bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                values[i] = value
+            else:
+                keys.insert(i, key)
+                values.insert(i, value)
+            return BPlusLeaf(keys, values)
+        keys, child_refs = list(node.keys), list(node.child_refs)
+        i = bisect.bisect_right(keys, key)
+        child = self._insert(self._follow(child_refs[i]), key, value)
+        if self._overflows(child):
+            left, separator, right = self._split(child)
+            child_refs[i:i + 1] = [BPlusPageRef(referent=left),
+                                   BPlusPageRef(referent=right)]
+            keys.insert(i, separator)
+        else:
+            child_refs[i] = BPlusPageRef(referent=child)
+        return BPlusInternal(keys, child_refs)
+
+    def bulk_load(self, items):
+        """replace the tree with one built bottom-up from the (key, value) pairs.
+        leaves are packed full in key order and written first, then each level
+        of internal pages above them"""
+        if self._storage.lock():
+            self._refresh_tree_ref()
+        entries = sorted((float(key), ValueRef.referent_to_bytes(value))
+                         for key, value in dict(items).items())
+        refs, first_keys = [], []
+        leaf = BPlusLeaf([], [])
+        for key, value in entries:
+            if len(value) > self.MAX_VALUE_LENGTH:
+                raise ValueError('Value of %d bytes is too large for a page' % len(value))
+            if (leaf.keys and self._size(leaf) + BPlusPageRef.ENTRY_LENGTH
+                    + len(value) > Storage.PAGE_CAPACITY):
+                self._write_page(leaf, leaf.keys[0], refs, first_keys)
+                leaf = BPlusLeaf([], [])
+            leaf.keys.append(key)
+            leaf.values.append(value)
+        self._write_page(leaf, leaf.keys[0] if leaf.keys else None, refs, first_keys)
+        while len(refs) > 1:
+            #spread the children evenly so that no page is left with a single one
+            fanout = self.MAX_INTERNAL_KEYS + 1
+            groups = (len(refs) + fanout - 1) // fanout
+            level_refs, level_keys = [], []
+            start = 0
+            for g in range(groups):
+                end = start + (len(refs) - start) // (groups - g)
+                node = BPlusInternal(first_keys[start + 1:end], refs[start:end])
+                self._write_page(node, first_keys[start], level_refs, level_keys)
+                start = end
+            refs, first_keys = level_refs, level_keys
+        self._tree_ref = refs[0]
+        self.commit()
+
+    def _write_page(self, node, first_key, refs, first_keys):
+        "store a page built by bulk_load and record its address and smallest key"
+        ref = BPlusPageRef(referent=node)
+        ref.store(self._storage)
+        refs.append(BPlusPageRef(address=ref.address))
+        first_keys.append(first_key)
+
+    def compact_into(self, storage):
+        """copy the committed tree into an empty page storage and commit it there,
+        pages in breadth-first order"""
+        self._refresh_tree_ref()
+        nodes = []
+        queue = collections.deque()
+        root = self._follow(self._tree_ref)
+        if root is not None:
+            queue.append(root)
+        while queue:
+            node = queue.popleft()
+            nodes.append(node)
+            if isinstance(node, BPlusInternal):
+                queue.extend(self._follow(child_ref) for child_ref in node.child_refs)
+        #children are queued in order, so page i + 1 is the next child in line
+        next_page = 1
+        for node in nodes:
+            if isinstance(node, BPlusInternal):
+                child_refs = []
+                for _ in node.child_refs:
+                    child_refs.append(BPlusPageRef(
+                        address=Storage.SUPERBLOCK_SIZE + next_page * Storage.PAGE_SIZE))
+                    next_page += 1
+                node = BPlusInternal(node.keys, child_refs)
+            storage.write(BPlusPageRef.referent_to_bytes(node))
+        storage.commit_root_address(Storage.SUPERBLOCK_SIZE if nodes else 0)
+
+    def delete(self, key):
+        "delete key, creating new tree and path"
+        if self._storage.lock():
+            self._refresh_tree_ref()
+        node = self._delete(self._follow(self._tree_ref), float(key))
+        #an internal root left with a single child is dropped
+        while isinstance(node, BPlusInternal) and not node.keys:
+            node = self._follow(node.child_refs[0])
+        self._tree_ref = BPlusPageRef(referent=node)
+
+    def _delete(self, node, key):
+        "copy of node with key removed; the copy may be underfull"
+        if node is None:
+            raise KeyError
+        if isinstance(node, BPlusLeaf):
+            i = bisect.bisect_left(node.keys, key)
+            if i == len(node.keys) or node.keys[i] != key:
+                raise KeyError
+            return BPlusLeaf(node.keys[:i] + node.keys[i + 1:],
+                             node.values[:i] + node.values[i + 1:])
+        keys, child_refs = list(node.keys), list(node.child_refs)
+        i = bisect.bisect_right(keys, key)
+        child = self._delete(self._follow(child_refs[i]), key)
+        child_refs[i] = BPlusPageRef(referent=child)
+        if self._size(child) < self.MIN_FILL and len(child_refs) > 1:
+            #merge with the left sibling, or the right one for the first child
+            j = i - 1 if i > 0 else i
+            left, right = self._follow(child_refs[j]), self._follow(child_refs[j + 1])
+            if isinstance(left, BPlusLeaf):
+                merged = BPlusLeaf(left.keys + right.keys, left.values + right.values)
+            else:
+                merged = BPlusInternal(left.keys + [keys[j]] + right.keys,
+                                       left.child_refs + right.child_refs)
+            if self._overflows(merged):
+                #too big for one page: redistribute the keys between the two
+                left, separator, right = self._split(merged)
+                child_refs[j:j + 2] = [BPlusPageRef(referent=left),
+                                       BPlusPageRef(referent=right)]
+                keys[j] = separator
+            else:
+                child_refs[j:j + 2] = [BPlusPageRef(referent=merged)]
+                del keys[j]
+        return BPlusInternal(keys, child_refs)
+
+class LSMRun(object):
+    """immutable sorted run of a log-structured tree: n keys in increasing order, whether each
+    of them is deleted, and their encoded values (see ValueRef.referent_to_bytes) in one blob"""
+    def __init__(self, keys, deleted, offsets, blob):
+        self.keys = keys
+        self.deleted = deleted
+        #the value of the i-th key is blob[offsets[i]:offsets[i + 1]]
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, key):
+        "position of key in the run, or None"
+        i = int(np.searchsorted(self.keys, key))
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return None
+
+    def value(self, i):
+        return ValueRef.bytes_to_referent(self.blob[int(self.offsets[i]):int(self.offsets[i + 1])])
+
+    def entries(self, age, lo=None, hi=None, reverse=False):
+        "generator of (key, age, run, position) for the keys with lo <= key <= hi, in order or reversed"
+        start = 0 if lo is None else int(np.searchsorted(self.keys, lo, side='left'))
+        end = len(self.keys) if hi is None else int(np.searchsorted(self.keys, hi, side='right'))
+        positions = range(end - 1, start - 1, -1) if reverse else range(start, end)
+        for i in positions:
+            yield float(self.keys[i]), age, self, i
+
+    @classmethod
+    def from_entries(cls, keys, values):
+        "run of the sorted keys, with their encoded values, None for a deleted key"
+        deleted = np.array([value is None for value in values], dtype=bool)
+        values = [b'' if value is None else value for value in values]
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(value) for value in values], dtype=np.int64)
+        return cls(np.array(keys, dtype=np.float64), deleted, offsets, b''.join(values))
+
+    @classmethod
+    def merge(cls, runs, drop_deleted=False):
+        """merge runs, newest first, into one where the newest entry of each key wins.
+        deleted keys are dropped with drop_deleted, when no older run is left for them to hide"""
+        keys = np.concatenate([run.keys for run in runs])
+        ages = np.concatenate([np.full(len(run), age, dtype=np.int64) for age, run in enumerate(runs)])
+        order = np.lexsort((ages, keys))
+        newest = np.ones(len(order), dtype=bool)
+        newest[1:] = keys[order[1:]] != keys[order[:-1]]
+        order = order[newest]
+        deleted = np.concatenate([run.deleted for run in runs])[order]
+        if drop_deleted:
+            order, deleted = order[~deleted], deleted[~deleted]
+        #gather the values from the blobs of all the runs, one after the other, in a single pass
+        bases = np.cumsum([0] + [len(run.blob) for run in runs[:-1]])
+        starts = np.concatenate([run.offsets[:-1] + base for run, base in zip(runs, bases)])[order]
+        lengths = np.concatenate([np.diff(run.offsets) for run in runs])[order]
+        blob = np.concatenate([np.frombuffer(run.blob, dtype=np.uint8) for run in runs])
+        offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(lengths)
+        positions = np.arange(offsets[-1]) + np.repeat(starts - offsets[:-1], lengths)
+        return cls(keys[order], deleted, offsets, blob[positions].tobytes())
+
+class LSMRunRef(ValueRef):
+    "reference to a sorted run on disk: its length, keys, deleted flags, value offsets and values"
+    COUNT_FORMAT = "!Q"
+    COUNT_LENGTH = struct.calcsize(COUNT_FORMAT)
+
+    @staticmethod
+    def referent_to_bytes(run):
+        return b''.join([struct.pack(LSMRunRef.COUNT_FORMAT, len(run)),
+                         np.asarray(run.keys, dtype='>f8').tobytes(),
+                         np.asarray(run.deleted, dtype=np.uint8).tobytes(),
+                         np.asarray(run.offsets, dtype='>u8').tobytes(),
+                         bytes(run.blob)])
+
+    @staticmethod
+    def bytes_to_referent(data):
+        n = struct.unpack_from(LSMRunRef.COUNT_FORMAT, data)[0]
+        offset = LSMRunRef.COUNT_LENGTH
+        #keys and offsets are searched and sliced a lot, so they are kept in native order
+        keys = np.frombuffer(data, dtype='>f8', count=n, offset=offset).astype(np.float64)
+        offset += 8 * n
+        deleted = np.frombuffer(data, dtype=np.uint8, count=n, offset=offset).astype(bool)
+        offset += n
+        offsets = np.frombuffer(data, dtype='>u8', count=n + 1, offset=offset).astype(np.int64)
+        offset += 8 * (n + 1)
+        return LSMRun(keys, deleted, offsets, data[offset:])
+
+class LSMRunListRef(ValueRef):
+    "reference to the root of a log-structured tree: the (address, length) of its runs, newest first"
+    RUN_FORMAT = "!QQ"
+    RUN_LENGTH = struct.calcsize(RUN_FORMAT)
+
+    @staticmethod
+    def referent_to_bytes(runs):
+        return (struct.pack(LSMRunRef.COUNT_FORMAT, len(runs))
+                + b''.join(struct.pack(LSMRunListRef.RUN_FORMAT, address, length) for address, length in runs))
+
+    @staticmethod
+    def bytes_to_referent(data):
+        n = struct.unpack_from(LSMRunRef.COUNT_FORMAT, data)[0]
+        return tuple(struct.unpack_from(LSMRunListRef.RUN_FORMAT, data, LSMRunRef.COUNT_LENGTH + i * LSMRunListRef.RUN_LENGTH)
+                     for i in range(n))
+
+class LSMTree(object):
+    """Log-structured merge tree, the write-optimized alternative to the binary tree of a DBDB.
+
+    set and delete only change an in-memory memtable. Once it holds MEMTABLE_SIZE keys, or on commit,
+    the memtable is appended to the file in one record, as an immutable sorted run where deleted keys
+    are marked. Committing writes the list of the runs, newest first, as the new root. A key is thus
+    written once, rather than with the whole path of nodes above it, and again whenever its run is merged.
+
+    Runs are merged by tiers: the newest runs are merged into one for as long as the next one is at most
+    MERGE_RATIO times as long as those before it together, so that runs grow geometrically and a key is
+    merged O(log n) times. Only committed runs are merged, and the merged run takes their place in a new
+    committed list, so readers see the same keys before and after. With background_merge, merges run in
+    a thread of their own while the writer goes on.
+
+    get looks for a key in the memtable, then in the runs from newest to oldest. range merges the memtable
+    and the runs in key order, the newest entry of a key hiding the older ones.
+    """
+    MEMTABLE_SIZE = 4096
+    MERGE_RATIO = 2
+
+    def __init__(self, storage, background_merge=False):
+        self._storage = storage
+        self.background_merge = background_merge
+        #key -> encoded value, None for a deleted key, and its keys in order
+        self._memtable = {}
+        self._memtable_keys = []
+        #(address, length) of the runs, newest first: all of them, and those of the last commit
+        self._runs = self._committed = ()
+        #runs decoded so far, when the storage has no cache to keep them
+        self._loaded = {}
+        #the writer and the merge thread share the file
+        self._lock = threading.RLock()
+        self._merger = None
+        self._merge_error = None
+        self._refresh_tree_ref()
+
+    def _refresh_tree_ref(self):
+        "get the runs of the last commit, unless there are changes waiting for the next one"
+        with self._lock:
+            if self._memtable or self._runs != self._committed:
+                return
+            address = self._storage.get_root_address()
+            self._set_runs(LSMRunListRef(address=address).get(self._storage) if address else ())
+
+    def _set_runs(self, runs, committed=None):
+        "switch to new lists of runs, forgetting the decoded runs that are not in them any more"
+        self._runs = tuple(runs)
+        self._committed = self._runs if committed is None else tuple(committed)
+        live = set(address for address, length in self._runs)
+        self._loaded = {address: run for address, run in self._loaded.items() if address in live}
+
+    def _run(self, address):
+        "the decoded run at address"
+        with self._lock:
+            if self._storage.cache is not None:
+                return LSMRunRef(address=address).get(self._storage)
+            run = self._loaded.get(address)
+            if run is None:
+                run = self._loaded[address] = LSMRunRef(address=address).get(self._storage)
+            return run
+
+    def get(self, key):
+        "get value for a key"
+        if not self._storage.locked:
+            self._refresh_tree_ref()
+        if key in self._memtable:
+            value = self._memtable[key]
+            if value is None:
+                raise KeyError
+            return ValueRef.bytes_to_referent(value)
+        for address, length in self._runs:
+            run = self._run(address)
+            i = run.find(key)
+            if i is not None:
+                if run.deleted[i]:
+                    raise KeyError
+                return run.value(i)
+        raise KeyError
+
+    def range(self, lo=None, hi=None, reverse=False):
+        """lazily yield (key, value) pairs with lo <= key <= hi in key order, or in reverse order.
+        the memtable and every run are scanned side by side"""
+        if not self._storage.locked:
+            self._refresh_tree_ref()
+        keys = self._memtable_keys
+        start = 0 if lo is None else bisect.bisect_left(keys, lo)
+        end = len(keys) if hi is None else bisect.bisect_right(keys, hi)
+        keys = keys[start:end]
+        if reverse:
+            keys.reverse()
+        #the memtable is age 0 and the runs are older and older: a key is read from the youngest
+        sources = [[(key, 0, None, self._memtable[key]) for key in keys]]
+        sources.extend(self._run(address).entries(age, lo, hi, reverse)
+                       for age, (address, length) in enumerate(self._runs, 1))
+        order = (lambda entry: (entry[0], -entry[1])) if reverse else (lambda entry: entry[:2])
+        last = None
+        for key, age, run, item in heapq.merge(*sources, key=order, reverse=reverse):
+            if last is not None and key == last:
+                continue
+            last = key
+            if run is None:
+                if item is not None:
+                    yield key, ValueRef.bytes_to_referent(item)
+            elif not run.deleted[item]:
+                yield key, run.value(item)
+
+    def set(self, key, value):
+        "set a new value in the memtable"
+        with self._lock:
+            if self._storage.lock():
+                self._refresh_tree_ref()
+            self._put(float(key), ValueRef.referent_to_bytes(value))
+
+    def delete(self, key):
+        "mark key deleted in the memtable, raising KeyError if there is no such key"
+        with self._lock:
+            if self._storage.lock():
+                self._refresh_tree_ref()
+            self.get(key)
+            self._put(float(key), None)
+
+    def _put(self, key, value):
+        if key not in self._memtable:
+            bisect.insort(self._memtable_keys, key)
+        self._memtable[key] = value
+        if len(self._memtable) >= self.MEMTABLE_SIZE:
+            self._flush()
+
+    def _flush(self):
+        "write the memtable as the newest run, which the next commit makes part of the tree"
+        keys = self._memtable_keys
+        run = LSMRun.from_entries(keys, [self._memtable[key] for key in keys])
+        address = self._storage.write(LSMRunRef.referent_to_bytes(run))
+        self._memtable = {}
+        self._memtable_keys = []
+        self._set_runs(((address, len(run)),) + self._runs, self._committed)
+
+    def commit(self):
+        "changes are final only when committed"
+        with self._lock:
+            if self._memtable:
+                self._flush()
+            if self._runs != self._committed:
+                self._commit_runs(self._runs)
+            else:
+                self._storage.unlock()
+        self._start_merge()
+
+    def _commit_runs(self, runs):
+        "write the list of runs and make it the root"
+        address = self._storage.write(LSMRunListRef.referent_to_bytes(runs)) if runs else 0
+        self._storage.commit_root_address(address)
+        self._committed = tuple(runs)
+
+    def _tier(self, runs):
+        "number of the newest runs to merge together, 0 while they are not worth merging"
+        if len(runs) < 2:
+            return 0
+        count, total = 1, runs[0][1]
+        while count < len(runs) and runs[count][1] <= self.MERGE_RATIO * total:
+            total += runs[count][1]
+            count += 1
+        return count if count > 1 else 0
+
+    def merge(self):
+        "merge tiers of committed runs until none is left to merge, and return the number of merges"
+        merges = 0
+        while self._merge_tier():
+            merges += 1
+        return merges
+
+    def _merge_tier(self):
+        "merge the newest tier of committed runs and commit the merged run in their place"
+        with self._lock:
+            committed = self._committed
+            count = self._tier(committed)
+            if not count:
+                return False
+            tier = committed[:count]
+            runs = [self._run(address) for address, length in tier]
+        #the runs are immutable, so they are merged while the writer goes on.
+        #no older run is left for a deleted key of the oldest tier to hide
+        merged = LSMRun.merge(runs, drop_deleted=(count == len(committed)))
+        with self._lock:
+            #the writer may have committed newer runs, never removed any
+            committed = self._committed
+            i = committed.index(tier[0])
+            replacement = ()
+            if len(merged):
+                replacement = ((self._storage.write(LSMRunRef.referent_to_bytes(merged)), len(merged)),)
+            merged_runs = committed[:i] + replacement + committed[i + count:]
+            pending = self._runs[:len(self._runs) - len(committed)]
+            self._commit_runs(merged_runs)
+            self._set_runs(pending + merged_runs, merged_runs)
+        return True
+
+    def _start_merge(self):
+        "merge the committed runs if a tier is due, in the merge thread with background_merge"
+        if not self._tier(self._committed):
+            return
+        if not self.background_merge:
+            self.merge()
+            return
+        with self._lock:
+            if self._merger is None:
+                self._merger = threading.Thread(target=self._merge_in_background)
+                self._merger.daemon = True
+                self._merger.start()
+
+    def _merge_in_background(self):
+        "merge until no tier is due, including those the writer commits meanwhile"
+        while True:
+            try:
+                self.merge()
+            except Exception as error:
+                self._merge_error = error
+            with self._lock:
+                if self._merge_error is not None or not self._tier(self._committed):
+                    self._merger = None
+                    return
+
+    def wait(self):
+        "wait for the merges running in the background, raising the error that stopped them if any"
+        merger = self._merger
+        if merger is not None:
+            merger.join()
+        error, self._merge_error = self._merge_error, None
+        if error is not None:
+            raise error
+
+    def bulk_load(self, items):
+        "replace the tree with a single run of the (key, value) pairs, and commit"
+        self.wait()
+        with self._lock:
+            if self._storage.lock():
+                self._refresh_tree_ref()
+            entries = {float(key): ValueRef.referent_to_bytes(value) for key, value in items}
+            keys = sorted(entries)
+            run = LSMRun.from_entries(keys, [entries[key] for key in keys])
+            self._memtable = {}
+            self._memtable_keys = []
+            runs = ((self._storage.write(LSMRunRef.referent_to_bytes(run)), len(run)),) if keys else ()
+            self._commit_runs(runs)
+            self._set_runs(runs)
+
+    def compact_into(self, storage):
+        "merge all the committed runs into one, without deleted keys, in an empty storage and commit it there"
+        self.wait()
+        with self._lock:
+            self._refresh_tree_ref()
+            runs = [self._run(address) for address, length in self._committed]
+            address = 0
+            if runs:
+                merged = LSMRun.merge(runs, drop_deleted=True)
+                if len(merged):
+                    run_address = storage.write(LSMRunRef.referent_to_bytes(merged))
+                    address = storage.write(LSMRunListRef.referent_to_bytes(((run_address, len(merged)),)))
+            storage.commit_root_address(address)
+            #addresses in the new file may be those of other runs in the old one
+            self._loaded = {}
+            self._runs = self._committed = ()
+
 
 class VantagePointDB(DBDB):
-    def __init__(self, VPdbfilename, VPtsfilename):
+    #keys can be off the kcorr_dist distance of their TS by this much: TS as far from the VP as others are
+    #moved to the next floats above them (see uniqueKeys), and distances to the query are computed apart
+    KEY_ERROR = 1e-12
+
+    def __init__(self, VPdbfilename, VPtsfilename, **options):
         self.VPDBfile = VPdbfilename
         self.VPTSfile = VPtsfilename
         try:
@@ -416,7 +1822,128 @@ class VantagePointDB(DBDB):
         except IOError:
             fd = os.open(self.VPDBfile, os.O_RDWR | os.O_CREAT)
             f = os.fdopen(fd, 'r+b')
-        DBDB.__init__(self, f)
+        DBDB.__init__(self, f, **options)
+
+    def compact(self):
+        """rewrite the database file with only the committed tree, see DBDB.compact.
+        a database read at the root recorded in a manifest is compacted with its forest, see VPForest.compact"""
+        if self._storage._pinned_root is not None:
+            raise ValueError('Database read at a manifest root, compact its forest with VPForest.compact.')
+        return DBDB.compact(self, self.VPDBfile)
+
+    def nearest(self, vpDistance, distance, k=1, lower_bound=None, budget=None, time_limit=None):
+        """best-first search for the k (distance, row) pairs nearest to a query, nearest first.
+
+        vpDistance is the kcorr_metric distance from the query to the VP, distance(row) the exact
+        kcorr_metric distance from the query to the TS in a row, and lower_bound(row), if given, a
+        cheaper bound on it (e.g. from a PivotTable), or a list of such bounds tried in turn, cheapest
+        first (e.g. then a DFTFilter). The keys are kcorr_dist distances to the VP,
+        so a TS at key x is at least |sqrt(x) - vpDistance| from the query, give or take KEY_ERROR
+        on x. Subtrees wait in a
+        priority queue ordered by the least such bound over their range of keys, and the search
+        stops when the best of them is farther than the k-th best TS found so far.
+
+        In a log-structured or B+tree database the keys are in sorted runs or pages rather than in a binary
+        tree: they are read outwards from the query's own key, on both sides at once, nearest bound first,
+        with the same stop.
+
+        With a budget of exact distances, or a time_limit in seconds, the search is approximate: it also
+        stops once it has computed budget distances or run that long, and returns the best pairs found so
+        far. complete tells whether the last search ended on its own, its result then being exact.
+        """
+        self._assert_not_closed()
+        if budget is not None and budget < 1:
+            raise ValueError('The budget must allow at least one distance')
+        tree = self._tree
+        if not self._storage.locked:
+            tree._refresh_tree_ref()
+        self.visits = 0
+        self.cost = 0
+        self.complete = True
+        deadline = None if time_limit is None else time.time() + time_limit
+        if lower_bound is None:
+            lower_bound = []
+        elif callable(lower_bound):
+            lower_bound = [lower_bound]
+        #number of TS each bound ruled out
+        self.pruned = [0] * len(lower_bound)
+        #max-heap of the best pairs so far, as (-distance, row)
+        best = []
+        if k < 1:
+            return best
+        if isinstance(tree, (LSMTree, BPlusTree)):
+            return self._nearest_sorted(vpDistance, distance, k, lower_bound, best, budget, deadline)
+        #frontier of (bound, tie breaker, ref, lowest, highest) for the subtrees to visit, where lowest
+        #and highest bound the kcorr_metric distance to the VP of the TS in the subtree
+        order = itertools.count()
+        frontier = [(0.0, next(order), tree._tree_ref, 0.0, np.inf)]
+        while frontier:
+            tau = -best[0][0] if len(best) == k else np.inf
+            if frontier[0][0] > tau:
+                break
+            if self._exhausted(budget, deadline):
+                break
+            bound, _, ref, lo, hi = heapq.heappop(frontier)
+            node = tree._follow(ref)
+            if node is None:
+                continue
+            self.visits += 1
+            low, high = self._key_metrics(node.key)
+            if max(low - vpDistance, vpDistance - high) <= tau:
+                self._offer(best, k, tree._follow(node.value_ref), distance, lower_bound)
+            for child_ref, child_lo, child_hi in ((node.left_ref, lo, high), (node.right_ref, low, hi)):
+                #children set since the last commit have no address yet
+                if tree._follow(child_ref) is not None:
+                    child_bound = max(child_lo - vpDistance, vpDistance - child_hi, 0.0)
+                    heapq.heappush(frontier, (child_bound, next(order), child_ref, child_lo, child_hi))
+        return sorted((-d, row) for d, row in best)
+
+    def _nearest_sorted(self, vpDistance, distance, k, lower_bound, best, budget, deadline):
+        "nearest over the keys in order: bounds only grow going away from the query's key, either way"
+        center = vpDistance * vpDistance
+        below = float(np.nextafter(center, -np.inf))
+        sides = [self._tree.range(center, None), self._tree.range(None, below, reverse=True)]
+        heads = [next(side, None) for side in sides]
+        while heads[0] is not None or heads[1] is not None:
+            bounds = [np.inf if head is None else self._key_bound(head[0], vpDistance) for head in heads]
+            side = 0 if bounds[0] <= bounds[1] else 1
+            tau = -best[0][0] if len(best) == k else np.inf
+            if bounds[side] > tau or self._exhausted(budget, deadline):
+                break
+            self.visits += 1
+            self._offer(best, k, heads[side][1], distance, lower_bound)
+            heads[side] = next(sides[side], None)
+        return sorted((-d, row) for d, row in best)
+
+    def _key_metrics(self, key):
+        "least and greatest kcorr_metric distance to the VP of the TS at a key, keys being off by up to KEY_ERROR"
+        #kcorr_metric of a single key, without the overhead of numpy
+        return math.sqrt(max(key - self.KEY_ERROR, 0.0)), math.sqrt(max(key + self.KEY_ERROR, 0.0))
+
+    def _key_bound(self, key, vpDistance):
+        "lower bound on the distance from the query to the TS at a key"
+        low, high = self._key_metrics(key)
+        return max(low - vpDistance, vpDistance - high, 0.0)
+
+    def _exhausted(self, budget, deadline):
+        "whether an approximate search has spent its budget or its time, which leaves it incomplete"
+        if (budget is not None and self.cost >= budget) or (deadline is not None and time.time() >= deadline):
+            self.complete = False
+        return not self.complete
+
+    def _offer(self, best, k, row, distance, lower_bounds):
+        "compute the distance to the TS in row, unless a lower bound rules it out, and keep it if among the k best"
+        tau = -best[0][0] if len(best) == k else np.inf
+        for i, lower_bound in enumerate(lower_bounds):
+            if lower_bound(row) > tau:
+                self.pruned[i] += 1
+                return
+        self.cost += 1
+        d = distance(row)
+        if len(best) < k:
+            heapq.heappush(best, (-d, row))
+        elif d < tau:
+            heapq.heapreplace(best, (-d, row))
         
 
     def populate_VPDistTree(self, n, folderPath):
@@ -424,22 +1951,569 @@ class VantagePointDB(DBDB):
         vantagePoint = ts.ArrayTimeSeries(np.load(self.VPTSfile))
         stdVP =  stand(vantagePoint, vantagePoint.mean(), vantagePoint.std())
         # load each of the n timeseries
+        pairs = []
         for i in range(n):
             tsFileName = str(folderPath) + '/' + 'ts_' +str(i + 1)+'.npy'
             TS = ts.ArrayTimeSeries(np.load(tsFileName))
             # standardize TS
             stdts = stand(TS, TS.mean(), TS.std())
             distance = kcorr_dist(kernel_corr(stdts, stdVP))
-            self.set(distance, tsFileName)
-        self.commit()
+            pairs.append((distance, tsFileName))
+        # write the whole tree in one sorted pass and commit it
+        self.bulk_load(pairs)
+        self.close()
+
+    def populate_from_store(self, store):
+        # same as populate_VPDistTree, reading the series from a SeriesStore.
+        # values are the rows of the series in the store rather than their file names.
+        # distances use the spectra and self-kernels saved in the store, all computed in one batch
+        distances = store.distances(store.row(self.VPTSfile))
+        self.bulk_load(zip(distances.tolist(), range(len(store))))
         self.close()
+
+# TS compared with all the VPs at once when the forest is built
+BUILD_CHUNK = 256
+
+# where the vantage point tree over the series store is kept
+VPTREE_FILE = 'VPTree.dbdb'
+
+class VPTreeLeaf(object):
+    "leaf of a vantage point tree: a bucket of series store rows"
+    def __init__(self, rows):
+        self.rows = rows
+
+    def store_refs(self, storage):
+        pass
+
+class VPTreeNode(object):
+    """internal node of a vantage point tree: the row of its vantage point and, for the series
+    closer to it than the median (inside) and for the others (outside), the lowest and highest
+    distance to it and the ref of their subtree. A removed vantage point still splits the series
+    below it, but is no longer one of them"""
+    def __init__(self, vp_row, inside_bounds, inside_ref, outside_bounds, outside_ref, removed=False):
+        self.vp_row = vp_row
+        self.inside_bounds = inside_bounds
+        self.inside_ref = inside_ref
+        self.outside_bounds = outside_bounds
+        self.outside_ref = outside_ref
+        self.removed = removed
+
+    def with_child(self, inside, bounds, ref):
+        "copy of the node with the bounds and ref of one of its subtrees replaced"
+        if inside:
+            return VPTreeNode(self.vp_row, bounds, ref, self.outside_bounds, self.outside_ref, self.removed)
+        return VPTreeNode(self.vp_row, self.inside_bounds, self.inside_ref, bounds, ref, self.removed)
+
+    def store_refs(self, storage):
+        "store the subtrees first so that their addresses are known"
+        self.inside_ref.store(storage)
+        self.outside_ref.store(storage)
+
+class VPTreeNodeRef(BinaryNodeRef):
+    "reference to a vantage point tree node on disk"
+    LEAF = 0
+    INTERNAL = 1
+    #the count of the header of an internal node tells whether its vantage point was removed
+    HEADER_FORMAT = "!BH"
+    HEADER_LENGTH = struct.calcsize(HEADER_FORMAT)
+    #vantage point row, inside and outside bounds, inside and outside addresses
+    NODE_FORMAT = "!qddddQQ"
+    #nodes have a single encoding, whatever the superblock says
+    get = ValueRef.get
+    store = ValueRef.store
+
+    @staticmethod
+    def referent_to_bytes(referent):
+        "pack a node as a header followed by its fixed width fields, or a leaf by its rows"
+        ref = VPTreeNodeRef
+        if isinstance(referent, VPTreeLeaf):
+            n = len(referent.rows)
+            return struct.pack(ref.HEADER_FORMAT, ref.LEAF, n) + struct.pack("!%dq" % n, *referent.rows)
+        return struct.pack(ref.HEADER_FORMAT, ref.INTERNAL, int(referent.removed)) + struct.pack(ref.NODE_FORMAT,
+            referent.vp_row,
+            referent.inside_bounds[0], referent.inside_bounds[1],
+            referent.outside_bounds[0], referent.outside_bounds[1],
+            referent.inside_ref.address,
+            referent.outside_ref.address,
+        )
+
+    @staticmethod
+    def bytes_to_referent(data):
+        "unpack a node written by referent_to_bytes"
+        ref = VPTreeNodeRef
+        kind, n = struct.unpack_from(ref.HEADER_FORMAT, data)
+        if kind == ref.LEAF:
+            return VPTreeLeaf(list(struct.unpack_from("!%dq" % n, data, ref.HEADER_LENGTH)))
+        (vp_row, inside_lo, inside_hi, outside_lo, outside_hi,
+         inside, outside) = struct.unpack_from(ref.NODE_FORMAT, data, ref.HEADER_LENGTH)
+        return VPTreeNode(vp_row, (inside_lo, inside_hi), VPTreeNodeRef(address=inside),
+                          (outside_lo, outside_hi), VPTreeNodeRef(address=outside), bool(n))
+
+class VPTree(BinaryTree):
+    """Immutable vantage point tree over the rows of a SeriesStore.
+
+    Each node picks one of its series as vantage point and splits the others at the median of
+    their distance to it; subtrees of at most LEAF_SIZE series are kept as leaves. Distances are
+    kcorr_metric distances, which obey the triangle inequality: a subtree whose series are all
+    between lo and hi from a vantage point at d from the query holds none closer than
+    max(lo - d, d - hi), and is skipped when that is already farther than the k-th best.
+
+    Series are inserted and removed along a copied path, as in the binary tree: an inserted series goes
+    down the side of each node its distance falls in (or nearest to), widening its bounds, into a leaf,
+    and a leaf that grows past LEAF_SIZE is built into a subtree. Bounds are not narrowed by removals,
+    they still hold every series below them.
+    """
+    LEAF_SIZE = 8
+    #distances to a vantage point are computed again to find a series to remove, within this tolerance
+    DISTANCE_TOLERANCE = 1e-9
+
+    def _refresh_tree_ref(self):
+        "get reference to new tree if it has changed"
+        self._tree_ref = VPTreeNodeRef(
+            address=self._storage.get_root_address())
+
+    @property
+    def cost(self):
+        "number of distances computed by the last search from this thread"
+        return getattr(self._snapshot, 'cost', 0)
+
+    def build(self, store, rows=None, seed=None):
+        """replace the tree with one over the given rows of store (all by default) and commit.
+        vantage points are drawn at random, reproducibly for a given seed"""
+        if self._storage.lock():
+            self._refresh_tree_ref()
+        rows = np.arange(len(store)) if rows is None else np.asarray(rows, dtype=np.int64)
+        self._tree_ref = self._build(store, rows, np.random.RandomState(seed))
+        self.commit()
+
+    def _build(self, store, rows, random):
+        "write the subtree over rows, children first, returning its ref"
+        if len(rows) == 0:
+            return VPTreeNodeRef()
+        if len(rows) <= self.LEAF_SIZE:
+            node = VPTreeLeaf([int(row) for row in rows])
+        else:
+            pick = random.randint(len(rows))
+            vp_row = rows[pick]
+            rows = np.delete(rows, pick)
+            distances = self._distances(store, store.spectrum(vp_row), store.self_kernel(vp_row), rows)
+            half = len(rows) // 2
+            order = np.argpartition(distances, half)
+            inside, outside = order[:half], order[half:]
+            node = VPTreeNode(
+                int(vp_row),
+                (distances[inside].min(), distances[inside].max()),
+                self._build(store, rows[inside], random),
+                (distances[outside].min(), distances[outside].max()),
+                self._build(store, rows[outside], random))
+        node_ref = VPTreeNodeRef(referent=node)
+        node_ref.store(self._storage)
+        #only keep the address so that memory stays O(log n)
+        return VPTreeNodeRef(address=node_ref.address)
+
+    def insert(self, store, row):
+        "insert the series in a row of store in the tree, along a new path"
+        if self._storage.lock():
+            self._refresh_tree_ref()
+        self._tree_ref = self._insert(self._follow(self._tree_ref), store, row)
+
+    def _insert(self, node, store, row):
+        "copy of the subtree of node with row inserted, returning its ref"
+        if node is None:
+            return VPTreeNodeRef(referent=VPTreeLeaf([row]))
+        if isinstance(node, VPTreeLeaf):
+            rows = node.rows + [row]
+            if len(rows) <= self.LEAF_SIZE:
+                return VPTreeNodeRef(referent=VPTreeLeaf(rows))
+            return self._build(store, np.array(rows, dtype=np.int64), np.random.RandomState(row))
+        d = self._vp_distance(store, node.vp_row, row)
+        inside_hi, outside_lo = node.inside_bounds[1], node.outside_bounds[0]
+        inside = d <= inside_hi or (d < outside_lo and d - inside_hi <= outside_lo - d)
+        lo, hi = node.inside_bounds if inside else node.outside_bounds
+        child_ref = node.inside_ref if inside else node.outside_ref
+        return VPTreeNodeRef(referent=node.with_child(
+            inside, (min(lo, d), max(hi, d)), self._insert(self._follow(child_ref), store, row)))
+
+    def remove(self, store, row):
+        "remove the series in a row of store from the tree, along a new path. raises KeyError if it is not in it"
+        if self._storage.lock():
+            self._refresh_tree_ref()
+        ref = self._remove(self._follow(self._tree_ref), store, row)
+        if ref is None:
+            raise KeyError(row)
+        self._tree_ref = ref
+
+    def _remove(self, node, store, row):
+        "copy of the subtree of node without row, returning its ref, or None if row is not in it"
+        if node is None:
+            return None
+        if isinstance(node, VPTreeLeaf):
+            if row not in node.rows:
+                return None
+            return VPTreeNodeRef(referent=VPTreeLeaf([other for other in node.rows if other != row]))
+        if node.vp_row == row:
+            if node.removed:
+                return None
+            return VPTreeNodeRef(referent=VPTreeNode(node.vp_row, node.inside_bounds, node.inside_ref,
+                                                     node.outside_bounds, node.outside_ref, True))
+        d = self._vp_distance(store, node.vp_row, row)
+        for inside, (lo, hi), child_ref in ((True, node.inside_bounds, node.inside_ref),
+                                            (False, node.outside_bounds, node.outside_ref)):
+            if lo - self.DISTANCE_TOLERANCE <= d <= hi + self.DISTANCE_TOLERANCE:
+                ref = self._remove(self._follow(child_ref), store, row)
+                if ref is not None:
+                    return VPTreeNodeRef(referent=node.with_child(inside, (lo, hi), ref))
+        return None
+
+    def _vp_distance(self, store, vp_row, row):
+        "distance from a vantage point to the series in a row, computed as when the tree was built"
+        return self._distances(store, store.spectrum(vp_row), store.self_kernel(vp_row), [row])[0]
+
+    def _distances(self, store, fourier, kernel, rows):
+        "kcorr_metric distances from a series, given its spectral_features, to the series in rows"
+        distances, _ = kernel_dist_spectra_many(fourier, kernel, store.spectrum(rows),
+                                                store.self_kernel(rows), store.values.shape[1])
+        return kcorr_metric(distances)
+
+    def nearest(self, store, fourier, kernel, k=1, radius=None):
+        """the (distance, row) pairs of the k series of store nearest to a query, nearest first,
+        given the spectral_features of the standardized query. with a radius, only the series
+        within it are returned; with k=None, all of them"""
+        if not self._storage.locked:
+            self._refresh_tree_ref()
+        self._snapshot.cost = 0
+        #max-heap of the best pairs so far, as (-distance, row)
+        best = []
+        if k is not None and k < 1:
+            return best
+        bound = np.inf if radius is None else radius
+        self._search(self._tree_ref, store, fourier, kernel, k, bound, best)
+        return sorted((-distance, row) for distance, row in best)
+
+    def _search(self, ref, store, fourier, kernel, k, bound, best):
+        "add the series of the subtree at ref that beat the current k-th best to best"
+        node = self._follow(ref)
+        if node is None:
+            return
+        rows = node.rows if isinstance(node, VPTreeLeaf) else [node.vp_row]
+        if not rows:
+            #a leaf whose series were all removed
+            return
+        distances = self._distances(store, fourier, kernel, rows)
+        self._snapshot.cost += len(rows)
+        for distance, row in zip(distances.tolist(), rows):
+            if isinstance(node, VPTreeNode) and node.removed:
+                continue
+            if distance <= self._tau(k, bound, best):
+                heapq.heappush(best, (-distance, row))
+                if k is not None and len(best) > k:
+                    heapq.heappop(best)
+        if isinstance(node, VPTreeLeaf):
+            return
+        d = distances[0]
+        children = [(node.inside_bounds, node.inside_ref), (node.outside_bounds, node.outside_ref)]
+        #the side the query falls on is the likeliest to hold its neighbours
+        if d > (node.inside_bounds[1] + node.outside_bounds[0]) / 2:
+            children.reverse()
+        for (lo, hi), child_ref in children:
+            if max(lo - d, d - hi) <= self._tau(k, bound, best):
+                self._search(child_ref, store, fourier, kernel, k, bound, best)
+
+    @staticmethod
+    def _tau(k, bound, best):
+        "distance a series must be within to enter the results"
+        if k is not None and len(best) == k:
+            return min(bound, -best[0][0])
+        return bound
+
+    def compact_into(self, storage):
+        "copy the committed tree into an empty storage and commit it there, children first"
+        self._refresh_tree_ref()
+        storage.commit_root_address(self._copy_into(self._tree_ref, storage).address)
+
+    def _copy_into(self, ref, storage):
+        "write the subtree at ref into storage, returning its new ref"
+        node = self._follow(ref)
+        if node is None:
+            return VPTreeNodeRef()
+        if isinstance(node, VPTreeNode):
+            node = VPTreeNode(node.vp_row, node.inside_bounds, self._copy_into(node.inside_ref, storage),
+                              node.outside_bounds, self._copy_into(node.outside_ref, storage), node.removed)
+        return VPTreeNodeRef(address=storage.write(VPTreeNodeRef.referent_to_bytes(node)))
+
+class VPTreeDB(DBDB):
+    """DBDB holding a vantage point tree over the rows of a SeriesStore.
+
+    build, insert, remove and nearest replace get/set/delete, and the binary tree navigation helpers do not apply.
+    """
+    def __init__(self, f, **options):
+        self._storage = Storage(f, **options)
+        self._tree = VPTree(self._storage)
+
+    @property
+    def cost(self):
+        "number of distances computed by the last search from this thread"
+        return self._tree.cost
+
+    def build(self, store, rows=None, seed=None):
+        "replace the tree with one over the rows of store (all by default) and commit"
+        self._assert_not_closed()
+        return self._tree.build(store, rows, seed)
+
+    def insert(self, store, row):
+        "insert the series in a row of store, see VPTree.insert"
+        self._assert_not_closed()
+        return self._tree.insert(store, row)
+
+    def remove(self, store, row):
+        "remove the series in a row of store, see VPTree.remove"
+        self._assert_not_closed()
+        return self._tree.remove(store, row)
+
+    def nearest(self, store, fourier, kernel, k=1, radius=None):
+        "the (distance, row) pairs of the k series of store nearest to a query, see VPTree.nearest"
+        self._assert_not_closed()
+        return self._tree.nearest(store, fourier, kernel, k, radius)
+
+def openSeriesStore(n = 1000, folderPath = '.'):
+    """open the series store the forest indexes, packing it from the n timeseries files if there is none.
+    raises ValueError if the store holds another number of series, e.g. once a VPForest added some"""
+    if not os.path.exists(DEFAULT_STORE + '.npy'):
+        return SeriesStore.from_files(
+            DEFAULT_STORE, [str(folderPath) + '/ts_' + str(i + 1) + '.npy' for i in range(n)])
+    store = SeriesStore(DEFAULT_STORE)
+    if len(store) != n:
+        raise ValueError('The series store holds %d series, not %d: remove it to pack the timeseries files again'
+                         % (len(store), n))
+    return store
         
-# require VPDict created from before which contains a dictionary of {number: (ts, name of .dbdb)}
-# function creates k vantage point databases
+def buildVPTree(store, VPTreefilename = VPTREE_FILE, seed = None, rows = None):
+    """build the vantage point tree over the rows of store (all by default) and return its root address.
+    the tree is written after those already in the file, so readers of their roots keep reading them"""
+    fd = os.open(VPTreefilename, os.O_RDWR | os.O_CREAT)
+    vptree = VPTreeDB(os.fdopen(fd, 'r+b'))
+    vptree.build(store, rows, seed)
+    root = vptree._storage.get_root_address()
+    vptree.close()
+    return root
+
+def openVPTree(VPTreefilename = VPTREE_FILE, root_address = None, **options):
+    """open the vantage point tree database read-only, at root_address (e.g. recorded in an IndexManifest)
+    or at its last commit. options are passed on to Storage, e.g. a cache"""
+    return VPTreeDB(open(VPTreefilename, 'rb'), mapped=True, root_address=root_address, **options)
+
+def forestDistances(store, VProws, report = False):
+    """kcorr_dist distances from every TS of store to each of the VPs in VProws, as a N x k matrix.
+    the store is streamed once, BUILD_CHUNK TS at a time, each chunk compared with all the VPs in one call"""
+    VProws = list(VProws)
+    VPspectra, VPkernels = store.spectrum(VProws), store.self_kernel(VProws)
+    length = store.values.shape[1]
+    distances = np.empty((len(store), len(VProws)))
+    started = time.time()
+    for start in range(0, len(store), BUILD_CHUNK):
+        rows = slice(start, start + BUILD_CHUNK)
+        distances[rows] = kernel_dist_spectra_matrix(store.spectrum(rows), store.self_kernel(rows),
+                                                     VPspectra, VPkernels, length)
+        if report:
+            reportProgress('Distances', min(start + BUILD_CHUNK, len(store)), len(store), 'series', started)
+    return distances
+
+def reportProgress(stage, done, total, unit, started):
+    "print how far a stage of the build is and its throughput since it started"
+    elapsed = max(time.time() - started, 1e-9)
+    print ("%s: %d/%d %s, %.0f %s/s" % (stage, done, total, unit, done / elapsed, unit))
+
+def uniqueKeys(distances):
+    """keys for the TS at distances from a VP, in the same order: their distances, where a TS as far from the VP
+    as another one is moved to the next float above it, as add_series does, since each key holds a single TS"""
+    keys = np.array(distances, dtype=np.float64)
+    order = np.argsort(keys, kind='mergesort')
+    for previous, row in zip(order[:-1].tolist(), order[1:].tolist()):
+        if keys[row] <= keys[previous]:
+            keys[row] = np.nextafter(keys[previous], np.inf)
+    return keys
+
+def _writeVPDB(task):
+    "write the tree of one VP from its column of distances, in a process of the build pool, and return its root"
+    index, VPDBfilename, VPTSfilename, distances, options = task
+    vpdb = VantagePointDB(VPDBfilename, VPTSfilename, **options)
+    vpdb.bulk_load(zip(uniqueKeys(distances).tolist(), range(len(distances))))
+    root = vpdb._storage.get_root_address()
+    vpdb.close()
+    return index, root
+
+# select k vantage points, compute the distances from every TS to all of them in a single pass over the store,
+# then write their databases (in a pool of processes) and the pivot table, and write the manifest
+# that describes them last, so that queries never see a forest that is not complete.
+# the series are read from the SeriesStore under DEFAULT_STORE (see openSeriesStore). with report = True the
+# progress of each stage is printed; running this file builds the forest with one process per core and reports.
+# lsm = True or bplus = True create the VP databases log-structured or as B+trees
             
-def createVPForest(k = 20):
-    for i in range(k):
-        vpdb = VantagePointDB("./" + VPDict[i+1][1] , "./" + VPDict[i+1][0])
-        vpdb.populate_VPDistTree(1000, '.')
+def createVPForest(k = 20, seed = None, n = 1000, folderPath = '.', manifestFileName = DEFAULT_MANIFEST,
+                   processes = 1, report = False, lsm = False, bplus = False):
+    # a forest built over a previous one is its next generation. the series a VPForest removed from that one
+    # are still in the store, and would be indexed again
+    generation = 0
+    if os.path.exists(manifestFileName):
+        previous = IndexManifest.load(manifestFileName)
+        if previous.removed:
+            raise ValueError('Series were removed from the forest: remove the series store to pack the '
+                             'timeseries files again')
+        generation = previous.generation + 1
+    store = openSeriesStore(n, folderPath)
+    # dictionary that contains info on the TS chosen as vantage points: {number: (ts, name of .dbdb)}
+    VPDict = selectVPs(k, seed, len(store))
+    VProws = [store.row("./" + VPDict[i+1][0]) for i in range(k)]
+    distances = forestDistances(store, VProws, report)
+    # one tree writer per VP, each handed its column of (distance, row) pairs
+    options = {'lsm': lsm, 'bplus': bplus}
+    tasks = ((i, "./" + VPDict[i+1][1], "./" + VPDict[i+1][0], distances[:, i], options) for i in range(k))
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+        written = pool.imap_unordered(_writeVPDB, tasks)
+    else:
+        pool = None
+        written = map(_writeVPDB, tasks)
+    started = time.time()
+    roots = [None] * k
+    try:
+        for done, (index, root) in enumerate(written, 1):
+            roots[index] = root
+            if report:
+                reportProgress('Trees', done, k, 'trees', started)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    # the distances from every TS to all the VPs, one column per VP in the order of VPDict
+    PivotTable.create(DEFAULT_PIVOT_TABLE, store, VProws, kcorr_metric(distances))
+    # the tree over all the TS, built here rather than by the queries
+    VPTreeRoot = buildVPTree(store, VPTREE_FILE, seed)
+    manifest = IndexManifest([(VPDict[i+1][0], VProws[i], VPDict[i+1][1]) for i in range(k)],
+                             len(store), store.values.shape[1], DEFAULT_STORE, DEFAULT_PIVOT_TABLE, seed=seed,
+                             roots=roots, generation=generation, vpTree=VPTREE_FILE, vpTreeRoot=VPTreeRoot)
+    manifest.save(manifestFileName)
+    return manifest
+
+class VPForest(object):
+    """The VP forest described by a manifest, open to add and remove series while queries run.
+
+    A new series is compared with all the VPs in one call; it is appended to the series store and the
+    pivot table and inserted in every VP database, under its distance to that VP, and in the VP tree.
+    A removed series is deleted from every VP database and the VP tree, its row staying in the store and
+    pivot table, unused. Changes are published by commit, which commits each database and then saves a new
+    manifest with the root of every database and of the tree, and the number of series: queries load a manifest and read the databases at its roots and
+    only its first rows of the store and pivot table, so they see the forest of one commit at a time and
+    never half of a change. There must be a single VPForest writing to a forest at a time. Log-structured
+    VP databases merge their runs in the background as series come in.
+    """
+    # keys are kcorr_dist distances and the pivot table holds their square roots: a key is looked up
+    # from the pivot table within this tolerance, and identified by its value
+    KEY_TOLERANCE = 1e-9
+
+    def __init__(self, manifestFileName = DEFAULT_MANIFEST):
+        self.manifestFileName = manifestFileName
+        self.manifest = IndexManifest.load(manifestFileName)
+        # rows written after the last commit of the manifest, if any, are written over
+        self.store = SeriesStore(self.manifest.store, self.manifest.seriesCount)
+        self.pivotTable = PivotTable(self.manifest.pivotTable, self.manifest.seriesCount)
+        roots = self.manifest.roots or [None] * len(self.manifest.vantagePoints)
+        self.VPDBs = [VantagePointDB(db, name, buffered=True, root_address=root, background_merge=True)
+                      for (name, row, db), root in zip(self.manifest.vantagePoints, roots)]
+        # the tree over all the series is changed along with the databases
+        self.VPTree = None
+        if self.manifest.vpTree is not None:
+            self.VPTree = VPTreeDB(open(self.manifest.vpTree, 'r+b'), buffered=True,
+                                   root_address=self.manifest.vpTreeRoot)
+        self.removed = set(self.manifest.removed)
+
+    def close(self):
+        "drop the uncommitted changes to the databases and close them"
+        for vpdb in self.VPDBs:
+            vpdb.close()
+        if self.VPTree is not None:
+            self.VPTree.close()
+
+    def _liveRow(self, id):
+        "row of the series named id, raises KeyError if it is not in the forest"
+        row = self.store.row(id)
+        if row in self.removed:
+            raise KeyError(id)
+        return row
+
+    def add_series(self, id, values, commit = True):
+        "add the series named id, with those values, to the forest and return its row"
+        try:
+            self._liveRow(id)
+        except KeyError:
+            pass
+        else:
+            raise ValueError('Series %r is already in the forest' % (id,))
+        row = self.store.append([id], [values])[0]
+        VProws = self.manifest.VProws
+        distances, _ = kernel_dist_spectra_many(self.store.spectrum(row), self.store.self_kernel(row),
+                                                self.store.spectrum(VProws), self.store.self_kernel(VProws),
+                                                self.manifest.length)
+        self.pivotTable.append(kcorr_metric(distances))
+        for vpdb, distance in zip(self.VPDBs, distances.tolist()):
+            # keys are unique, a series as far from the VP as another one goes right next to it
+            while True:
+                try:
+                    vpdb.get(distance)
+                except KeyError:
+                    break
+                distance = float(np.nextafter(distance, np.inf))
+            vpdb.set(distance, row)
+        if self.VPTree is not None:
+            self.VPTree.insert(self.store, row)
+        if commit:
+            self.commit()
+        return row
+
+    def remove_series(self, id, commit = True):
+        """remove the series named id from the forest, raises KeyError if it is not in it, and ValueError,
+        changing nothing, if a VP database has no entry for it"""
+        row = self._liveRow(id)
+        # the key of the series in every database is found before any is changed
+        keys = []
+        for vpdb, metric in zip(self.VPDBs, self.pivotTable.distances[row].tolist()):
+            key = metric * metric
+            found = [nodeKey for nodeKey, value in vpdb.range(key - self.KEY_TOLERANCE, key + self.KEY_TOLERANCE)
+                     if value == row]
+            if not found:
+                raise ValueError('Series %r is not in %s under its distance to the VP' % (id, vpdb.VPDBfile))
+            keys.append(found[0])
+        for vpdb, key in zip(self.VPDBs, keys):
+            vpdb.delete(key)
+        if self.VPTree is not None:
+            self.VPTree.remove(self.store, row)
+        self.removed.add(row)
+        if commit:
+            self.commit()
+
+    def compact(self):
+        """commit, rewrite every database and the VP tree with only their committed trees, and publish their
+        new roots in a new manifest, returning the bytes reclaimed. The roots of the previous manifests are
+        no longer in the files: queries must load the new manifest (see mostSimilarTS.loadIndex)"""
+        reclaimed = sum(DBDB.compact(vpdb, vpdb.VPDBfile) for vpdb in self.VPDBs)
+        if self.VPTree is not None:
+            reclaimed += self.VPTree.compact(self.manifest.vpTree)
+        self.commit()
+        return reclaimed
+
+    def commit(self):
+        "publish the changes made since the last commit to the readers of the manifest"
+        for vpdb in self.VPDBs:
+            vpdb.commit()
+        VPTreeRoot = None
+        if self.VPTree is not None:
+            self.VPTree.commit()
+            VPTreeRoot = self.VPTree._storage.get_root_address()
+        previous = self.manifest
+        self.manifest = IndexManifest(previous.vantagePoints, len(self.store), previous.length, previous.store,
+                                      previous.pivotTable, previous.mult, previous.metric, previous.seed,
+                                      [vpdb._storage.get_root_address() for vpdb in self.VPDBs],
+                                      self.removed, previous.generation + 1, previous.vpTree, VPTreeRoot)
+        self.manifest.save(self.manifestFileName)
 
-createVPForest()
+if __name__ == "__main__":
+    createVPForest(processes = multiprocessing.cpu_count(), report = True)
@@ -2,14 +2,22 @@
  Purpose: to generate (using tsmaker) a set of 1000 time series, each stored in a file
  Function expects input of n which is the number of timeseries to be generated, with the default of 1000.
  Output is n timeseries saved in the format of 'ts_1.npy' ... to 'ts_1000.npy' in the current working directory
+ The same timeseries are also packed into the SeriesStore the VP forest reads ('series.npy' and 'series_names.npy'),
+ named './ts_1.npy' ... './ts_1000.npy'
 
 """
 from TimeSeriesDistance import tsmaker
+from SeriesStore import SeriesStore, DEFAULT_STORE
 import numpy as np
 def generateAndStoreTimeSeries(n = 1000):
+    names = []
+    values = []
     for i in range(n):
         fileName = 'ts_'+str(i+1)+'.npy'
         timeSeries = tsmaker(0.5, 0.1, 0.01)
         np.save(fileName, timeSeries)
+        names.append('./' + fileName)
+        values.append(timeSeries.values())
+    SeriesStore.create(DEFAULT_STORE, names, values)
 
 generateAndStoreTimeSeries()
\ No newline at end of file
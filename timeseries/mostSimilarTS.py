@@ -6,80 +6,278 @@ mostSimilarTS(inputFileName, howmany = 1)
 
 Preconditions:
 --------------
-- VPDict should have been executed in buildVPDBforest and the same VPDict is used
-- The same VPDict should be used because it contains k key-value pairs that contain information about the TS selected as VP
+- The forest should have been built by createVPForest in buildVPDBforest (e.g. by running buildVPDBforest.py), which saves
+  the IndexManifest of the forest. Importing this module builds nothing: the manifest is loaded by loadIndex on the first
+  query, with the series store and pivot table it names, so the VPs used are the ones the databases were built for
+- loadIndex(manifestFileName = DEFAULT_MANIFEST, coefficients = 0) can also be called beforehand to load the index
+  from another manifest, or to keep that many DFT coefficients per TS for the filter (e.g. DEFAULT_COEFFICIENTS)
 - target TS should be named in the format: 'ts_1.npy' ... to 'ts_1000.npy' 
+- the VP database is opened read-only and read through a memory map, at the root recorded in the manifest. Series
+  added to or removed from the forest by a VPForest are seen once loadIndex loads the manifest they were committed in;
+  until then the queries keep seeing the forest of the manifest they loaded, all of it
+- the VP and candidate TS are read from the module level seriesStore (see SeriesStore) by their row,
+  rather than each from its own file. Their spectra and self-kernels are saved in the store, so a
+  query costs one FFT for the target TS and one inverse FFT per VP and per candidate, all the VPs
+  and then all the candidates being transformed in one batch (see kernel_dist_spectra_many)
+- the result is exact. The tree of the nearest VP is searched best first (see VantagePointDB.nearest): the
+  search radius shrinks to the distance of the howmany-th best TS found so far, and the search stops as soon
+  as no subtree left can hold a closer TS, so few nodes are read when howmany is small
+- the distances from the target TS to all the VPs bound its distance to every TS through the module level
+  pivotTable (see PivotTable), saved with the forest. Only the TS whose bound beats the howmany-th best
+  found so far are compared with the target TS
+- when loadIndex is asked for DFT coefficients, the TS that pass the pivot bound go through the module level
+  dftFilter (see DFTFilter) next: from the first few DFT coefficients of the target TS and of the TS, kept in memory,
+  it bounds their distance again without any FFT. dftFilter.tested, dftFilter.passed and dftFilter.selectivity count
+  the TS it was tried on and those it let through to the exact distance, and are printed after each query, so that
+  the number of coefficients can be tuned. The filter is off by default: on TS such as those of generateAndStoreTS,
+  kernel distances with multiplier 1 are all within about 1e-3 of each other, closer than any bound from a few
+  coefficients can tell apart, and every TS passes it
+- tree nodes read by a query are kept in the module level nodeCache (see buildVPDBforest.NodeCache);
+  nodeCache.hits and nodeCache.misses tell how well it is sized
 
 Example input and output: 
 -------------------------
 >>> mostSimilarTS.mostSimilarTS('./ts_100.npy', 10)
-Nodes in search region =  561
+Nodes visited =  877 , distances computed =  46
 ['./ts_100.npy', './ts_586.npy', './ts_106.npy', './ts_283.npy', './ts_478.npy', './ts_702.npy', './ts_248.npy', './ts_439.npy', './ts_800.npy', './ts_274.npy']
 
+mostSimilarTS_batch(inputFileNames, howmany = 1)
+-------------
+- Expects a list of input file names and howmany
+- Returns a list with, for each input file in order, the same list of filenames mostSimilarTS would return
+- The distances from all the target TS to all the VPs are computed as one matrix (see DistanceMatrix).
+  The targets nearest to the same VP are searched through a single opening of its database, and a TS
+  needed by one of them is compared with all of them in one batch, its distances and bounds being kept
+  for the others. mostSimilarTS is a batch of one
+
+mostSimilarTS_approx(inputFileName, howmany = 1, budget = None, timeLimit = None)
+-------------
+- Same inputs as mostSimilarTS, with a budget of exact distances and/or a time limit in seconds for the search
+- Returns the filenames of the most similar TS found within the budget, and an estimated recall: the fraction of the
+  howmany nearest TS that are found for sure, given the exact distances computed and the pivot (and DFT) bounds
+  of all the others. It is a lower bound, and 1.0 when the search ended before its budget, the result being exact
+- The nodes are visited best first as in mostSimilarTS, so the TS most likely to be near are compared first, and
+  the search returns the best found so far once it has computed budget distances or run for timeLimit seconds.
+  mostSimilarTS_approx_batch(inputFileNames, howmany = 1, budget = None, timeLimit = None) returns a (filenames,
+  estimated recall) pair for each input file, searched as mostSimilarTS_batch does
+
+measureRecall(inputFileNames, howmany = 1, budgets = DEFAULT_BUDGETS, timeLimits = ())
+-------------
+- Runs the exact search, then the approximate one with each budget and each time limit, over the input files
+- Returns a list of (budget, timeLimit, recall, estimated recall, seconds per query), the exact search first,
+  the recall being the mean fraction of the exact result the approximate one found
+
+mostSimilarTS_tree(inputFileName, howmany = 1)
+-------------
+- Same inputs and output as mostSimilarTS, searching the vantage point tree over the series store
+  (see buildVPDBforest.VPTreeDB) instead of the forest. The result is exact as well: only the subtrees
+  the triangle inequality cannot rule out are read
+- The tree is built with the forest by createVPForest and read at the root recorded in the manifest, read-only
 
 """
 
+import time
 import numpy as np
 from selectVPs import selectVPs
 import ArrayTimeSeries as ts
-from TimeSeriesDistance import tsmaker, random_ts, stand, ccor, max_corr_at_phase, kernel_corr, kcorr_dist
+from TimeSeriesDistance import tsmaker, random_ts, stand, ccor, max_corr_at_phase
+from TimeSeriesDistance import spectral_features, spectral_features_many, kernel_dist_spectra_many, kcorr_metric
+from DistanceMatrix import distance_matrix
+from PivotTable import PivotTable
+from DFTFilter import DFTFilter
+from SeriesStore import SeriesStore
+from IndexManifest import IndexManifest, DEFAULT_MANIFEST
 import buildVPDBforest as VPDBforest
-from buildVPDBforest import VPDict as VPDict
+
+# decoded tree nodes and values, shared by the VP databases across queries
+nodeCache = VPDBforest.NodeCache()
+# the manifest of the forest, the packed series the VP databases point into by row
+# and the distances from every TS to all the VPs, saved with the forest. loaded on the first query
+manifest = None
+seriesStore = None
+pivotTable = None
+# the first DFT coefficients of every TS, computed from the store when the index is loaded with some
+dftFilter = None
+# exact distances per target allowed to the approximate searches that measureRecall compares by default
+DEFAULT_BUDGETS = (8, 16, 32, 64, 128)
+
+def loadIndex(manifestFileName = DEFAULT_MANIFEST, coefficients = 0):
+    """load the manifest saved by createVPForest, open the series store and pivot table it names
+    and keep the first coefficients of the DFT of each TS for the filter, if any"""
+    global manifest, seriesStore, pivotTable, dftFilter
+    indexManifest = IndexManifest.load(manifestFileName)
+    # the store and pivot table may already hold rows added after the manifest was saved
+    store = SeriesStore(indexManifest.store, indexManifest.seriesCount)
+    if len(store) != indexManifest.seriesCount:
+        raise ValueError('The series store holds %d series, the forest was built for %d'
+                         % (len(store), indexManifest.seriesCount))
+    pivotTable = PivotTable(indexManifest.pivotTable, indexManifest.seriesCount)
+    dftFilter = DFTFilter(store, coefficients, indexManifest.mult) if coefficients else None
+    seriesStore = store
+    manifest = indexManifest
+    return manifest
 
 def mostSimilarTS(inputFileName, howmany = 1):
-    # distance from target to each of the VPs
-    distance = []
-    # to store the database file name of VP (VPDBx.dbdb)
-    VPDBList = []
-    
-    inputTS = ts.ArrayTimeSeries(np.load(inputFileName))
-    inputstdTS =  stand(inputTS, inputTS.mean(), inputTS.std())
+    return mostSimilarTS_batch([inputFileName], howmany)[0]
+
+def mostSimilarTS_batch(inputFileNames, howmany = 1):
+    return _searchForest(inputFileNames, howmany)[0]
+
+def mostSimilarTS_approx(inputFileName, howmany = 1, budget = None, timeLimit = None):
+    names, recall = mostSimilarTS_approx_batch([inputFileName], howmany, budget, timeLimit)[0]
+    return names, recall
+
+def mostSimilarTS_approx_batch(inputFileNames, howmany = 1, budget = None, timeLimit = None):
+    return list(zip(*_searchForest(inputFileNames, howmany, budget, timeLimit)))
+
+def _searchForest(inputFileNames, howmany, budget = None, timeLimit = None):
+    "the names of the nearest TS of each target and the estimated recall of each search"
+    if len(inputFileNames) == 0:
+        return [], []
+    if manifest is None:
+        loadIndex()
+    # standardize all the target TS, one per row, and take the FFT of each; VPs and candidates have theirs in the store
+    inputstdTS = []
+    for inputFileName in inputFileNames:
+        inputTS = ts.ArrayTimeSeries(np.load(inputFileName))
+        inputstdTS.append(stand(inputTS, inputTS.mean(), inputTS.std()))
+    inputstdTS = np.array(inputstdTS)
+    inputFourier, inputK = spectral_features_many(inputstdTS)
+    length = inputstdTS.shape[1]
+    if dftFilter is not None:
+        inputFeatures = dftFilter.features(inputFourier)
+        tested = passed = 0
     
     # find most similar vantage point distance measure
+    # distance from every target to every VP, computed as one matrix
+    # and the database file name of each VP (VPDBx.dbdb)
+    VPDict = manifest.VPDict
+    VPDBList = [VPDict[i + 1][1] for i in range(len(VPDict))]
+    roots = manifest.roots or [None] * len(VPDBList)
+    VPdistance = kcorr_metric(distance_matrix(inputstdTS, seriesStore.std(manifest.VProws)))
+    bestdistIndex = np.argmin(VPdistance, axis=1)
     
-    for i in range(len(VPDict)):
-        vpTS = ts.ArrayTimeSeries(np.load(VPDict[i + 1][0]))
-        VPstdTS =  stand(vpTS, vpTS.mean(), vpTS.std())
-        VPDBList.append(VPDict[i + 1][1])
-        distance.append(kcorr_dist(kernel_corr(inputstdTS, VPstdTS)))
-    bestdist = min(distance)
-    bestdistIndex = np.argmin(distance)
-    bestVPDBfilename = VPDBList[bestdistIndex]
-    bestVPDB = VPDBforest.VantagePointDB(bestVPDBfilename, VPDict[bestdistIndex + 1][0] )
-    
-    # define the area to search for 
-    regionRadius = 2.0*bestdist
-    
-    #get the root level node
-    root = bestVPDB._tree._follow(bestVPDB._tree._tree_ref)
-    listofdistance = []
-    nodesinregion = []
-    # compare with the root node key first
-    nodesinregion.append(root)
+    # the distances to all the VPs bound the distance between a target TS and any TS through the
+    # module level pivotTable, which has one column per VP: the VP distances above are reused
+    pivotDistances = VPdistance
     
-    # this is a breadth first search that prunes right side subtree that are outside the search region
-    # each node within the region is examined. distance from the target TS is computed and stored in a list
-    
-    while nodesinregion:
-
-        node = nodesinregion[0]
-        if node is not None:
-            nodeKey = bestVPDB.getNodeKey(node)
-        # examine current node
-        if  node is not None and (nodeKey > regionRadius):
-            nodesinregion.append(bestVPDB.getLeftChildNode(node))
-        elif node is not None and (nodeKey <= regionRadius):
-            tsfilename = bestVPDB.get(nodeKey)
-            # obtain the TS for the node and compute the distance between the TS 
-            # at the node and the target TS
-            TS = ts.ArrayTimeSeries(np.load(tsfilename))
-            stdTS = stand(TS, TS.mean(), TS.std())
-            distance = kcorr_dist(kernel_corr(stdTS, inputstdTS))
+    results = [None] * len(inputFileNames)
+    recalls = [1.0] * len(inputFileNames)
+    visits = computed = 0
+    # with a budget or a time limit, each target computes only its own distances: shared with the group,
+    # every distance charged to one target would be computed for all of them, G * G * budget in a group of G
+    capped = budget is not None or timeLimit is not None
+    # the targets nearest to the same VP are searched together, through one opening of its database
+    for VPindex in np.unique(bestdistIndex):
+        group = np.flatnonzero(bestdistIndex == VPindex)
+        bestVPDB = VPDBforest.VantagePointDB(VPDBList[VPindex], VPDict[VPindex + 1][0],
+                                             cache=nodeCache, mapped=True, root_address=roots[VPindex])
+        # a TS needed by one target of the group is compared with all of them in one batch,
+        # and its bounds and distances are kept for the other targets
+        lowerBounds = {}
+        dftBounds = {}
+        exactDistances = {}
+        groupFeatures = None if dftFilter is None else tuple(feature[group] for feature in inputFeatures)
+        for position, query in enumerate(group):
+            queryDistances = {}
+            
+            def lowerBound(row):
+                if row not in lowerBounds:
+                    lowerBounds[row] = np.max(np.abs(pivotTable.distances[row] - pivotDistances[group]), axis=1)
+                return lowerBounds[row][position]
+            
+            def dftBound(row):
+                if row not in dftBounds:
+                    dftBounds[row] = dftFilter.lower_bounds(groupFeatures, inputK[group], [row])[:, 0]
+                return dftBounds[row][position]
             
-            listofdistance.append((distance, nodeKey))
-            nodesinregion.append(bestVPDB.getLeftChildNode(node))
-            nodesinregion.append(bestVPDB.getRightChildNode(node))
-        # remove examined node
-        nodesinregion.remove(node)
-    print ("Nodes in search region = ",  len(listofdistance))
-    return [bestVPDB.get(nodeKey) for (distance, nodeKey) in sorted(listofdistance)[0: howmany ]]
\ No newline at end of file
+            def exactDistance(row):
+                if capped:
+                    if row not in queryDistances:
+                        distance, _ = kernel_dist_spectra_many(seriesStore.spectrum(row), seriesStore.self_kernel(row),
+                                                               inputFourier[[query]], inputK[[query]], length)
+                        queryDistances[row] = kcorr_metric(distance)[0]
+                    return queryDistances[row]
+                if row not in exactDistances:
+                    # from the spectrum of the TS saved in the store
+                    distance, _ = kernel_dist_spectra_many(seriesStore.spectrum(row), seriesStore.self_kernel(row),
+                                                           inputFourier[group], inputK[group], length)
+                    exactDistances[row] = kcorr_metric(distance)
+                return exactDistances[row][position]
+            
+            # visit the nodes of the VP's tree best first. the search radius shrinks to the distance of the
+            # howmany-th best TS found so far, and subtrees entirely outside of it are never read
+            # the pivot bound first, then the DFT bound for the TS it could not rule out
+            bounds = [lowerBound] if dftFilter is None else [lowerBound, dftBound]
+            nearest = bestVPDB.nearest(float(VPdistance[query, VPindex]), exactDistance, howmany, bounds,
+                                       budget, timeLimit)
+            results[query] = [seriesStore.name(row) for (distance, row) in nearest]
+            if not bestVPDB.complete:
+                # what is known of the distance of every TS to the target: exact for those computed,
+                # a lower bound for the others
+                known = pivotTable.lower_bounds(pivotDistances[query])
+                known[manifest.removed] = np.inf
+                for row in dftBounds:
+                    known[row] = max(known[row], dftBounds[row][position])
+                for row in exactDistances:
+                    known[row] = exactDistances[row][position]
+                for row in queryDistances:
+                    known[row] = queryDistances[row]
+                known[[row for (distance, row) in nearest]] = np.inf
+                recalls[query] = _estimatedRecall(nearest, howmany, known)
+            visits += bestVPDB.visits
+            computed += len(queryDistances)
+            if dftFilter is not None:
+                tested += bestVPDB.cost + bestVPDB.pruned[1]
+                passed += bestVPDB.cost
+        computed += len(exactDistances) * len(group)
+        bestVPDB.close()
+    print ("Nodes visited = ", visits, ", distances computed = ", computed)
+    if dftFilter is not None:
+        dftFilter.record(tested, passed)
+        print ("DFT filter: tested = ", tested, ", passed = ", passed)
+    if budget is not None or timeLimit is not None:
+        print ("Estimated recall = ", np.mean(recalls))
+    return results, recalls
+
+def _estimatedRecall(nearest, howmany, known):
+    """fraction of the howmany nearest TS found for sure: the i-th (distance, row) pair of nearest is
+    among them when fewer than howmany - i other TS can be closer, given known, the exact distance
+    or a lower bound on it of every TS but those found"""
+    known = np.sort(known)
+    found = sum(1 for i, (distance, row) in enumerate(nearest)
+                if i + np.searchsorted(known, distance, side='left') < howmany)
+    return found / howmany
+
+def measureRecall(inputFileNames, howmany = 1, budgets = DEFAULT_BUDGETS, timeLimits = ()):
+    """recall and latency of the approximate searches for each budget and each time limit, against the exact search:
+    a list of (budget, timeLimit, recall, estimated recall, seconds per query), the exact search first"""
+    started = time.time()
+    exact = mostSimilarTS_batch(inputFileNames, howmany)
+    curve = [(None, None, 1.0, 1.0, (time.time() - started) / len(inputFileNames))]
+    for budget, timeLimit in [(budget, None) for budget in budgets] + [(None, limit) for limit in timeLimits]:
+        started = time.time()
+        approximate = mostSimilarTS_approx_batch(inputFileNames, howmany, budget, timeLimit)
+        seconds = (time.time() - started) / len(inputFileNames)
+        # all of no neighbors are found
+        recall = np.mean([len(set(names) & set(expected)) / len(expected) if expected else 1.0
+                          for (names, estimated), expected in zip(approximate, exact)])
+        estimated = np.mean([estimated for (names, estimated) in approximate])
+        curve.append((budget, timeLimit, float(recall), float(estimated), seconds))
+    return curve
+
+def mostSimilarTS_tree(inputFileName, howmany = 1):
+    if manifest is None:
+        loadIndex()
+    inputTS = ts.ArrayTimeSeries(np.load(inputFileName))
+    inputstdTS =  stand(inputTS, inputTS.mean(), inputTS.std())
+    inputFourier, inputK = spectral_features(inputstdTS)
+    
+    # search the whole tree, skipping the subtrees too far from the target TS to hold any of its neighbors
+    if manifest.vpTree is None:
+        raise ValueError('The index was built without a vantage point tree, build it again with createVPForest')
+    vptree = VPDBforest.openVPTree(manifest.vpTree, manifest.vpTreeRoot, cache=nodeCache)
+    nearest = vptree.nearest(seriesStore, inputFourier, inputK, howmany)
+    print ("Distances computed = ", vptree.cost)
+    vptree.close()
+    return [seriesStore.name(row) for (distance, row) in nearest]
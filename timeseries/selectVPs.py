@@ -4,14 +4,16 @@ and return dictionary with numeric key from 1 - 20 and values are (name of TS se
 
 Example of returned value: {('ts_806.npy', 'VPDB1.dbdb'), ...}
 
+selectVPs(n = 20, seed = None, count = 1000) draws n of the count TS; the same seed draws the same vantage points
+
 Precondition:
 ------------
 The name of the timeseries generated should follow the format 'ts_1.npy' ... to 'ts_1000.npy' 
 """
 import numpy as np
 
-def selectVPs(n = 20):
-    VPindex = np.random.choice(np.arange(1, 1001), size = n, replace = False)
+def selectVPs(n = 20, seed = None, count = 1000):
+    VPindex = np.random.RandomState(seed).choice(np.arange(1, count + 1), size = n, replace = False)
     VPDict = {}
     for i in range(n):
         VPfileName = 'ts_'+ str(VPindex[i]) +'.npy'
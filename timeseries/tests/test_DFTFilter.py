@@ -0,0 +1,69 @@
+import numpy as np
+from DFTFilter import DFTFilter
+from SeriesStore import SeriesStore
+from TimeSeriesDistance import spectral_features_many, kernel_dist_spectra_matrix, kcorr_metric
+from pytest import raises
+
+"""
+test functions for the DFT lower bound filter
+"""
+def standardized(values):
+    return (values - values.mean(axis=1)[:, None]) / values.std(axis=1)[:, None]
+
+def exact(store, spectra, kernels):
+    return kcorr_metric(kernel_dist_spectra_matrix(spectra, kernels, store.spectrum(slice(None)),
+                                                   store.self_kernel(slice(None)), store.values.shape[1]))
+
+#test that the bounds never exceed the exact distances, whatever the number of coefficients and the length
+def test_lower_bounds(tmpdir):
+    for n, values in ((64, np.cumsum(np.random.randn(100, 64), axis=1)), (63, np.random.randn(100, 63))):
+        store = SeriesStore.create(str(tmpdir.join('series' + str(n))), [str(i) for i in range(100)], values)
+        spectra, kernels = spectral_features_many(np.random.randn(5, n))
+        distances = exact(store, spectra, kernels)
+        for coefficients in (1, 4, 16, 40):
+            dftFilter = DFTFilter(store, coefficients)
+            features = dftFilter.features(spectra)
+            bounds = dftFilter.lower_bounds(features, kernels)
+            assert bounds.shape == (5, 100)
+            assert np.all(bounds <= distances + 1e-12)
+            assert np.allclose(dftFilter.lower_bounds(features, kernels, [7, 3]), bounds[:, [7, 3]])
+
+#test that the bounds hold for other multipliers, the self-kernels of the series being computed with them too
+def test_lower_bounds_mult(tmpdir):
+    values = np.cumsum(np.random.randn(100, 64), axis=1)
+    store = SeriesStore.create(str(tmpdir.join('series')), [str(i) for i in range(100)], values)
+    queries = standardized(np.cumsum(np.random.randn(5, 64), axis=1))
+    for mult in (0.5, 2):
+        spectra, kernels = spectral_features_many(queries, mult=mult)
+        storeSpectra, storeKernels = spectral_features_many(store.std(slice(None)), mult=mult)
+        distances = kcorr_metric(kernel_dist_spectra_matrix(spectra, kernels, storeSpectra, storeKernels, 64, mult=mult))
+        dftFilter = DFTFilter(store, 8, mult=mult)
+        bounds = dftFilter.lower_bounds(dftFilter.features(spectra), kernels)
+        assert np.all(bounds <= distances + 1e-12) and np.any(bounds > 0)
+
+#test that on random walks the bounds rule out most series farther than the 5th nearest, with the default coefficients
+def test_lower_bounds_prune(tmpdir):
+    rng = np.random.RandomState(0)
+    store = SeriesStore.create(str(tmpdir.join('walks')), [str(i) for i in range(200)],
+                               np.cumsum(rng.randn(200, 64), axis=1))
+    spectra, kernels = spectral_features_many(standardized(np.cumsum(rng.randn(5, 64), axis=1)))
+    distances = exact(store, spectra, kernels)
+    dftFilter = DFTFilter(store)
+    bounds = dftFilter.lower_bounds(dftFilter.features(spectra), kernels)
+    radius = np.sort(distances, axis=1)[:, 4:5]
+    assert np.all(bounds <= distances + 1e-12)
+    assert np.mean(bounds > radius) > 0.25
+
+#test the counts of the filter and invalid input
+def test_selectivity(tmpdir):
+    store = SeriesStore.create(str(tmpdir.join('series')), ['a', 'b'], np.random.randn(2, 16))
+    dftFilter = DFTFilter(store, 100)
+    assert dftFilter.coefficients == 9 and len(dftFilter) == 2
+    assert dftFilter.selectivity is None
+    dftFilter.record(10, 4)
+    dftFilter.record(10, 1)
+    assert (dftFilter.tested, dftFilter.passed, dftFilter.selectivity) == (20, 5, 0.25)
+    dftFilter.reset()
+    assert dftFilter.tested == 0
+    with raises(ValueError):
+        DFTFilter(store, 0)
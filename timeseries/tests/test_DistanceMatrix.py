@@ -0,0 +1,59 @@
+import numpy as np
+from DistanceMatrix import distance_matrix
+from TimeSeriesDistance import kernel_corr, kcorr_dist
+from pytest import raises
+
+"""
+test functions for the all-pairs distance matrices
+"""
+def standardized_rows(count, n):
+    series = np.random.randn(count, n)
+    return (series - series.mean(axis=1)[:, None]) / series.std(axis=1)[:, None]
+
+def pairwise(series, others, mult=1):
+    return np.array([[kcorr_dist(kernel_corr(x, y, mult)) for y in others] for x in series])
+
+#test the matrix of series with each other against kernel_corr, across block sizes
+def test_square():
+    series = standardized_rows(10, 50)
+    expected = pairwise(series, series, 10)
+    for block in (1, 3, 10, 64):
+        assert np.allclose(distance_matrix(series, mult=10, block=block), expected)
+
+#test the matrix of series with others against kernel_corr
+def test_rectangular():
+    series = standardized_rows(7, 51)
+    others = standardized_rows(4, 51)
+    assert np.allclose(distance_matrix(series, others, block=3), pairwise(series, others))
+
+#test the condensed distances against the square matrix
+def test_condensed():
+    series = standardized_rows(9, 40)
+    square = distance_matrix(series)
+    for block in (2, 4, 9):
+        condensed = distance_matrix(series, condensed=True, block=block)
+        assert np.allclose(condensed, square[np.triu_indices(9, 1)])
+
+#test writing the result to a memory mapped file
+def test_out(tmpdir):
+    series = standardized_rows(6, 30)
+    fileName = str(tmpdir.join('distances.npy'))
+    result = distance_matrix(series, out=fileName, block=4)
+    assert isinstance(result, np.memmap)
+    assert np.allclose(np.load(fileName), pairwise(series, series))
+
+#test spreading the blocks across processes
+def test_processes():
+    series = standardized_rows(12, 30)
+    assert np.allclose(distance_matrix(series, block=5, processes=2), distance_matrix(series))
+    assert np.allclose(distance_matrix(series, condensed=True, block=5, processes=2),
+                       distance_matrix(series, condensed=True))
+
+#test invalid input
+def test_invalid_input():
+    with raises(ValueError):
+        distance_matrix(standardized_rows(3, 10), standardized_rows(3, 11))
+    with raises(ValueError):
+        distance_matrix(standardized_rows(3, 10), standardized_rows(3, 10), condensed=True)
+    with raises(ValueError):
+        distance_matrix(standardized_rows(3, 10), block=0)
@@ -0,0 +1,36 @@
+import json
+from IndexManifest import IndexManifest
+from pytest import raises
+
+"""
+test functions for the index manifest
+"""
+def manifest():
+    return IndexManifest([('ts_3.npy', 2, 'VPDB1.dbdb'), ('ts_1.npy', 0, 'VPDB2.dbdb')], 10, 100, seed=5)
+
+#test that saved manifests load back the same
+def test_save_load(tmpdir):
+    path = str(tmpdir.join('manifest.json'))
+    manifest().save(path)
+    loaded = IndexManifest.load(path)
+    assert loaded.vantagePoints == manifest().vantagePoints
+    assert (loaded.seriesCount, loaded.length, loaded.seed, loaded.mult) == (10, 100, 5, 1)
+    assert not tmpdir.join('manifest.json.tmp').exists()
+    assert (loaded.vpTree, loaded.vpTreeRoot) == (None, None)
+    IndexManifest([('ts_3.npy', 2, 'VPDB1.dbdb')], 10, 100, vpTree='VPTree.dbdb', vpTreeRoot=4096).save(path)
+    assert (IndexManifest.load(path).vpTree, IndexManifest.load(path).vpTreeRoot) == ('VPTree.dbdb', 4096)
+
+#test the vantage points in the format of selectVPs
+def test_VPDict():
+    assert manifest().VPDict == {1: ('ts_3.npy', 'VPDB1.dbdb'), 2: ('ts_1.npy', 'VPDB2.dbdb')}
+    assert manifest().VProws == [2, 0]
+
+#test that manifests of another version are refused
+def test_version(tmpdir):
+    path = str(tmpdir.join('manifest.json'))
+    manifest().save(path)
+    saved = json.loads(tmpdir.join('manifest.json').read())
+    saved['version'] = 0
+    tmpdir.join('manifest.json').write(json.dumps(saved))
+    with raises(ValueError):
+        IndexManifest.load(path)
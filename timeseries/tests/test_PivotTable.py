@@ -0,0 +1,64 @@
+import numpy as np
+from PivotTable import PivotTable
+from SeriesStore import SeriesStore
+from TimeSeriesDistance import spectral_features, kernel_dist_many, kcorr_metric
+from pytest import raises
+
+"""
+test functions for the pivot table
+"""
+def clustered_store(tmpdir, count=200, n=64):
+    # a few well separated groups of noisy copies of the same series
+    centers = np.random.randn(5, n)
+    values = [centers[i % 5] + 0.1 * np.random.randn(n) for i in range(count)]
+    return SeriesStore.create(str(tmpdir.join('series')), ['ts_' + str(i) for i in range(count)], values)
+
+def brute_force(store, std):
+    return kcorr_metric(kernel_dist_many(std, store.std(slice(None)))[0])
+
+#test that created tables hold the distances to the pivots and can be reopened
+def test_create(tmpdir):
+    store = clustered_store(tmpdir)
+    table = PivotTable.create(str(tmpdir.join('pivots')), store, [3, 50, 101])
+    table = PivotTable(str(tmpdir.join('pivots')))
+    assert len(table) == 200
+    assert list(table.pivots) == [3, 50, 101]
+    assert table.distances.shape == (200, 3)
+    assert np.allclose(table.distances[:, 1], brute_force(store, store.std(50)))
+
+#test that the bounds never exceed the true distances
+def test_lower_bounds(tmpdir):
+    store = clustered_store(tmpdir)
+    table = PivotTable.create(str(tmpdir.join('pivots')), store, [0, 1, 2, 3, 4])
+    query = store.std(7) + 0.05 * np.random.randn(64)
+    query = (query - query.mean()) / query.std()
+    fourier, kernel = spectral_features(query)
+    pivotDistances = table.pivot_distances(store, fourier, kernel)
+    assert np.all(table.lower_bounds(pivotDistances) <= brute_force(store, query) + 1e-12)
+    assert np.allclose(table.lower_bounds(pivotDistances, [5, 9]), table.lower_bounds(pivotDistances)[[5, 9]])
+
+#test that searches return the exact nearest series, verifying only some of them
+def test_nearest(tmpdir):
+    store = clustered_store(tmpdir)
+    table = PivotTable.create(str(tmpdir.join('pivots')), store, [0, 1, 2, 3, 4])
+    for row in (0, 17, 123):
+        fourier, kernel = spectral_features(store.std(row))
+        expected = brute_force(store, store.std(row))
+        for k in (1, 5, 60):
+            nearest = table.nearest(store, fourier, kernel, k)
+            assert np.allclose([distance for distance, _ in nearest], np.sort(expected)[:k])
+            assert table.cost < len(store)
+        rows = np.arange(0, 200, 3)
+        nearest = table.nearest(store, fourier, kernel, 4, rows)
+        assert np.allclose([distance for distance, _ in nearest], np.sort(expected[rows])[:4])
+        assert all(row in rows for _, row in nearest)
+
+#test invalid input
+def test_invalid_input(tmpdir):
+    store = clustered_store(tmpdir)
+    with raises(ValueError):
+        PivotTable.create(str(tmpdir.join('pivots')), store, [])
+    table = PivotTable.create(str(tmpdir.join('pivots')), store, [0])
+    fourier, kernel = spectral_features(store.std(0))
+    with raises(ValueError):
+        table.nearest(store, fourier, kernel, 0)
@@ -0,0 +1,94 @@
+import numpy as np
+from SeriesStore import SeriesStore
+from TimeSeriesDistance import spectral_features, kernel_dist_many
+from pytest import raises
+
+"""
+test functions for the packed series store
+"""
+#test that created stores keep the rows and names in order
+def test_create(tmpdir):
+    path = str(tmpdir.join('series'))
+    values = [np.arange(5.0) * (i + 1) for i in range(3)]
+    store = SeriesStore.create(path, ['a', 'b', 'c'], values)
+    assert len(store) == 3
+    assert store.values.shape == (3, 5)
+    for row in range(3):
+        assert np.all(store[row] == values[row])
+    assert store.name(1) == 'b'
+    assert store.row('c') == 2
+
+#test reopening a saved store
+def test_reopen(tmpdir):
+    path = str(tmpdir.join('series'))
+    SeriesStore.create(path, ['a', 'b'], [[1, 2], [3, 4]])
+    store = SeriesStore(path)
+    assert np.all(store[1] == [3.0, 4.0])
+    assert store.row('a') == 0
+
+#test that rows are read-only views into the map
+def test_rows_are_views(tmpdir):
+    path = str(tmpdir.join('series'))
+    store = SeriesStore.create(path, ['a', 'b'], [[1, 2], [3, 4]])
+    assert isinstance(store.values, np.memmap)
+    with raises(ValueError):
+        store[0][0] = 10
+
+#test packing series saved in their own files
+def test_from_files(tmpdir):
+    fileNames = []
+    for i in range(4):
+        fileName = str(tmpdir.join('ts_' + str(i + 1) + '.npy'))
+        np.save(fileName, np.arange(10.0) + i)
+        fileNames.append(fileName)
+    store = SeriesStore.from_files(str(tmpdir.join('series')), fileNames)
+    assert len(store) == 4
+    assert store.row(fileNames[2]) == 2
+    assert np.all(store[3] == np.arange(10.0) + 3)
+
+#test the spectral index saved with the series
+def test_spectral_index(tmpdir):
+    path = str(tmpdir.join('series'))
+    values = [np.random.randn(16) for i in range(3)]
+    store = SeriesStore.create(path, ['a', 'b', 'c'], values)
+    for row in range(3):
+        std = (values[row] - values[row].mean()) / values[row].std()
+        spectrum, kernel = spectral_features(std)
+        assert np.allclose(store.std(row), std)
+        assert np.allclose(store.spectrum(row), spectrum)
+        assert np.isclose(store.self_kernel(row), kernel)
+
+#test the distances from a series to all the others, as computed from their values
+def test_distances(tmpdir):
+    values = np.random.randn(300, 16)
+    store = SeriesStore.create(str(tmpdir.join('series')), [str(i) for i in range(300)], values)
+    expected, _ = kernel_dist_many(store.std(7), store.std(slice(None)))
+    assert np.allclose(store.distances(7), expected)
+    assert abs(store.distances(7)[7]) < 1e-9
+
+#test invalid input
+def test_invalid_input(tmpdir):
+    path = str(tmpdir.join('series'))
+    with raises(ValueError):
+        SeriesStore.create(path, [], [])
+    store = SeriesStore.create(path, ['a'], [[1, 2]])
+    with raises(KeyError):
+        store.row('b')
+
+#test appending series, and that a store opened with a count only sees its first rows
+def test_append(tmpdir):
+    path = str(tmpdir.join('series'))
+    values = [np.random.randn(16) for i in range(5)]
+    store = SeriesStore.create(path, ['a', 'b'], values[:2])
+    before = SeriesStore(path)
+    for i in range(2, 5):
+        assert store.append(['abcde'[i]], [values[i]]) == [i]
+    assert len(store) == 5 and store.row('e') == 4
+    for row in range(5):
+        std = (values[row] - values[row].mean()) / values[row].std()
+        assert np.all(store[row] == values[row])
+        assert np.allclose(store.spectrum(row), spectral_features(std)[0])
+    assert len(before) == 2 and np.all(before[1] == values[1])
+    assert len(SeriesStore(path, 3)) == 3 and len(SeriesStore(path)) == 5
+    with raises(ValueError):
+        store.append(['f'], [np.zeros(4)])
@@ -0,0 +1,90 @@
+import numpy as np
+from TimeSeriesDistance import stand, ccor, kernel_corr, kcorr_dist, tsmaker
+from TimeSeriesDistance import spectral_features, ccor_spectra, kernel_corr_spectra, max_corr_at_phase
+from TimeSeriesDistance import spectral_features_many, kernel_dist_spectra_many, kernel_dist_many, kcorr_metric
+from TimeSeriesDistance import kernel_dist_spectra_matrix
+
+"""
+test functions for the timeseries distances
+"""
+def standardized(t):
+    return stand(t, t.mean(), t.std())
+
+#test that a series is at distance 0 from itself
+def test_self_distance():
+    t = standardized(tsmaker(0.5, 0.1, 0.01))
+    assert abs(kcorr_dist(kernel_corr(t, t))) < 1e-12
+
+#test the cross-correlation from spectra against ccor
+def test_ccor_spectra():
+    t1 = standardized(tsmaker(0.5, 0.1, 0.01))
+    t2 = standardized(tsmaker(0.4, 0.1, 0.01))
+    f1, _ = spectral_features(t1)
+    f2, _ = spectral_features(t2)
+    assert np.allclose(ccor_spectra(f1, f2, len(t1)), ccor(t1, t2))
+
+#test the kernel correlation from spectra against kernel_corr, for even and odd lengths
+def test_kernel_corr_spectra():
+    for n in (100, 101):
+        t1 = np.random.randn(n)
+        t2 = np.random.randn(n)
+        t1 = (t1 - t1.mean()) / t1.std()
+        t2 = (t2 - t2.mean()) / t2.std()
+        for mult in (1, 10):
+            f1, k1 = spectral_features(t1, mult)
+            f2, k2 = spectral_features(t2, mult)
+            assert np.isclose(kernel_corr_spectra(f1, k1, f2, k2, n, mult), kernel_corr(t1, t2, mult))
+
+def standardized_rows(count, n):
+    series = np.random.randn(count, n)
+    return (series - series.mean(axis=1)[:, None]) / series.std(axis=1)[:, None]
+
+#test the spectral features of many series against those of each
+def test_spectral_features_many():
+    series = standardized_rows(7, 101)
+    spectra, kernels = spectral_features_many(series, 10, chunk=3)
+    for row in range(7):
+        spectrum, kernel = spectral_features(series[row], 10)
+        assert np.allclose(spectra[row], spectrum)
+        assert np.isclose(kernels[row], kernel)
+
+#test the batch distances and phase shifts against the pairwise functions, across chunk sizes
+def test_kernel_dist_many():
+    t = standardized_rows(1, 100)[0]
+    series = standardized_rows(10, 100)
+    for chunk in (1, 3, 10, 64):
+        distances, shifts = kernel_dist_many(t, series, chunk=chunk)
+        for row in range(10):
+            assert np.isclose(distances[row], kcorr_dist(kernel_corr(t, series[row])))
+            assert shifts[row] == max_corr_at_phase(t, series[row])[0]
+
+#test the batch distances from spectra, and that a shifted series is found at its shift
+def test_kernel_dist_spectra_many():
+    t = standardized_rows(1, 100)[0]
+    series = np.vstack([standardized_rows(4, 100), np.roll(t, -5)])
+    fourier, kernel = spectral_features(t)
+    spectra, kernels = spectral_features_many(series)
+    distances, shifts = kernel_dist_spectra_many(fourier, kernel, spectra, kernels, 100)
+    assert np.allclose(distances, kernel_dist_many(t, series)[0])
+    assert abs(distances[4]) < 1e-12
+    assert shifts[4] == 5
+
+#test that the metric obeys the triangle inequality where kcorr_dist does not have to
+def test_kcorr_metric():
+    series = np.vstack([standardized_rows(20, 100), [standardized(tsmaker(0.5, 0.1, 0.01)) for i in range(20)]])
+    distances = np.array([kernel_dist_many(t, series)[0] for t in series])
+    metric = kcorr_metric(distances)
+    assert np.all(metric >= 0)
+    assert np.all(metric[:, None, :] <= metric[:, :, None] + metric[None, :, :] + 1e-12)
+    assert np.array_equal(np.argsort(metric, axis=1), np.argsort(np.maximum(distances, 0), axis=1))
+
+#test the distances between two sets of spectra against the one-to-many distances
+def test_kernel_dist_spectra_matrix():
+    series = standardized_rows(6, 101)
+    others = standardized_rows(3, 101)
+    spectra, kernels = spectral_features_many(series, 10)
+    otherSpectra, otherKernels = spectral_features_many(others, 10)
+    matrix = kernel_dist_spectra_matrix(spectra, kernels, otherSpectra, otherKernels, 101, 10)
+    assert matrix.shape == (6, 3)
+    for row in range(6):
+        assert np.allclose(matrix[row], kernel_dist_many(series[row], others, 10)[0])
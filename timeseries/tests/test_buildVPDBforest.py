@@ -0,0 +1,492 @@
+import os
+import shutil
+import threading
+import numpy as np
+import buildVPDBforest as VPDBforest
+from IndexManifest import IndexManifest
+from selectVPs import selectVPs
+from PivotTable import PivotTable
+from pytest import raises
+from TimeSeriesDistance import kernel_dist_many, kcorr_metric
+
+"""
+test functions for building the VP forest
+"""
+def saveSeries(tmpdir, n=50):
+    np.random.seed(0)
+    for i in range(n):
+        np.save(str(tmpdir.join('ts_' + str(i + 1) + '.npy')), np.random.randn(64))
+
+def forestContents(manifest):
+    contents = []
+    for name, row, db in manifest.vantagePoints:
+        vpdb = VPDBforest.VantagePointDB(db, name)
+        contents.append(list(vpdb.items()))
+        vpdb.close()
+    return contents
+
+#test that the same seed selects the same vantage points
+def test_selectVPs_seed():
+    assert selectVPs(5, seed=3) == selectVPs(5, seed=3)
+    assert all(int(name[3:-4]) <= 10 for name, db in selectVPs(5, seed=3, count=10).values())
+
+#test that building the forest writes its manifest, and that builds with a seed are reproducible
+def test_createVPForest(tmpdir):
+    saveSeries(tmpdir)
+    with tmpdir.as_cwd():
+        manifest = VPDBforest.createVPForest(k=3, seed=1, n=50)
+        loaded = IndexManifest.load()
+        assert loaded.vantagePoints == manifest.vantagePoints
+        assert (loaded.seriesCount, loaded.length, loaded.seed) == (50, 64, 1)
+        contents = forestContents(manifest)
+        # every series is in every tree, the VP at distance 0 from itself
+        for (name, row, db), items in zip(manifest.vantagePoints, contents):
+            assert sorted(value for key, value in items) == list(range(50))
+            assert items[0][1] == row
+        assert VPDBforest.createVPForest(k=3, seed=1, n=50).vantagePoints == manifest.vantagePoints
+        assert forestContents(manifest) == contents
+
+#test that the single pass distances are the distances to each VP
+def test_forestDistances(tmpdir):
+    saveSeries(tmpdir)
+    with tmpdir.as_cwd():
+        store = VPDBforest.openSeriesStore(50)
+        distances = VPDBforest.forestDistances(store, [4, 0, 33])
+        for column, row in enumerate([4, 0, 33]):
+            assert np.allclose(distances[:, column], kernel_dist_many(store.std(row), store.std(slice(None)))[0])
+
+#test that the trees written by a pool of processes are the same, and the pivot table saved with them
+def test_createVPForest_processes(tmpdir):
+    saveSeries(tmpdir)
+    with tmpdir.as_cwd():
+        manifest = VPDBforest.createVPForest(k=4, seed=2, n=50)
+        contents = forestContents(manifest)
+        assert VPDBforest.createVPForest(k=4, seed=2, n=50, processes=2, report=True).vantagePoints == manifest.vantagePoints
+        assert forestContents(manifest) == contents
+        table = PivotTable(manifest.pivotTable)
+        assert list(table.pivots) == manifest.VProws
+        for column, items in enumerate(contents):
+            for distance, row in items:
+                assert np.isclose(table.distances[row, column], kcorr_metric(distance))
+
+#test that the VP tree is built with the forest, read-only at the root of its manifest, and kept for earlier readers
+def test_createVPForest_vpTree(tmpdir):
+    saveSeries(tmpdir)
+    with tmpdir.as_cwd():
+        first = VPDBforest.createVPForest(k=3, seed=1, n=50)
+        second = VPDBforest.createVPForest(k=3, seed=2, n=50)
+        assert first.vpTree == second.vpTree == VPDBforest.VPTREE_FILE
+        assert first.vpTreeRoot != second.vpTreeRoot
+        store = VPDBforest.openSeriesStore(50)
+        for manifest in (first, second):
+            vptree = VPDBforest.openVPTree(manifest.vpTree, manifest.vpTreeRoot)
+            rows = [row for distance, row in vptree.nearest(store, store.spectrum(9), store.self_kernel(9), None, np.inf)]
+            assert sorted(rows) == list(range(50)) and rows[0] == 9
+            assert vptree.nearest(store, store.spectrum(9), store.self_kernel(9), 0) == []
+            with raises(ValueError):
+                vptree.build(store)
+            vptree.close()
+
+#test that the series inserted in the VP tree are found by its searches, and those removed, vantage points too, are not
+def test_VPTreeDB_insert_remove(tmpdir):
+    np.random.seed(3)
+    store = VPDBforest.SeriesStore.create(str(tmpdir.join('series')), [str(i) for i in range(120)],
+                                          np.random.randn(120, 64))
+    vptree = VPDBforest.VPTreeDB(open(str(tmpdir.join('tree.dbdb')), 'w+b'))
+    vptree.build(store, range(40), seed=1)
+    for row in range(40, 120):
+        vptree.insert(store, row)
+    removed = [vptree._tree._follow(vptree._tree._tree_ref).vp_row, 3, 50, 118]
+    for row in removed:
+        vptree.remove(store, row)
+    vptree.commit()
+    with raises(KeyError):
+        vptree.remove(store, removed[0])
+    live = np.array([row for row in range(120) if row not in removed])
+    for query in (0, 55, 119):
+        fourier, kernel = store.spectrum(query), store.self_kernel(query)
+        assert sorted(row for distance, row in vptree.nearest(store, fourier, kernel, None, np.inf)) == list(live)
+        distances = kcorr_metric(kernel_dist_many(store.std(query), store.std(live))[0])
+        expected = list(live[np.argsort(distances)[:5]])
+        assert [row for distance, row in vptree.nearest(store, fourier, kernel, 5)] == expected
+    vptree.close()
+
+#test adding and removing series in a built forest, and that readers of the previous manifest keep its trees
+def test_VPForest(tmpdir):
+    saveSeries(tmpdir)
+    with tmpdir.as_cwd():
+        built = VPDBforest.createVPForest(k=3, seed=1, n=50)
+        before = forestContents(built)
+        forest = VPDBforest.VPForest()
+        values = np.random.randn(64)
+        assert forest.add_series('new', values) == 50
+        with raises(ValueError):
+            forest.add_series('new', values)
+        forest.remove_series('./ts_7.npy')
+        with raises(KeyError):
+            forest.remove_series('./ts_7.npy')
+        # a series missing from a database is not removed from the others
+        key = [key for key, value in forest.VPDBs[1].items() if value == 12][0]
+        forest.VPDBs[1].delete(key)
+        with raises(ValueError):
+            forest.remove_series('./ts_13.npy', commit=False)
+        assert 12 in [value for key, value in forest.VPDBs[0].items()]
+        forest.close()
+        # the forest is not built again over the series it removed, nor over a store of another size
+        with raises(ValueError):
+            VPDBforest.createVPForest(k=3, seed=1, n=50)
+        with raises(ValueError):
+            VPDBforest.createVPForest(k=3, seed=1, n=50, manifestFileName='other.json')
+        manifest = IndexManifest.load()
+        assert (manifest.seriesCount, manifest.removed, manifest.generation) == (51, [6], 2)
+        table = PivotTable(manifest.pivotTable, manifest.seriesCount)
+        store = VPDBforest.SeriesStore(manifest.store, manifest.seriesCount)
+        for column, ((name, row, db), root) in enumerate(zip(manifest.vantagePoints, manifest.roots)):
+            vpdb = VPDBforest.VantagePointDB(db, name, root_address=root)
+            items = list(vpdb.items())
+            vpdb.close()
+            assert sorted(value for key, value in items) == [row for row in range(51) if row != 6]
+            key = [key for key, value in items if value == 50][0]
+            assert np.isclose(key, kernel_dist_many(store.std(50), store.std(row))[0])
+            assert np.isclose(table.distances[50, column], kcorr_metric(key))
+            # the trees committed by the build are still there to be read
+            vpdb = VPDBforest.VantagePointDB(db, name, root_address=built.roots[column])
+            assert list(vpdb.items()) == before[column]
+            vpdb.close()
+        # so is the VP tree, changed along with them
+        for tree, rows in ((manifest, [row for row in range(51) if row != 6]), (built, list(range(50)))):
+            vptree = VPDBforest.openVPTree(tree.vpTree, tree.vpTreeRoot)
+            found = vptree.nearest(store, store.spectrum(50), store.self_kernel(50), None, np.inf)
+            assert sorted(row for distance, row in found) == rows
+            vptree.close()
+
+#test a log-structured database against a dictionary, across flushes, merges and reopening
+def test_DBDB_lsm(tmpdir):
+    path = str(tmpdir.join('lsm.dbdb'))
+    db = VPDBforest.DBDB(open(path, 'w+b'), lsm=True, background_merge=True)
+    db._tree.MEMTABLE_SIZE = 50
+    expected = {}
+    rng = np.random.RandomState(3)
+    for i in range(1000):
+        key = float(rng.rand())
+        db.set(key, i)
+        expected[key] = i
+        if i % 5 == 0:
+            victim = sorted(expected)[rng.randint(len(expected))]
+            db.delete(victim)
+            del expected[victim]
+        if i % 40 == 0:
+            db.commit()
+    with raises(KeyError):
+        db.delete(2.0)
+    db.commit()
+    db.merge()
+    assert list(db.items()) == sorted(expected.items())
+    assert list(db.range(0.25, 0.5)) == [(k, v) for k, v in sorted(expected.items()) if 0.25 <= k <= 0.5]
+    assert len(db._tree._committed) < 10
+    db.close()
+    reader = VPDBforest.DBDB(open(path, 'r+b'), mapped=True)
+    key = sorted(expected)[7]
+    assert reader.get(key) == expected[key]
+    assert list(reader.items()) == sorted(expected.items())
+    reader.close()
+    with raises(ValueError):
+        VPDBforest.DBDB(open(str(tmpdir.join('binary.dbdb')), 'w+b')).close()
+        VPDBforest.DBDB(open(str(tmpdir.join('binary.dbdb')), 'r+b'), lsm=True)
+
+#test that a log-structured or B+tree forest holds the same trees, and takes in new series
+def test_createVPForest_lsm(tmpdir):
+    saveSeries(tmpdir)
+    with tmpdir.as_cwd():
+        contents = forestContents(VPDBforest.createVPForest(k=3, seed=1, n=50))
+    for structure in ('lsm', 'bplus'):
+        tmpdir.mkdir(structure)
+        for i in range(50):
+            tmpdir.join('ts_' + str(i + 1) + '.npy').copy(tmpdir.join(structure))
+        with tmpdir.join(structure).as_cwd():
+            manifest = VPDBforest.createVPForest(k=3, seed=1, n=50, **{structure: True})
+            assert forestContents(manifest) == contents
+            forest = VPDBforest.VPForest()
+            for i in range(20):
+                forest.add_series('new_' + str(i), np.random.randn(64), commit=(i % 4 == 3))
+            forest.remove_series('./ts_3.npy')
+            forest.close()
+            for items in forestContents(IndexManifest.load()):
+                assert sorted(value for key, value in items) == [row for row in range(70) if row != 2]
+            name, row, db = IndexManifest.load().vantagePoints[0]
+            vpdb = VPDBforest.VantagePointDB(db, name)
+            assert isinstance(vpdb._tree, VPDBforest.LSMTree if structure == 'lsm' else VPDBforest.BPlusTree)
+            vpdb.close()
+
+#test a B+tree database against a dictionary, across page splits, merges, reverse scans and reopening
+def test_DBDB_bplus(tmpdir):
+    path = str(tmpdir.join('bplus.dbdb'))
+    db = VPDBforest.DBDB(open(path, 'w+b'), bplus=True)
+    expected = {}
+    rng = np.random.RandomState(4)
+    for i in range(3000):
+        key = float(rng.rand())
+        db.set(key, 'value %d' % i)
+        expected[key] = 'value %d' % i
+        if i % 3 == 0:
+            victim = sorted(expected)[rng.randint(len(expected))]
+            db.delete(victim)
+            del expected[victim]
+        if i % 100 == 0:
+            db.commit()
+    db.commit()
+    assert isinstance(db._tree, VPDBforest.BPlusTree)
+    assert list(db.items()) == sorted(expected.items())
+    inside = [(k, v) for k, v in sorted(expected.items()) if 0.25 <= k <= 0.5]
+    assert list(db.range(0.25, 0.5)) == inside
+    assert list(db._tree.range(0.25, 0.5, reverse=True)) == inside[::-1]
+    assert list(db._tree.range(reverse=True)) == sorted(expected.items(), reverse=True)
+    db.close()
+    reader = VPDBforest.DBDB(open(path, 'r+b'), mapped=True)
+    key = sorted(expected)[7]
+    assert reader.get(key) == expected[key]
+    assert list(reader.items()) == sorted(expected.items())
+    reader.close()
+    with raises(ValueError):
+        VPDBforest.DBDB(open(path, 'r+b'), lsm=True)
+    with raises(ValueError):
+        VPDBforest.DBDB(open(str(tmpdir.join('both.dbdb')), 'w+b'), lsm=True, bplus=True)
+
+#test that a search with a budget of distances stops early, with the best it found, in every structure
+def test_nearest_budget(tmpdir):
+    rng = np.random.RandomState(5)
+    points = rng.rand(300, 2)
+    query = np.array([0.4, 0.3])
+    distance = lambda row: float(np.linalg.norm(points[row] - query))
+    vpDistance = float(np.linalg.norm(query))
+    expected = sorted((distance(row), row) for row in range(len(points)))[:5]
+    for name, options in (('binary', {}), ('lsm', {'lsm': True}), ('bplus', {'bplus': True})):
+        db = VPDBforest.VantagePointDB(str(tmpdir.join('budget_%s.dbdb' % name)), 'vp', **options)
+        db.bulk_load(sorted((float(x.dot(x)), row) for row, x in enumerate(points)))
+        assert db.nearest(vpDistance, distance, 5) == expected and db.complete
+        assert db.nearest(vpDistance, distance, 5, budget=1000) == expected and db.complete
+        approximate = db.nearest(vpDistance, distance, 5, budget=8)
+        assert db.cost == 8 and not db.complete
+        assert len(approximate) == 5 and approximate[0] == expected[0]
+        assert db.nearest(vpDistance, distance, 5, time_limit=0) == [] and not db.complete
+        assert db.nearest(vpDistance, distance, 0) == [] and db.complete
+        with raises(ValueError):
+            db.nearest(vpDistance, distance, 5, budget=0)
+        db.close()
+
+#test that a search reads the series set since the last commit as well
+def test_nearest_uncommitted(tmpdir):
+    for name, options in (('binary', {}), ('lsm', {'lsm': True}), ('bplus', {'bplus': True})):
+        db = VPDBforest.VantagePointDB(str(tmpdir.join('uncommitted_%s.dbdb' % name)), 'vp', **options)
+        for row in range(10):
+            db.set(float(row * row), row)
+        assert len(list(db.items())) == 10
+        assert db.nearest(4.0, lambda row: abs(row - 4.0), 3) == [(0.0, 4), (1.0, 3), (1.0, 5)]
+        db.close()
+
+#test that a file deleted and created again at the same path is not served the records cached for the old one
+def test_NodeCache_new_file(tmpdir):
+    cache = VPDBforest.NodeCache()
+    path = str(tmpdir.join('cached.dbdb'))
+    for generation in range(5):
+        db = VPDBforest.DBDB(open(path, 'w+b'), cache=cache)
+        for key in range(20):
+            db.set(float(key), 'value %d of round %d' % (key, generation))
+        db.commit()
+        db.close()
+        reader = VPDBforest.DBDB(open(path, 'r+b'), mapped=True, cache=cache)
+        assert [value for key, value in reader.items()] == ['value %d of round %d' % (key, generation) for key in range(20)]
+        reader.close()
+        tmpdir.join('cached.dbdb').remove()
+    assert cache.hits == 0
+
+#test that compaction keeps the committed tree of every structure and the storage options, reclaims the rest,
+#and that readers keep their snapshot
+def test_DBDB_compact(tmpdir):
+    cache = VPDBforest.NodeCache()
+    structures = (('binary', VPDBforest.DBDB, {}), ('lsm', VPDBforest.DBDB, {'lsm': True}),
+                  ('pickle', VPDBforest.DBDB, {'format_version': 0}), ('bplus', VPDBforest.DBDB, {'bplus': True}))
+    for name, DB, options in structures:
+        path = str(tmpdir.join(name + '.dbdb'))
+        db = DB(open(path, 'w+b'), cache=cache, buffered=True, sync_commits=2, sync_interval_ms=50, **options)
+        expected = {}
+        for i in range(300):
+            db.set(float(i % 100), 'value %d' % i)
+            expected[float(i % 100)] = 'value %d' % i
+            if i % 10 == 9:
+                db.commit()
+        for key in range(0, 100, 3):
+            db.delete(float(key))
+            del expected[float(key)]
+        db.commit()
+        reader = DB(open(path, 'r+b'), mapped=True, cache=cache)
+        snapshot = list(reader.items())
+        assert snapshot == sorted(expected.items())
+        assert db.compact() > 0
+        assert list(db.items()) == sorted(expected.items())
+        # the options of the storage are kept
+        assert (db._storage.buffered, db._storage.sync_commits, db._storage.sync_interval_ms) == (True, 2, 50)
+        # a second compaction, through the same cache, reclaims nothing and the database can still be written
+        assert db.compact() == 0
+        db.set(1000.0, 'last')
+        db.commit()
+        expected[1000.0] = 'last'
+        assert list(db.items()) == sorted(expected.items())
+        db.close()
+        assert list(reader.items()) == snapshot
+        reader.close()
+        reopened = DB(open(path, 'r+b'), cache=cache)
+        assert list(reopened.items()) == sorted(expected.items())
+        reopened.close()
+
+#test that threads reading through a concurrent storage each see whole commits, in order, while a writer commits
+def test_DBDB_concurrent(tmpdir):
+    path = str(tmpdir.join('concurrent.dbdb'))
+    writer = VPDBforest.DBDB(open(path, 'w+b'))
+    for key in range(20):
+        writer.set(float(key), 0)
+    writer.commit()
+    reader = VPDBforest.DBDB(open(path, 'rb'), concurrent=True)
+    with raises(ValueError):
+        reader.set(0.0, 1)
+    done = threading.Event()
+    errors = []
+    seen = []
+    def read():
+        last = 0
+        try:
+            while not done.is_set() or last < 50:
+                values = [value for key, value in reader.items()]
+                # every key of a commit carries its generation
+                assert len(values) == 20 and len(set(values)) == 1
+                assert values[0] >= last
+                last = values[0]
+                assert reader.get(7.0) >= last
+        except Exception as e:
+            errors.append(e)
+        seen.append(last)
+    threads = [threading.Thread(target=read) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for generation in range(1, 51):
+        for key in range(20):
+            writer.set(float(key), generation)
+        writer.commit()
+    done.set()
+    for thread in threads:
+        thread.join(60)
+    writer.close()
+    reader.close()
+    assert errors == [] and seen == [50] * 4
+
+#test that buffered storages read the records of a transaction from memory, write them on commit and drop them on close
+def test_Storage_buffered(tmpdir):
+    path = str(tmpdir.join('buffered.dbdb'))
+    storage = VPDBforest.Storage(open(path, 'w+b'), buffered=True)
+    size = tmpdir.join('buffered.dbdb').size()
+    addresses = [storage.write(('record %d' % i).encode()) for i in range(5)]
+    assert [storage.read(address) for address in addresses] == [('record %d' % i).encode() for i in range(5)]
+    assert tmpdir.join('buffered.dbdb').size() == size
+    storage.commit_root_address(addresses[-1])
+    assert tmpdir.join('buffered.dbdb').size() > size
+    size = tmpdir.join('buffered.dbdb').size()
+    storage.write(b'uncommitted')
+    storage.close()
+    assert tmpdir.join('buffered.dbdb').size() == size
+    # databases of every structure, in pages for the B+tree, read their uncommitted records back the same way
+    for name, options in (('binary', {}), ('lsm', {'lsm': True}), ('bplus', {'bplus': True})):
+        path = str(tmpdir.join(name + '.dbdb'))
+        db = VPDBforest.DBDB(open(path, 'w+b'), buffered=True, **options)
+        if name == 'lsm':
+            db._tree.MEMTABLE_SIZE = 10
+        for i in range(200):
+            db.set(float(i), 'value %d' % i)
+            if i == 99:
+                db.commit()
+        assert db.get(150.0) == 'value 150'
+        assert list(db.items()) == [(float(i), 'value %d' % i) for i in range(200)]
+        db.close()
+        reopened = VPDBforest.DBDB(open(path, 'r+b'))
+        assert list(reopened.items()) == [(float(i), 'value %d' % i) for i in range(100)]
+        reopened.close()
+
+#test that commits are fsynced every sync_commits commits, or once sync_interval_ms have passed, and on close
+def test_Storage_sync(tmpdir, monkeypatch):
+    syncs = []
+    fsync = VPDBforest.os.fsync
+    def countingSync(fd):
+        syncs.append(fd)
+        fsync(fd)
+    monkeypatch.setattr(VPDBforest.os, 'fsync', countingSync)
+    for name, options, commitSyncs, closeSyncs in (('never', {}, 0, 0), ('every3', {'sync_commits': 3}, 2, 1),
+                                                   ('interval0', {'sync_interval_ms': 0}, 7, 0),
+                                                   ('interval', {'sync_interval_ms': 10 ** 6}, 0, 1)):
+        del syncs[:]
+        db = VPDBforest.DBDB(open(str(tmpdir.join(name + '.dbdb')), 'w+b'), **options)
+        for i in range(7):
+            db.set(float(i), i)
+            db.commit()
+        # the tree, then the root pointing to it
+        assert len(syncs) == 2 * commitSyncs
+        db.close()
+        # commits left unsynced are synced on close, unless no policy was set
+        assert len(syncs) == 2 * commitSyncs + closeSyncs
+
+def avlHeight(tree, ref, lo=-np.inf, hi=np.inf):
+    "height of the subtree at ref, checking its keys are ordered, its heights right and its children balanced"
+    node = tree._follow(ref)
+    if node is None:
+        return 0
+    assert lo < node.key < hi
+    left, right = avlHeight(tree, node.left_ref, lo, node.key), avlHeight(tree, node.right_ref, node.key, hi)
+    assert abs(left - right) <= 1
+    assert node.height == 1 + max(left, right)
+    return node.height
+
+#test that the binary tree stays an AVL tree through sorted inserts and deletes, before and after a commit
+def test_BalancedBinaryTree(tmpdir):
+    path = str(tmpdir.join('avl.dbdb'))
+    db = VPDBforest.DBDB(open(path, 'w+b'))
+    keys = list(range(1000))
+    for key in keys:
+        db.set(float(key), key)
+    assert avlHeight(db._tree, db._tree._tree_ref) <= 1.45 * np.log2(len(keys) + 2)
+    deleted = set(keys[::3]) | set(keys[500:700])
+    for key in sorted(deleted):
+        db.delete(float(key))
+    keys = [key for key in keys if key not in deleted]
+    db.commit()
+    db.close()
+    db = VPDBforest.DBDB(open(path, 'r+b'))
+    assert avlHeight(db._tree, db._tree._tree_ref) <= 1.45 * np.log2(len(keys) + 2)
+    assert list(db.items()) == [(float(key), key) for key in keys]
+    db.close()
+
+#test that a database written with pickled nodes, before the format version, can still be read, written and compacted.
+#pickle_baseline.dbdb was written by the first DBDB: keys 0 to 39 in random order, then 7 and 20 deleted
+def test_DBDB_pickle_baseline(tmpdir):
+    path = str(tmpdir.join('baseline.dbdb'))
+    shutil.copy(os.path.join(os.path.dirname(__file__), 'pickle_baseline.dbdb'), path)
+    expected = dict((float(key), 'ts_%d.npy' % key) for key in range(40) if key not in (7, 20))
+    db = VPDBforest.DBDB(open(path, 'r+b'))
+    assert db._storage.format_version == VPDBforest.Storage.PICKLE_FORMAT
+    assert list(db.items()) == sorted(expected.items())
+    for key in range(40, 60):
+        db.set(float(key), 'ts_%d.npy' % key)
+        expected[float(key)] = 'ts_%d.npy' % key
+    db.delete(3.0)
+    del expected[3.0]
+    db.commit()
+    db.close()
+    reader = VPDBforest.DBDB(open(path, 'r+b'), mapped=True)
+    assert reader._storage.format_version == VPDBforest.Storage.PICKLE_FORMAT
+    assert reader.get(45.0) == 'ts_45.npy'
+    assert list(reader.items()) == sorted(expected.items())
+    reader.close()
+    db = VPDBforest.DBDB(open(path, 'r+b'))
+    db.compact()
+    db.close()
+    db = VPDBforest.DBDB(open(path, 'r+b'))
+    assert db._storage.format_version == VPDBforest.Storage.STRUCT_FORMAT
+    assert list(db.items()) == sorted(expected.items())
+    db.close()
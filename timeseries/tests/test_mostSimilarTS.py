@@ -0,0 +1,194 @@
+import numpy as np
+import buildVPDBforest as VPDBforest
+import mostSimilarTS
+from pytest import raises
+from TimeSeriesDistance import kernel_dist_many, kernel_dist_spectra_many
+
+"""
+test functions for the similarity searches
+"""
+def buildForest(tmpdir, n=60, lsm=False):
+    np.random.seed(1)
+    centers = np.random.randn(4, 64)
+    for i in range(n):
+        np.save(str(tmpdir.join('ts_' + str(i + 1) + '.npy')), centers[i % 4] + 0.3 * np.random.randn(64))
+    VPDBforest.createVPForest(k=4, seed=2, n=n, lsm=lsm)
+    mostSimilarTS.loadIndex()
+
+def bruteForce(fileName, howmany):
+    store = mostSimilarTS.seriesStore
+    values = np.load(fileName)
+    distances, _ = kernel_dist_many((values - values.mean()) / values.std(), store.std(slice(None)))
+    distances[mostSimilarTS.manifest.removed] = np.inf
+    return [store.name(row) for row in np.argsort(distances, kind='mergesort')[:howmany]]
+
+#test that the searches return the exact nearest series
+def test_mostSimilarTS(tmpdir):
+    with tmpdir.as_cwd():
+        buildForest(tmpdir)
+        for i in (1, 17, 42):
+            fileName = './ts_' + str(i) + '.npy'
+            for howmany in (1, 5):
+                expected = bruteForce(fileName, howmany)
+                assert mostSimilarTS.mostSimilarTS(fileName, howmany) == expected
+                assert mostSimilarTS.mostSimilarTS_tree(fileName, howmany) == expected
+
+#test that searches for no neighbors return none, as they always have
+def test_mostSimilarTS_none(tmpdir):
+    with tmpdir.as_cwd():
+        buildForest(tmpdir)
+        assert mostSimilarTS.mostSimilarTS('./ts_3.npy', 0) == []
+        assert mostSimilarTS.mostSimilarTS_tree('./ts_3.npy', 0) == []
+        assert mostSimilarTS.mostSimilarTS_approx('./ts_3.npy', 0, budget=5) == ([], 1.0)
+        curve = mostSimilarTS.measureRecall(['./ts_3.npy', './ts_4.npy'], 0, budgets=(5,))
+        assert [row[:4] for row in curve] == [(None, None, 1.0, 1.0), (5, None, 1.0, 1.0)]
+
+#test that a batch returns the results of each of its queries
+def test_mostSimilarTS_batch(tmpdir):
+    with tmpdir.as_cwd():
+        buildForest(tmpdir)
+        fileNames = ['./ts_' + str(i) + '.npy' for i in (3, 9, 3, 60, 25)]
+        assert mostSimilarTS.mostSimilarTS_batch(fileNames, 4) == [bruteForce(f, 4) for f in fileNames]
+        assert mostSimilarTS.mostSimilarTS_batch([], 4) == []
+
+#test that queries see the series added and removed once the manifest they were committed in is loaded
+def test_mostSimilarTS_VPForest(tmpdir):
+    with tmpdir.as_cwd():
+        buildForest(tmpdir)
+        fileName = './ts_5.npy'
+        before = mostSimilarTS.mostSimilarTS(fileName, 3)
+        forest = VPDBforest.VPForest()
+        np.save('copy.npy', np.load(fileName) + 0.05 * np.random.randn(64))
+        forest.add_series('./copy.npy', np.load('copy.npy'))
+        forest.remove_series(before[1])
+        assert mostSimilarTS.mostSimilarTS(fileName, 3) == before
+        assert mostSimilarTS.mostSimilarTS_tree(fileName, 3) == before
+        mostSimilarTS.loadIndex()
+        expected = bruteForce(fileName, 5)
+        assert './copy.npy' in expected[:2] and before[1] not in expected
+        assert mostSimilarTS.mostSimilarTS(fileName, 5) == expected
+        assert mostSimilarTS.mostSimilarTS_tree(fileName, 5) == expected
+        assert mostSimilarTS.mostSimilarTS_batch(['./copy.npy', './ts_12.npy'], 4) == [
+            bruteForce('./copy.npy', 4), bruteForce('./ts_12.npy', 4)]
+        forest.close()
+
+#test that a compacted forest publishes its new roots, and that queries of the new manifest are exact
+def test_mostSimilarTS_compact(tmpdir):
+    with tmpdir.as_cwd():
+        buildForest(tmpdir)
+        forest = VPDBforest.VPForest()
+        for i in range(10):
+            forest.add_series('./new_' + str(i), np.random.randn(64))
+        forest.remove_series('./ts_8.npy')
+        with raises(ValueError):
+            forest.VPDBs[0].compact()
+        assert forest.compact() > 0
+        mostSimilarTS.loadIndex()
+        fileNames = ['./ts_' + str(i) + '.npy' for i in (8, 15, 44)]
+        for fileName in fileNames:
+            expected = bruteForce(fileName, 5)
+            assert mostSimilarTS.mostSimilarTS(fileName, 5) == expected
+            assert mostSimilarTS.mostSimilarTS_tree(fileName, 5) == expected
+            assert mostSimilarTS.mostSimilarTS_approx(fileName, 5, budget=1000) == (expected, 1.0)
+        assert mostSimilarTS.mostSimilarTS_batch(fileNames, 5) == [bruteForce(f, 5) for f in fileNames]
+        # the compacted forest takes in new series
+        np.save('last.npy', np.load('./ts_15.npy') + 0.05 * np.random.randn(64))
+        forest.add_series('./last.npy', np.load('last.npy'))
+        forest.close()
+        mostSimilarTS.loadIndex()
+        assert mostSimilarTS.mostSimilarTS('./ts_15.npy', 5) == bruteForce('./ts_15.npy', 5)
+
+#test that searches over a log-structured forest are exact too, before and after series are added and removed
+def test_mostSimilarTS_lsm(tmpdir):
+    with tmpdir.as_cwd():
+        buildForest(tmpdir, lsm=True)
+        fileNames = ['./ts_' + str(i) + '.npy' for i in (2, 31, 47)]
+        assert mostSimilarTS.mostSimilarTS_batch(fileNames, 5) == [bruteForce(f, 5) for f in fileNames]
+        forest = VPDBforest.VPForest()
+        for i in range(10):
+            forest.add_series('./new_' + str(i), np.load(fileNames[i % 3]) + 0.1 * np.random.randn(64), commit=False)
+        forest.remove_series('./ts_31.npy', commit=False)
+        forest.commit()
+        forest.close()
+        mostSimilarTS.loadIndex()
+        for fileName in fileNames:
+            assert mostSimilarTS.mostSimilarTS(fileName, 5) == bruteForce(fileName, 5)
+
+#test that the searches stay exact through the DFT filter, which counts the TS it tested
+def test_mostSimilarTS_dftFilter(tmpdir):
+    with tmpdir.as_cwd():
+        buildForest(tmpdir)
+        mostSimilarTS.loadIndex(coefficients=4)
+        fileNames = ['./ts_' + str(i) + '.npy' for i in (4, 22, 51)]
+        assert mostSimilarTS.mostSimilarTS_batch(fileNames, 6) == [bruteForce(f, 6) for f in fileNames]
+        dftFilter = mostSimilarTS.dftFilter
+        assert dftFilter.tested >= dftFilter.passed > 0
+        mostSimilarTS.loadIndex()
+        assert mostSimilarTS.dftFilter is None
+
+#test that the approximate searches return the best they found within their budget, with a recall they never overestimate
+def test_mostSimilarTS_approx(tmpdir):
+    with tmpdir.as_cwd():
+        buildForest(tmpdir)
+        fileNames = ['./ts_' + str(i) + '.npy' for i in (6, 19, 33)]
+        for fileName in fileNames:
+            expected = bruteForce(fileName, 5)
+            assert mostSimilarTS.mostSimilarTS_approx(fileName, 5) == (expected, 1.0)
+            assert mostSimilarTS.mostSimilarTS_approx(fileName, 5, budget=1000) == (expected, 1.0)
+            names, recall = mostSimilarTS.mostSimilarTS_approx(fileName, 5, budget=5)
+            assert len(names) == 5 and 0 <= recall <= len(set(names) & set(expected)) / 5
+        curve = mostSimilarTS.measureRecall(fileNames, 5, budgets=(5, 1000), timeLimits=(10,))
+        assert [row[:2] for row in curve] == [(None, None), (5, None), (1000, None), (None, 10)]
+        assert curve[0][2:4] == curve[2][2:4] == curve[3][2:4] == (1.0, 1.0)
+        assert 0 <= curve[1][3] <= curve[1][2] <= 1
+
+#test that in a batch with a budget, the targets searching the same VP do not compute their distances for each other
+def test_mostSimilarTS_approx_batch(tmpdir, monkeypatch):
+    with tmpdir.as_cwd():
+        buildForest(tmpdir)
+        computed = []
+        def countingDistances(*args):
+            computed.append(len(args[2]))
+            return kernel_dist_spectra_many(*args)
+        monkeypatch.setattr(mostSimilarTS, 'kernel_dist_spectra_many', countingDistances)
+        fileNames = ['./ts_' + str(i) + '.npy' for i in range(1, 25)]
+        found = mostSimilarTS.mostSimilarTS_approx_batch(fileNames, 5, budget=5)
+        assert sum(computed) <= 5 * len(fileNames)
+        for fileName, (names, recall) in zip(fileNames, found):
+            assert len(names) == 5 and 0 <= recall <= len(set(names) & set(bruteForce(fileName, 5))) / 5
+
+#test that series as far from a VP as others, copies and shifted copies of a series, are all in the trees and found
+def test_mostSimilarTS_duplicates(tmpdir):
+    with tmpdir.as_cwd():
+        np.random.seed(1)
+        values = np.random.randn(64)
+        np.save('ts_1.npy', values)
+        np.save('ts_2.npy', values)
+        np.save('ts_3.npy', np.roll(values, 5))
+        for i in range(3, 40):
+            np.save('ts_' + str(i + 1) + '.npy', values + 0.3 * np.random.randn(64))
+        manifest = VPDBforest.createVPForest(k=4, seed=2, n=40)
+        for name, row, db in manifest.vantagePoints:
+            vpdb = VPDBforest.VantagePointDB(db, name)
+            assert sorted(value for key, value in vpdb.items()) == list(range(40))
+            vpdb.close()
+        mostSimilarTS.loadIndex()
+        for fileName in ('./ts_1.npy', './ts_3.npy'):
+            assert sorted(mostSimilarTS.mostSimilarTS(fileName, 3)) == ['./ts_1.npy', './ts_2.npy', './ts_3.npy']
+            assert sorted(mostSimilarTS.mostSimilarTS_tree(fileName, 3)) == ['./ts_1.npy', './ts_2.npy', './ts_3.npy']
+            assert mostSimilarTS.mostSimilarTS(fileName, 6)[3:] == bruteForce(fileName, 6)[3:]
+
+#test that the tree searches stay exact while series come in and go, each commit loaded by the queries
+def test_mostSimilarTS_tree_ingestion(tmpdir):
+    with tmpdir.as_cwd():
+        buildForest(tmpdir)
+        forest = VPDBforest.VPForest()
+        for i in range(12):
+            np.save('new_%d.npy' % i, np.load('./ts_%d.npy' % (i + 1)) + 0.1 * np.random.randn(64))
+            forest.add_series('./new_%d.npy' % i, np.load('new_%d.npy' % i))
+            if i % 3 == 2:
+                forest.remove_series('./ts_%d.npy' % (i + 20))
+            mostSimilarTS.loadIndex()
+            for fileName in ('./new_%d.npy' % i, './ts_%d.npy' % (i + 30)):
+                assert mostSimilarTS.mostSimilarTS_tree(fileName, 4) == bruteForce(fileName, 4)
+        forest.close()